@@ -0,0 +1,261 @@
+import json
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+import redis
+from sqlalchemy import exc
+from flask import render_template
+from mailer import mail_payload
+from models import Customer, Dealer, DealerAlertSetting, ServiceAddress, Tank
+import config
+
+log = logging.getLogger(__name__)
+
+# tank ids with readings since the last pass
+DIRTY_KEY = 'owl:alerts:dirty'
+SCHEDULED_KEY = 'owl:alerts:scheduled'
+
+Thresholds = namedtuple('Thresholds', ['enabled', 'low_level', 'low_days', 'clear_margin', 'clear_days', 'email'])
+
+
+def active_key(dealer_id):
+    # tank id -> raised alert document
+    return 'owl:alerts:active:{}'.format(dealer_id)
+
+
+def mark_changed(redis_client, tank_ids, delay=config.ALERT_BATCH_DELAY):
+    """
+    Queue tanks for the next evaluation pass
+    :param redis_client: redis connection
+    :param tank_ids: tanks that received readings
+    :param delay: seconds the pass waits to collect more tanks
+    :return: True when the caller should queue the evaluation task
+    """
+    tank_ids = list(tank_ids)
+    if not tank_ids:
+        return False
+
+    try:
+        pipe = redis_client.pipeline()
+        pipe.sadd(DIRTY_KEY, *tank_ids)
+        pipe.set(SCHEDULED_KEY, 1, ex=delay + config.ALERT_PASS_TIME_LIMIT, nx=True)
+        return bool(pipe.execute()[1])
+    except redis.RedisError as err:
+        # the tanks are queued again with their next reading
+        log.error('alert queue unavailable: %s', err)
+        return False
+
+
+def dealer_tank_ids(session, dealer_id):
+    """
+    Every tank of a dealer, queued for a pass when its thresholds change
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :return: list of ints
+    """
+    return [row.id for row in session.query(Tank.id).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id
+    )]
+
+
+def take_changed(redis_client):
+    """
+    Atomically take every queued tank id
+    :param redis_client: redis connection
+    :return: list of ints
+    """
+    pipe = redis_client.pipeline()
+    pipe.smembers(DIRTY_KEY)
+    pipe.delete(DIRTY_KEY, SCHEDULED_KEY)
+    members, _ = pipe.execute()
+    return sorted(int(member) for member in members)
+
+
+def dealer_thresholds(session, dealer_ids):
+    """
+    Alert settings of the dealers, config defaults where unset
+    :param session: sqlalchemy session
+    :param dealer_ids:
+    :return: dict of dealer id -> Thresholds
+    """
+    rows = session.query(
+        Dealer.id, Dealer.email, DealerAlertSetting
+    ).outerjoin(
+        DealerAlertSetting, DealerAlertSetting.dealer_id == Dealer.id
+    ).filter(
+        Dealer.id.in_(dealer_ids)
+    ).all()
+
+    thresholds = {}
+    for dealer_id, dealer_email, setting in rows:
+        setting = setting or DealerAlertSetting()
+        thresholds[dealer_id] = Thresholds(
+            setting.enabled is not False,
+            _default(setting.low_level, config.ALERT_LOW_LEVEL),
+            _default(setting.low_days, config.ALERT_LOW_DAYS),
+            _default(setting.clear_margin, config.ALERT_CLEAR_MARGIN),
+            _default(setting.clear_days, config.ALERT_CLEAR_DAYS),
+            setting.notify_email or dealer_email
+        )
+
+    return thresholds
+
+
+def _default(value, default):
+    return default if value is None else value
+
+
+def is_low(thresholds, sensor_value, days_to_empty):
+    return (sensor_value is not None and sensor_value <= thresholds.low_level) or \
+        (days_to_empty is not None and days_to_empty <= thresholds.low_days)
+
+
+def is_clear(thresholds, sensor_value, days_to_empty):
+    # a raised alert only clears past the margins, so readings hovering
+    # around a threshold do not raise it again and again
+    return (sensor_value is None or sensor_value > thresholds.low_level + thresholds.clear_margin) and \
+        (days_to_empty is None or days_to_empty > thresholds.low_days + thresholds.clear_days)
+
+
+def load_tanks(session, tank_ids):
+    return session.query(
+        Tank.id,
+        Customer.dealer_id,
+        Customer.customer_name,
+        ServiceAddress.id.label('service_address_id'),
+        ServiceAddress.address1,
+        ServiceAddress.city,
+        Tank.capacity,
+        Tank.sensor_value,
+        Tank.days_to_empty,
+        Tank.receiver_time
+    ).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Tank.id.in_(tank_ids)
+    ).all()
+
+
+def evaluate(session, redis_client, tank_ids):
+    """
+    Raise and clear alerts for changed tanks only.
+    Per chunk: one query for the tanks, one for their dealers' settings,
+    one redis round trip for the current alert state and one to write changes.
+    :param session: sqlalchemy session
+    :param redis_client: redis connection
+    :param tank_ids: changed tanks
+    :return: (dict of dealer id -> (Thresholds, list of raised alerts), counts)
+    """
+    raised = {}
+    counts = {'evaluated': 0, 'raised': 0, 'cleared': 0}
+    thresholds = {}
+
+    for i in range(0, len(tank_ids), config.ALERT_CHUNK_SIZE):
+        tanks = load_tanks(session, tank_ids[i:i + config.ALERT_CHUNK_SIZE])
+
+        missing = set(t.dealer_id for t in tanks) - set(thresholds)
+        if missing:
+            thresholds.update(dealer_thresholds(session, missing))
+
+        pipe = redis_client.pipeline()
+        for tank in tanks:
+            pipe.hexists(active_key(tank.dealer_id), tank.id)
+        active = pipe.execute()
+
+        pipe = redis_client.pipeline()
+        for tank, is_active in zip(tanks, active):
+            counts['evaluated'] += 1
+            settings = thresholds[tank.dealer_id]
+
+            if not is_active and settings.enabled and is_low(settings, tank.sensor_value, tank.days_to_empty):
+                alert = alert_document(tank, settings)
+                pipe.hset(active_key(tank.dealer_id), tank.id, json.dumps(alert, sort_keys=True))
+                raised.setdefault(tank.dealer_id, (settings, []))[1].append(alert)
+                counts['raised'] += 1
+            elif is_active and (not settings.enabled or is_clear(settings, tank.sensor_value, tank.days_to_empty)):
+                pipe.hdel(active_key(tank.dealer_id), tank.id)
+                counts['cleared'] += 1
+        pipe.execute()
+
+    return raised, counts
+
+
+def alert_document(tank, thresholds):
+    reasons = []
+    if tank.sensor_value is not None and tank.sensor_value <= thresholds.low_level:
+        reasons.append('level')
+    if tank.days_to_empty is not None and tank.days_to_empty <= thresholds.low_days:
+        reasons.append('days_to_empty')
+
+    return {
+        'tank_id': tank.id,
+        'service_address_id': tank.service_address_id,
+        'customer_name': tank.customer_name,
+        'address': '{}, {}'.format(tank.address1, tank.city),
+        'capacity': tank.capacity,
+        'sensor_value': tank.sensor_value,
+        'days_to_empty': tank.days_to_empty,
+        'receiver_time': tank.receiver_time.isoformat() if tank.receiver_time else None,
+        'reasons': reasons,
+        'raised_at': datetime.utcnow().isoformat(),
+    }
+
+
+def run_pass(session, redis_client):
+    """
+    One evaluation pass over everything queued since the last one
+    :param session: sqlalchemy session
+    :param redis_client: redis connection
+    :return: (raised alerts by dealer, summary dict)
+    """
+    started = time.perf_counter()
+
+    try:
+        tank_ids = take_changed(redis_client)
+    except redis.RedisError as err:
+        log.error('alert queue unavailable: %s', err)
+        return {}, {'evaluated': 0, 'raised': 0, 'cleared': 0}
+
+    try:
+        raised, counts = evaluate(session, redis_client, tank_ids)
+    except (exc.SQLAlchemyError, redis.RedisError):
+        # give the next pass another go at them
+        if tank_ids:
+            mark_changed(redis_client, tank_ids)
+        raise
+
+    counts['ms'] = round((time.perf_counter() - started) * 1000.0, 3)
+    if tank_ids:
+        log.info('alert pass: %(evaluated)d tanks, %(raised)d raised, %(cleared)d cleared in %(ms)sms', counts)
+
+    return raised, counts
+
+
+def active_alerts(redis_client, dealer_id):
+    """
+    A dealer's raised alerts, lowest tanks first
+    :param redis_client: redis connection
+    :param dealer_id:
+    :return: list of alert documents
+    """
+    alerts = [json.loads(raw.decode('utf-8')) for raw in redis_client.hgetall(active_key(dealer_id)).values()]
+    return sorted(alerts, key=lambda a: (a['sensor_value'] is None, a['sensor_value'], a['tank_id']))
+
+
+def alert_mail(thresholds, alerts):
+    """
+    One digest per dealer and pass, however many tanks went low
+    :param thresholds: Thresholds of the dealer
+    :param alerts: raised alert documents
+    :return: mailer.mail_payload() dict
+    """
+    subject = 'Low tank alert: {} tank{}'.format(len(alerts), '' if len(alerts) == 1 else 's')
+    html = render_template('low_tank_alert.html', thresholds=thresholds, alerts=alerts)
+    return mail_payload(thresholds.email, subject, html=html, body=subject)
@@ -0,0 +1,346 @@
+"""
+asyncio companion service for the radio gateways.
+
+Serves the hot gateway paths - radio lookup, latest tank state and reading
+ingestion - on aiohttp with aiomysql and aioredis, so thousands of open
+gateway connections share one event loop instead of one blocked worker
+each. It runs next to the Flask app against the same database and redis,
+reuses its models, serializers and ingest planning, and authenticates with
+the Flask session cookie.
+
+    python async_service.py
+    gunicorn 'async_service:create_app()' --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:8081
+"""
+import asyncio
+import functools
+import io
+import json
+import logging
+import pickle
+import time
+from itertools import islice
+import aioredis
+from aiohttp import web
+from aiomysql.sa import create_engine
+from sqlalchemy import select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Query
+from alerts import DIRTY_KEY, SCHEDULED_KEY
+from cache import response_cache
+from dealers import DealerContext, dealer_cache
+from etags import version_token
+from models import Customer, DealerAccount, Reading, ServiceAddress, Tank
+from radio_index import CHANNEL, RadioEntry, RadioIndex, device_query
+from readings import device_lookup_query, ingest_result, iter_ndjson, latest_state_case_statement, \
+    latest_state_params, parse_readings, plan_ingest, updated_rows
+from serializers import encode, tank_serializer
+from tasks import evaluate_alerts_task
+import config
+
+log = logging.getLogger(__name__)
+
+# this process keeps its own copy of the index, fed by the same pub/sub events
+radio_index = RadioIndex()
+
+
+class ApiError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def json_response(document, status=200, headers=None):
+    return web.Response(text=encode(document), status=status, headers=headers, content_type='application/json')
+
+
+@web.middleware
+async def api_errors(request, handler):
+    try:
+        return await handler(request)
+    except ApiError as err:
+        return json_response({'code': err.code, 'message': err.message}, err.code)
+
+
+async def fetch_all(engine, statement):
+    """
+    Run a select and return plain tuples in column order
+    :param engine: aiomysql.sa engine
+    :param statement: sqlalchemy selectable
+    :return: list of tuples
+    """
+    async with engine.acquire() as conn:
+        result = await conn.execute(statement)
+        rows = await result.fetchall()
+    return [tuple(row.values()) for row in rows]
+
+
+async def fetch_first(engine, statement):
+    rows = await fetch_all(engine, statement.limit(1))
+    return rows[0] if rows else None
+
+
+async def current_dealer(request):
+    """
+    Resolve the dealer from the Flask-Session cookie stored in redis
+    :param request:
+    :return: DealerContext
+    """
+    sid = request.cookies.get(config.SESSION_COOKIE_NAME)
+    data = None
+
+    if sid:
+        data = await request.app['redis'].get(config.SESSION_KEY_PREFIX + sid)
+
+    user_id = pickle.loads(data).get('user_id') if data else None
+    if user_id is None:
+        raise ApiError(401, 'Login required to access this API.')
+
+    user_id = int(user_id)
+    ctx = dealer_cache.get(user_id)
+
+    if ctx is None:
+        row = await fetch_first(request.app['db'], select([DealerAccount.id, DealerAccount.dealer_id]).where(
+            DealerAccount.user_id == user_id
+        ))
+
+        if row is None:
+            raise ApiError(403, 'No dealer account for this user...')
+
+        ctx = DealerContext(user_id, row[0], row[1])
+        dealer_cache.set(user_id, ctx)
+
+    return ctx
+
+
+async def radio_lookup(request):
+    """
+    Device behind a radio network_id, from memory with a database fallback
+    """
+    ctx = await current_dealer(request)
+    network_id = request.match_info['network_id']
+
+    entry, fallback = radio_index.peek(network_id)
+    if fallback:
+        row = await fetch_first(request.app['db'], device_query(None, network_id).statement)
+        entry = radio_index.resolved(network_id, row)
+
+    if entry is None or entry.dealer_id != ctx.dealer_id:
+        raise ApiError(404, 'Radio {} not found...'.format(network_id))
+
+    return json_response({'radio': entry._asdict(), 'status_code': 200})
+
+
+async def tank_state(request):
+    """
+    Latest state of a dealer tank; same document and ETag as the Flask view
+    """
+    ctx = await current_dealer(request)
+    tank_pk_id = int(request.match_info['tank_pk_id'])
+
+    statement = Query(tank_serializer.columns).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Tank.id == tank_pk_id,
+        Customer.dealer_id == ctx.dealer_id
+    ).statement
+
+    row = await fetch_first(request.app['db'], statement)
+
+    if row is None:
+        raise ApiError(404, 'Tank {} not found...'.format(tank_pk_id))
+
+    etag = '"{}"'.format(version_token(row))
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    return json_response({'tank': tank_serializer.dump_row(row), 'status_code': 200}, headers={'ETag': etag})
+
+
+async def readings_batch(request):
+    """
+    Bulk reading ingestion, same contract as POST /readings/batch on the Flask app
+    """
+    ctx = await current_dealer(request)
+
+    started = time.perf_counter()
+    body = await request.read()
+
+    try:
+        if request.content_type in ('application/x-ndjson', 'application/ndjson'):
+            data = list(islice(iter_ndjson(io.BytesIO(body)), config.READING_BATCH_MAX + 1))
+        else:
+            data = json.loads(body.decode('utf-8'))
+            if isinstance(data, dict):
+                data = data.get('readings')
+    except ValueError:
+        data = None
+
+    if not isinstance(data, list):
+        raise ApiError(400, 'Expected a JSON array or NDJSON stream of readings...')
+
+    if len(data) > config.READING_BATCH_MAX:
+        raise ApiError(413, 'Batches are limited to {} readings...'.format(config.READING_BATCH_MAX))
+
+    readings, errors = parse_readings(data)
+    parsed = time.perf_counter()
+
+    result = await ingest_readings(request.app['db'], ctx.dealer_id, readings)
+
+    if result['inserted']:
+        await request.app['redis'].incr(response_cache.generation_key(ctx.dealer_id))
+
+    await queue_alert_evaluation(request.app, result.pop('tank_ids'))
+
+    result['timings_ms']['parse'] = round((parsed - started) * 1000.0, 3)
+    result.update({'received': len(data), 'errors': errors, 'status_code': 201})
+    return json_response(result, 201)
+
+
+async def queue_alert_evaluation(app, tank_ids):
+    """
+    alerts.mark_changed() on aioredis; the first batch of a window queues
+    the celery task, which is sent from a thread so the loop never blocks
+    on the broker
+    """
+    if not tank_ids:
+        return
+
+    redis = app['redis']
+    tr = redis.multi_exec()
+    tr.sadd(DIRTY_KEY, *tank_ids)
+    claimed = tr.set(SCHEDULED_KEY, 1, expire=config.ALERT_BATCH_DELAY + config.ALERT_PASS_TIME_LIMIT,
+                     exist=redis.SET_IF_NOT_EXIST)
+    await tr.execute()
+
+    if await claimed:
+        await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(evaluate_alerts_task.apply_async, countdown=config.ALERT_BATCH_DELAY)
+        )
+
+
+async def ingest_readings(engine, dealer_id, readings):
+    """
+    readings.ingest_readings on the async driver: one query to resolve the
+    devices, multi-row inserts into the history table and the guarded
+    latest-state updates, committed together
+    :param engine: aiomysql.sa engine
+    :param dealer_id:
+    :param readings: list of (network_id, receiver_time, sensor_value)
+    :return: dict with counts, unknown network ids and timings
+    """
+    timings = {}
+    started = time.perf_counter()
+    network_ids = list(set(r[0] for r in readings))
+
+    async with engine.acquire() as conn:
+        devices = {}
+        if network_ids:
+            result = await conn.execute(device_lookup_query(None, dealer_id, network_ids).statement)
+            for row in await result.fetchall():
+                devices[row.network_id] = (row.device_type, row.device_id)
+        timings['resolve'] = time.perf_counter() - started
+
+        rows, latest, unknown = plan_ingest(devices, readings)
+
+        async with conn.begin():
+            phase = time.perf_counter()
+            for i in range(0, len(rows), config.ASYNC_INSERT_CHUNK):
+                await conn.execute(Reading.__table__.insert().values(rows[i:i + config.ASYNC_INSERT_CHUNK]))
+            timings['insert'] = time.perf_counter() - phase
+
+            phase = time.perf_counter()
+            updated = 0
+            for model, params in latest_state_params(latest):
+                # one statement per chunk, aiomysql has no executemany
+                for i in range(0, len(params), config.ASYNC_INSERT_CHUNK):
+                    chunk = params[i:i + config.ASYNC_INSERT_CHUNK]
+                    result = await conn.execute(latest_state_case_statement(model, chunk))
+                    updated += updated_rows(result, chunk)
+            timings['update'] = time.perf_counter() - phase
+
+    timings['total'] = time.perf_counter() - started
+    return ingest_result(dealer_id, rows, latest, unknown, updated, timings)
+
+
+async def stats(request):
+    await current_dealer(request)
+    return json_response({'radio_index': radio_index.stats(), 'status_code': 200})
+
+
+async def load_radio_index(app):
+    rows = await fetch_all(app['db'], device_query(None).statement)
+    entries = radio_index.replace(RadioEntry(*row) for row in rows)
+    log.info('radio index loaded %d devices', len(entries))
+
+
+async def refresh_radio_index(app):
+    while True:
+        await asyncio.sleep(config.RADIO_INDEX_REFRESH)
+        try:
+            await load_radio_index(app)
+        except Exception as err:
+            log.warning('radio index refresh failed: %s', err)
+
+
+async def follow_radio_events(app):
+    # provision/deprovision events published by the Flask workers
+    channel, = await app['redis_sub'].subscribe(CHANNEL)
+    async for message in channel.iter():
+        radio_index.apply(json.loads(message.decode('utf-8')))
+
+
+async def on_startup(app):
+    url = make_url(config.SQLALCHEMY_DATABASE_URI)
+
+    app['db'] = await create_engine(
+        host=url.host,
+        port=url.port or 3306,
+        user=url.username,
+        password=url.password or '',
+        db=url.database,
+        charset='utf8',
+        minsize=config.ASYNC_DB_POOL_MIN,
+        maxsize=config.ASYNC_DB_POOL_MAX,
+        pool_recycle=config.DB_POOL_RECYCLE
+    )
+    app['redis'] = await aioredis.create_redis_pool(config.REDIS_URL, maxsize=config.ASYNC_REDIS_POOL_MAX)
+    app['redis_sub'] = await aioredis.create_redis(config.REDIS_URL)
+
+    await load_radio_index(app)
+    app['workers'] = [
+        asyncio.ensure_future(refresh_radio_index(app)),
+        asyncio.ensure_future(follow_radio_events(app)),
+    ]
+
+
+async def on_cleanup(app):
+    for worker in app['workers']:
+        worker.cancel()
+
+    app['redis_sub'].close()
+    app['redis'].close()
+    await app['redis_sub'].wait_closed()
+    await app['redis'].wait_closed()
+
+    app['db'].close()
+    await app['db'].wait_closed()
+
+
+def create_app():
+    app = web.Application(middlewares=[api_errors])
+    app.router.add_get(config.API_URL_PREFIX + '/radio/lookup/{network_id}', radio_lookup)
+    app.router.add_get(config.API_URL_PREFIX + '/tank/{tank_pk_id:\\d+}', tank_state)
+    app.router.add_post(config.API_URL_PREFIX + '/readings/batch', readings_batch)
+    app.router.add_get(config.API_URL_PREFIX + '/stats/radio-index', stats)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), port=config.ASYNC_SERVICE_PORT)
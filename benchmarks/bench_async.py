@@ -0,0 +1,92 @@
+"""
+Load the same gateway endpoint on the Flask app and on async_service.py
+with many concurrent clients and compare throughput and latency.
+
+Log in once through the Flask app and pass the session cookie value;
+both services accept it.
+
+    python benchmarks/bench_async.py --cookie <session id> \
+        --flask https://localhost:5000 --async http://localhost:8081 \
+        --path /api/v1.0/radio/lookup/<network_id> --concurrency 1000 --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+import aiohttp
+
+
+async def worker(session, url, queue, latencies, errors):
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        started = time.perf_counter()
+        try:
+            async with session.get(url) as resp:
+                await resp.read()
+                if resp.status >= 400:
+                    errors.append(resp.status)
+        except aiohttp.ClientError as err:
+            errors.append(type(err).__name__)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(base_url, args):
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(None)
+
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=args.concurrency, ssl=False)
+    cookies = {'session': args.cookie}
+
+    async with aiohttp.ClientSession(connector=connector, cookies=cookies) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            worker(session, base_url + args.path, queue, latencies, errors) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000.0, 2)
+
+    return {
+        'url': base_url + args.path,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cookie', required=True, help='Flask session cookie value')
+    parser.add_argument('--flask', default='https://localhost:5000')
+    parser.add_argument('--async', dest='async_url', default='http://localhost:8081')
+    parser.add_argument('--path', required=True)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = {}
+    for name, base_url in (('flask', args.flask), ('async', args.async_url)):
+        results[name] = loop.run_until_complete(run(base_url, args))
+
+    results['speedup'] = round(
+        results['async']['requests_per_second'] / max(results['flask']['requests_per_second'], 0.001), 2
+    )
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,518 @@
+"""
+Endpoint load test against the SQLite and fakeredis stand-in (standin.py)
+seeded by seed_data.py. Every endpoint in views.py is driven by concurrent
+clients, one logged in test client per thread, and each gets its p50, p90
+and p99 latency, throughput, status codes and SQL queries per request.
+
+Read-only endpoints run first, then the writes; the radio provisioning
+ones last, as they move radios the readings batches post to. Celery tasks
+run eagerly inside the request, so their queries count towards it.
+
+    python benchmarks/bench_endpoints.py [--clients 4] [--requests 50] [--only tank]
+        [--output results.json] [--compare previous.json] [--tolerance 20]
+        [seed_data.py scale options, or --reuse to keep the database]
+
+The results file is JSON with the git commit, scale and options of the
+run, so two of them can be compared with --compare; an endpoint whose p50
+or queries per request grew by more than --tolerance percent is reported
+as a regression and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin  # noqa: E402
+import seed_data  # noqa: E402
+
+BASE = dict(base_url='https://localhost')
+PREFIX = '/api/v1.0'
+
+# name, method, request(catalog, rng, worker, i) -> (path, open() keyword arguments), anonymous client
+Scenario = namedtuple('Scenario', ['name', 'method', 'request', 'anonymous'])
+
+# dealer rows the requests pick from
+Catalog = namedtuple('Catalog', ['dealer_id', 'user_id', 'latitude', 'longitude', 'billing_day', 'customers',
+                                 'addresses', 'tanks', 'meters'])
+
+# radios the provisioning scenarios add, above any seeded one
+BENCH_RADIO_BASE = 900000000
+
+
+def scenario(name, method='GET', anonymous=False):
+    def register(request):
+        SCENARIOS.append(Scenario(name, method, request, anonymous))
+        return request
+    return register
+
+
+SCENARIOS = []
+
+
+def _json(document):
+    return {'data': json.dumps(document), 'content_type': 'application/json'}
+
+
+@scenario('index')
+def _index(catalog, rng, worker, i):
+    return PREFIX + '/index', {}
+
+
+@scenario('docs')
+def _docs(catalog, rng, worker, i):
+    return PREFIX + '/docs', {}
+
+
+@scenario('login_redirect', anonymous=True)
+def _login_redirect(catalog, rng, worker, i):
+    return PREFIX + '/login', {}
+
+
+@scenario('login_form', anonymous=True)
+def _login_form(catalog, rng, worker, i):
+    return PREFIX + '/auth/login', {}
+
+
+@scenario('customers')
+def _customers(catalog, rng, worker, i):
+    return PREFIX + '/customers?limit=50&after={}'.format(rng.choice(catalog.customers)), {}
+
+
+@scenario('customers_include')
+def _customers_include(catalog, rng, worker, i):
+    return PREFIX + '/customers?limit=20&include=service_addresses&after={}'.format(
+        rng.choice(catalog.customers)), {}
+
+
+@scenario('customer')
+def _customer(catalog, rng, worker, i):
+    return PREFIX + '/customer/{}'.format(rng.choice(catalog.customers)), {}
+
+
+@scenario('service_addresses')
+def _service_addresses(catalog, rng, worker, i):
+    return PREFIX + '/customer/{}/service-addresses'.format(rng.choice(catalog.addresses)[0]), {}
+
+
+@scenario('service_address')
+def _service_address(catalog, rng, worker, i):
+    return PREFIX + '/customer/{}/service-address/{}'.format(*rng.choice(catalog.addresses)), {}
+
+
+@scenario('tanks')
+def _tanks(catalog, rng, worker, i):
+    return PREFIX + '/tanks?limit=50&after={}'.format(rng.choice(catalog.tanks)[0]), {}
+
+
+@scenario('tank')
+def _tank(catalog, rng, worker, i):
+    return PREFIX + '/tank/{}'.format(rng.choice(catalog.tanks)[0]), {}
+
+
+@scenario('tank_history')
+def _tank_history(catalog, rng, worker, i):
+    return PREFIX + '/tank/{}/history'.format(rng.choice(catalog.tanks)[0]), {}
+
+
+@scenario('tank_history_records')
+def _tank_history_records(catalog, rng, worker, i):
+    return PREFIX + '/tank/{}/history/20'.format(rng.choice(catalog.tanks)[0]), {}
+
+
+@scenario('routes')
+def _routes(catalog, rng, worker, i):
+    return PREFIX + '/routes', {}
+
+
+@scenario('alerts')
+def _alerts(catalog, rng, worker, i):
+    return PREFIX + '/alerts', {}
+
+
+@scenario('alert_settings')
+def _alert_settings(catalog, rng, worker, i):
+    return PREFIX + '/alerts/settings', {}
+
+
+@scenario('billing_progress')
+def _billing_progress(catalog, rng, worker, i):
+    return PREFIX + '/billing/run', {}
+
+
+@scenario('service_addresses_nearby')
+def _nearby(catalog, rng, worker, i):
+    return PREFIX + '/service-addresses/nearby?lat={:.5f}&lon={:.5f}&radius_km=10'.format(
+        catalog.latitude + rng.gauss(0, 0.2), catalog.longitude + rng.gauss(0, 0.2)), {}
+
+
+@scenario('tanks_nearest')
+def _nearest(catalog, rng, worker, i):
+    return PREFIX + '/tanks/nearest?lat={:.5f}&lon={:.5f}&k=10'.format(
+        catalog.latitude + rng.gauss(0, 0.2), catalog.longitude + rng.gauss(0, 0.2)), {}
+
+
+@scenario('radios')
+def _radios(catalog, rng, worker, i):
+    return PREFIX + '/radios', {}
+
+
+@scenario('radio')
+def _radio(catalog, rng, worker, i):
+    return PREFIX + '/radio/{}'.format(rng.choice(catalog.tanks)[1]), {}
+
+
+@scenario('radio_lookup')
+def _radio_lookup(catalog, rng, worker, i):
+    return PREFIX + '/radio/lookup/{}'.format(rng.choice(catalog.tanks)[1]), {}
+
+
+@scenario('stats_radio_index')
+def _stats_radio_index(catalog, rng, worker, i):
+    return PREFIX + '/stats/radio-index', {}
+
+
+@scenario('stats_pool')
+def _stats_pool(catalog, rng, worker, i):
+    return PREFIX + '/stats/pool', {}
+
+
+@scenario('stats_response_cache')
+def _stats_response_cache(catalog, rng, worker, i):
+    return PREFIX + '/stats/response-cache', {}
+
+
+@scenario('meters')
+def _meters(catalog, rng, worker, i):
+    return PREFIX + '/meters?limit=50', {}
+
+
+@scenario('meters_usage')
+def _meters_usage(catalog, rng, worker, i):
+    return PREFIX + '/meters/usage', {}
+
+
+@scenario('meter')
+def _meter(catalog, rng, worker, i):
+    return PREFIX + '/meter/{}'.format(rng.choice(catalog.meters or [0])), {}
+
+
+@scenario('alert_settings_update', 'PUT')
+def _alert_settings_update(catalog, rng, worker, i):
+    return PREFIX + '/alerts/settings', _json({'low_level': rng.choice([15.0, 20.0, 25.0]), 'low_days': 5})
+
+
+@scenario('readings_batch', 'POST')
+def _readings_batch(catalog, rng, worker, i):
+    # newer than the seeded history, one second apart per worker and request
+    at = datetime.utcnow() + timedelta(seconds=worker * 100000 + i)
+    tanks = rng.sample(catalog.tanks, min(100, len(catalog.tanks)))
+    readings = [{'network_id': network_id, 'receiver_time': at.isoformat(),
+                 'sensor_value': round(rng.uniform(5, 90), 1)} for _, network_id in tanks]
+    return PREFIX + '/readings/batch', _json(readings)
+
+
+@scenario('tanks_forecast', 'POST')
+def _tanks_forecast(catalog, rng, worker, i):
+    return PREFIX + '/tanks/forecast', {}
+
+
+@scenario('billing_run', 'POST')
+def _billing_run(catalog, rng, worker, i):
+    # a run is only accepted on a cycle day, repeats resume it
+    return PREFIX + '/billing/run?day={}'.format(catalog.billing_day.isoformat()), {}
+
+
+@scenario('import_customers', 'POST')
+def _import_customers(catalog, rng, worker, i):
+    rows = [json.dumps({'customer_name': 'Imported {}-{}-{}'.format(worker, i, n), 'address1': '1 Main St',
+                        'city': 'Charlotte', 'state': 'NC', 'postal_code': '28202'}) for n in range(100)]
+    return PREFIX + '/import/customers', {'data': '\n'.join(rows), 'content_type': 'application/x-ndjson'}
+
+
+def _cycle_pair(catalog, worker, i):
+    # the same tank and radio for the provision and the deprovision of a pair
+    slot = worker * 100000 + i
+    return catalog.tanks[slot % len(catalog.tanks)][0], BENCH_RADIO_BASE + slot
+
+
+@scenario('tank_provision', 'POST')
+def _tank_provision(catalog, rng, worker, i):
+    return PREFIX + '/tank/{}/provision/{}'.format(*_cycle_pair(catalog, worker, i)), {}
+
+
+@scenario('tank_deprovision', 'POST')
+def _tank_deprovision(catalog, rng, worker, i):
+    return PREFIX + '/tank/{}/deprovision/{}'.format(*_cycle_pair(catalog, worker, i)), {}
+
+
+@scenario('tanks_provision', 'POST')
+def _tanks_provision(catalog, rng, worker, i):
+    base = BENCH_RADIO_BASE // 2 + (worker * 1000 + i) * 100
+    items = [{'tank_id': tank_id, 'network_id': str(base + n)}
+             for n, (tank_id, _) in enumerate(rng.sample(catalog.tanks, min(100, len(catalog.tanks))))]
+    return PREFIX + '/tanks/provision', _json(items)
+
+
+@scenario('logout', anonymous=True)
+def _logout(catalog, rng, worker, i):
+    return PREFIX + '/logout', {}
+
+
+class QueryCounter(threading.local):
+    """
+    SQL statements run by the current thread
+    """
+    count = 0
+
+    def install(self, engine):
+        from sqlalchemy import event
+
+        def before_cursor_execute(*args, **kwargs):
+            self.count += 1
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def last_cycle_day(start_of_billing_cycle):
+    from billing import cycle_day
+
+    today = datetime.utcnow().date()
+    day = cycle_day(today, start_of_billing_cycle)
+    if day > today:
+        day = cycle_day(today.replace(day=1) - timedelta(days=1), start_of_billing_cycle)
+    return day
+
+
+def load_catalogs():
+    from extensions import db
+    from models import Customer, Dealer, DealerAccount, Meter, ServiceAddress, Tank
+
+    session = db.session
+    catalogs = []
+    for dealer_id, user_id, latitude, longitude, start_of_cycle in session.query(
+        Dealer.id, DealerAccount.user_id, Dealer.latitude, Dealer.longitude, Dealer.start_of_billing_cycle
+    ).join(DealerAccount, DealerAccount.dealer_id == Dealer.id).order_by(Dealer.id):
+        addresses = session.query(ServiceAddress.customer_id, ServiceAddress.id).join(
+            Customer, ServiceAddress.customer_id == Customer.id).filter(Customer.dealer_id == dealer_id).all()
+        tanks = session.query(Tank.id, Tank.network_id).join(
+            ServiceAddress, Tank.service_address_id == ServiceAddress.id
+        ).join(Customer, ServiceAddress.customer_id == Customer.id).filter(
+            Customer.dealer_id == dealer_id, Tank.network_id.isnot(None)).order_by(Tank.id).all()
+        meters = session.query(Meter.id).join(
+            ServiceAddress, Meter.service_address_id == ServiceAddress.id
+        ).join(Customer, ServiceAddress.customer_id == Customer.id).filter(Customer.dealer_id == dealer_id).all()
+
+        catalogs.append(Catalog(dealer_id, user_id, latitude or 0.0, longitude or 0.0,
+                                last_cycle_day(start_of_cycle or 1), sorted(set(a[0] for a in addresses)),
+                                [tuple(a) for a in addresses], [tuple(t) for t in tanks], [m[0] for m in meters]))
+    session.remove()
+
+    if not catalogs or not all(c.customers and c.tanks for c in catalogs):
+        raise SystemExit('The database has no seeded dealers with customers and tanks, run without --reuse')
+    return catalogs
+
+
+def client_for(app, user_id=None):
+    client = app.test_client()
+    if user_id is not None:
+        with client.session_transaction(**BASE) as session:
+            session['user_id'] = str(user_id)
+            session['_fresh'] = True
+    return client
+
+
+def percentile(ordered, fraction):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def run_scenario(app, counter, catalogs, item, clients, requests, seed):
+    """
+    requests from each of clients threads at once
+    :return: result dict of the endpoint
+    """
+    latencies = []
+    queries = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def work(worker):
+        catalog = catalogs[worker % len(catalogs)]
+        rng = random.Random('{}-{}-{}'.format(seed, item.name, worker))
+        client = client_for(app, None if item.anonymous else catalog.user_id)
+        timings = []
+        counts = []
+        codes = {}
+        barrier.wait()
+
+        for i in range(requests):
+            path, kwargs = item.request(catalog, rng, worker, i)
+            counter.count = 0
+            started = time.perf_counter()
+            try:
+                response = client.open(path, method=item.method, **dict(BASE, **kwargs))
+                response.get_data()
+                code = response.status_code
+            except Exception as err:
+                code = 'exception'
+                with lock:
+                    if len(errors) < 5:
+                        errors.append('{}: {}'.format(type(err).__name__, err))
+            timings.append(time.perf_counter() - started)
+            counts.append(counter.count)
+            codes[code] = codes.get(code, 0) + 1
+
+        with lock:
+            latencies.extend(timings)
+            queries.extend(counts)
+            for code, count in codes.items():
+                statuses[str(code)] = statuses.get(str(code), 0) + count
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000.0, 3) if seconds is not None else None  # noqa: E731
+    return {
+        'method': item.method,
+        'requests': len(latencies),
+        'statuses': statuses,
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p90_ms': ms(percentile(latencies, 0.90)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'max_ms': ms(latencies[-1]) if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(sum(queries) / float(len(queries)), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=standin.ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current, tolerance):
+    """
+    :param previous: results document of an earlier run
+    :param current: results document of this run
+    :param tolerance: percent an endpoint may grow before it counts as a regression
+    :return: (report lines, number of regressions)
+    """
+    lines = ['{:<28} {:>10} {:>10} {:>8} {:>9} {:>9}'.format('endpoint', 'p50 before', 'p50 now', 'change',
+                                                             'queries', 'before')]
+    regressions = 0
+
+    for name, now in current['endpoints'].items():
+        before = previous.get('endpoints', {}).get(name)
+        if before is None or not before.get('p50_ms') or now['p50_ms'] is None:
+            lines.append('{:<28} {:>10} {:>10}'.format(name, '-', now['p50_ms']))
+            continue
+
+        change = (now['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100.0
+        more_queries = (now['queries_per_request'] or 0) > (before['queries_per_request'] or 0) * (
+            1 + tolerance / 100.0)
+        flag = ''
+        if change > tolerance or more_queries:
+            flag = '  REGRESSION'
+            regressions += 1
+        lines.append('{:<28} {:>10} {:>10} {:>+7.1f}% {:>9} {:>9}{}'.format(
+            name, before['p50_ms'], now['p50_ms'], change, now['queries_per_request'], before['queries_per_request'],
+            flag))
+
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    seed_data.add_arguments(parser)
+    parser.add_argument('--reuse', action='store_true', help='keep an already seeded database')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients per endpoint')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client and endpoint')
+    parser.add_argument('--only', action='append', help='run endpoints whose name contains this, repeatable')
+    parser.add_argument('--output', default='bench_endpoints.json', help='results file')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='percent growth reported as a regression')
+    args = parser.parse_args()
+
+    fresh = not (args.reuse and os.path.exists(args.db))
+    app = standin.boot(args.db, fresh=fresh)
+    from extensions import db
+
+    scale = seed_data.scale_from(args)
+    seeded = None
+    if fresh:
+        seeded = seed_data.Seeder(db.session, scale).run()
+        db.session.remove()
+        print('seeded {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(seeded.items()))))
+
+    counter = QueryCounter()
+    counter.install(db.engine)
+    catalogs = load_catalogs()
+
+    selected = [s for s in SCENARIOS if not args.only or any(part in s.name for part in args.only)]
+    results = {
+        'commit': git_commit(),
+        'started': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': db.engine.url.drivername,
+        'scale': scale.to_dict() if fresh else None,
+        'seeded': seeded,
+        'clients': args.clients,
+        'requests_per_client': args.requests,
+        'endpoints': {},
+    }
+
+    print('{:<28} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}  {}'.format(
+        'endpoint', 'method', 'p50 ms', 'p99 ms', 'req/s', 'queries', 'count', 'statuses'))
+    for item in selected:
+        result = run_scenario(app, counter, catalogs, item, args.clients, args.requests, args.seed)
+        results['endpoints'][item.name] = result
+        print('{:<28} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}  {}'.format(
+            item.name, item.method, result['p50_ms'], result['p99_ms'], result['throughput_rps'],
+            result['queries_per_request'], result['requests'],
+            ' '.join('{}x{}'.format(code, n) for code, n in sorted(result['statuses'].items()))))
+        for error in result['errors']:
+            print('    {}'.format(error))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        lines, regressions = compare(previous, results, args.tolerance)
+        print('\ncompared with {} ({})'.format(args.compare, previous.get('commit')))
+        print('\n'.join(lines))
+        if regressions:
+            print('{} regression{}'.format(regressions, '' if regressions == 1 else 's'))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
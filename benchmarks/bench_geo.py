@@ -0,0 +1,66 @@
+"""
+Radius and nearest-neighbour queries on a synthetic dealer territory:
+the numpy PointIndex against a plain python scan of every row.
+
+    python benchmarks/bench_geo.py [points] [repeat]
+"""
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo import EARTH_RADIUS_KM, PointIndex  # noqa: E402
+
+
+def make_points(count, seed=42):
+    # roughly a 300km x 300km territory
+    rng = random.Random(seed)
+    return [(i, 35.0 + rng.uniform(-1.35, 1.35), -80.0 + rng.uniform(-1.65, 1.65)) for i in range(1, count + 1)]
+
+
+def scan_km(lat, lon, lat2, lon2):
+    lat, lon, lat2, lon2 = map(math.radians, (lat, lon, lat2, lon2))
+    a = math.sin((lat2 - lat) / 2.0) ** 2 + math.cos(lat) * math.cos(lat2) * math.sin((lon2 - lon) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(count=100000, repeat=5):
+    points = make_points(count)
+    lat, lon, radius_km, k = 35.1, -80.2, 15.0, 25
+
+    started = time.perf_counter()
+    index = PointIndex(*zip(*points))
+    build = time.perf_counter() - started
+
+    def scan_within():
+        hits = [(scan_km(lat, lon, p[1], p[2]), p[0]) for p in points]
+        return sorted(h for h in hits if h[0] <= radius_km)
+
+    def scan_nearest():
+        return sorted((scan_km(lat, lon, p[1], p[2]), p[0]) for p in points)[:k]
+
+    assert [pk for _, pk in scan_within()] == list(index.within(lat, lon, radius_km)[0])
+    assert [pk for _, pk in scan_nearest()] == list(index.nearest(lat, lon, k)[0])
+
+    print('points: {}'.format(count))
+    print('index build:              {:.1f}ms'.format(build * 1000.0))
+    print('within {}km, scan:       {:.2f}ms'.format(radius_km, best_of(repeat, scan_within) * 1000.0))
+    print('within {}km, index:      {:.2f}ms'.format(radius_km, best_of(repeat, lambda: index.within(lat, lon, radius_km)) * 1000.0))
+    print('nearest {}, scan:         {:.2f}ms'.format(k, best_of(repeat, scan_nearest) * 1000.0))
+    print('nearest {}, index:        {:.2f}ms'.format(k, best_of(repeat, lambda: index.nearest(lat, lon, k)) * 1000.0))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
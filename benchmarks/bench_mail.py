@@ -0,0 +1,72 @@
+"""
+Mail throughput against a local SMTP sink: one connection per message (the
+old send_async_email behaviour) against the batched queue in mailer.py.
+The sink's connect latency stands in for the TCP, STARTTLS and AUTH round
+trips a real relay costs on every new connection.
+
+Needs a redis for the queue; fakeredis is used when installed.
+
+    python benchmarks/bench_mail.py [messages] [connect latency ms]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_mail import Mail  # noqa: E402
+from app import create_app  # noqa: E402
+from extensions import redis_client as app_redis  # noqa: E402
+from mailer import QUEUE_KEY, build_message, enqueue, flush_queue, mail_payload  # noqa: E402
+from smtp_sink import SMTPSink  # noqa: E402
+
+try:
+    import fakeredis
+    redis_client = fakeredis.FakeStrictRedis()
+except ImportError:
+    redis_client = app_redis
+
+app = create_app(views=False)
+
+
+def sink_mail(sink):
+    app.config.update(MAIL_SERVER=sink.host, MAIL_PORT=sink.port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_DEFAULT_SENDER='alerts@localhost',
+                      MAIL_SUPPRESS_SEND=False)
+    return Mail(app)
+
+
+def payloads(count):
+    return [mail_payload('customer{}@localhost'.format(i), 'Low tank alert', html='<p>tank {} is low</p>'.format(i))
+            for i in range(count)]
+
+
+def main(messages=500, connect_ms=50):
+    with app.app_context():
+        sink = SMTPSink(connect_latency=connect_ms / 1000.0).start()
+        mail = sink_mail(sink)
+
+        started = time.perf_counter()
+        for payload in payloads(messages):
+            mail.send(build_message(payload, mail.default_sender))
+        single_time = time.perf_counter() - started
+        single_connections = sink.connections
+
+        redis_client.delete(QUEUE_KEY)
+        enqueue(redis_client, payloads(messages))
+        started = time.perf_counter()
+        totals = flush_queue(mail, redis_client, rate=0)
+        batched_time = time.perf_counter() - started
+
+        assert totals['sent'] == messages and len(sink.messages) == 2 * messages
+        sink.stop()
+
+    print('messages: {}, connect latency: {}ms'.format(messages, connect_ms))
+    print('connection per message: {:.0f} msg/s, {} connections'.format(messages / single_time, single_connections))
+    print('batched queue:          {:.0f} msg/s, {} connections'.format(
+        messages / batched_time, sink.connections - single_connections))
+    print('speedup: {:.1f}x'.format(single_time / batched_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,75 @@
+"""
+Compare the marshmallow ModelSchema + jsonify list path with the
+compiled row-tuple serializer used by the list endpoints.
+
+    python benchmarks/bench_serializers.py [rows] [repeat]
+"""
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from flask import jsonify  # noqa: E402
+from models import Customer  # noqa: E402
+from schemas import CustomerSchema  # noqa: E402
+from serializers import customer_serializer  # noqa: E402
+
+app = create_app(views=False)
+
+
+def make_rows(count):
+    objects = []
+    for i in range(1, count + 1):
+        objects.append(Customer(
+            id=i,
+            dealer_id=1,
+            customer_name='Customer {}'.format(i),
+            customer_number='C{:08d}'.format(i),
+            address1='{} Main Street'.format(i),
+            city='Charlotte',
+            state='NC',
+            postal_code='28202',
+        ))
+
+    tuples = [tuple(getattr(obj, field) for field in customer_serializer.fields) for obj in objects]
+    return objects, tuples
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(count=10000, repeat=5):
+    objects, tuples = make_rows(count)
+    schema = CustomerSchema(many=True)
+
+    with app.test_request_context():
+        def marshmallow_path():
+            return jsonify({'customers': schema.dump(objects).data, 'next_after': None, 'status_code': 200}).get_data()
+
+        def fast_path():
+            return customer_serializer.response({
+                'customers': customer_serializer.dump_rows(tuples), 'next_after': None, 'status_code': 200
+            }).get_data()
+
+        assert json.loads(marshmallow_path().decode('utf-8')) == json.loads(fast_path().decode('utf-8'))
+
+        slow = best_of(repeat, marshmallow_path)
+        fast = best_of(repeat, fast_path)
+
+    print('rows: {}'.format(count))
+    print('marshmallow + jsonify: {:.1f}ms'.format(slow * 1000.0))
+    print('compiled serializer:   {:.1f}ms'.format(fast * 1000.0))
+    print('speedup: {:.1f}x'.format(slow / fast))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
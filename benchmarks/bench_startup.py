@@ -0,0 +1,134 @@
+"""
+Cold start of each way the code is run, every run in a fresh interpreter
+against the SQLite and fakeredis stand-in (standin.py):
+
+    web     import wsgi (create_app with the API views), then the login page
+    worker  import tasks, then the first task (flush_mail_task, which builds
+            the worker's app)
+    cli     create_app(views=False), then `import customers` of a small file
+
+Each reports the import time, the time to the first request, task or
+command, the process wall time and the modules loaded; the median of
+--runs runs is printed.
+
+    python benchmarks/bench_startup.py [--runs 7] [--only worker] [--output startup.json] [--db /tmp/owl-bench.db]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin  # noqa: E402
+
+PREFIX = '/api/v1.0'
+SCENARIOS = ['web', 'worker', 'cli']
+
+
+def child_web(path):
+    import wsgi
+    imported = time.perf_counter()
+    response = wsgi.app.test_client().get(PREFIX + '/auth/login', base_url='https://localhost')
+    return imported, response.status_code
+
+
+def child_worker(path):
+    import tasks
+    imported = time.perf_counter()
+    result = tasks.flush_mail_task.apply()
+    return imported, result.state
+
+
+def child_cli(path):
+    from click.testing import CliRunner
+    from flask.cli import ScriptInfo
+    from app import create_app
+    app = create_app(views=False)
+    imported = time.perf_counter()
+    result = CliRunner().invoke(app.cli, ['import', 'customers', path, '--dealer', '1'],
+                                obj=ScriptInfo(create_app=lambda info: app))
+    return imported, result.exit_code
+
+
+def child(name, db, path):
+    # stand-in setup is not part of the cold start being measured
+    standin.environ(db)
+    modules = len(sys.modules)
+    started = time.perf_counter()
+    imported, outcome = globals()['child_' + name](path)
+    finished = time.perf_counter()
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'first_ms': (finished - imported) * 1000,
+        'modules': len(sys.modules) - modules,
+        'outcome': outcome,
+    }))
+
+
+def run(name, db, path):
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', os.path.abspath(__file__),
+                                      '--child', name, '--db', db, '--input', path])
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['wall_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def write_rows(path):
+    rows = [json.dumps({'customer_name': 'Startup {}'.format(n), 'address1': '1 Main St', 'city': 'Charlotte',
+                        'state': 'NC', 'postal_code': '28202'}) for n in range(10)]
+    with open(path, 'w') as stream:
+        stream.write('\n'.join(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=standin.DEFAULT_DATABASE, help='SQLite database file, seeded if missing')
+    parser.add_argument('--runs', type=int, default=7, help='fresh processes per scenario')
+    parser.add_argument('--only', action='append', choices=SCENARIOS, help='run this scenario, repeatable')
+    parser.add_argument('--output', help='results file')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--input', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.db, args.input)
+
+    if not os.path.exists(args.db):
+        # one dealer is enough, startup does not depend on the data
+        subprocess.check_call([sys.executable, '-W', 'ignore', os.path.join(os.path.dirname(__file__), 'seed_data.py'),
+                               '--db', args.db, '--dealers', '1', '--customers', '20', '--days', '1'])
+
+    path = os.path.join(tempfile.gettempdir(), 'owl-startup.ndjson')
+    write_rows(path)
+
+    from bench_endpoints import git_commit
+
+    results = {'commit': git_commit(), 'runs': args.runs, 'scenarios': {}}
+    print('{:<8} {:>10} {:>10} {:>10} {:>8}  {}'.format('scenario', 'import ms', 'first ms', 'wall ms', 'modules',
+                                                      'outcome'))
+    for name in args.only or SCENARIOS:
+        # one warm-up so the first run does not pay for writing .pyc files
+        run(name, args.db, path)
+        samples = [run(name, args.db, path) for _ in range(args.runs)]
+        summary = dict((key, round(median(s[key] for s in samples), 1))
+                       for key in ('import_ms', 'first_ms', 'wall_ms', 'modules'))
+        summary['outcome'] = sorted(set(str(s['outcome']) for s in samples))
+        results['scenarios'][name] = summary
+        print('{:<8} {:>10} {:>10} {:>10} {:>8}  {}'.format(name, summary['import_ms'], summary['first_ms'],
+                                                          summary['wall_ms'], int(summary['modules']),
+                                                          ','.join(summary['outcome'])))
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+        print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
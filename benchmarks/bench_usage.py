@@ -0,0 +1,91 @@
+"""
+Usage billing math: per-row python with Decimal against the vectorized
+register deltas and integer fixed point pricing in usage.py. The results
+must match to the cent.
+
+    python benchmarks/bench_usage.py [meters] [readings per meter]
+"""
+import os
+import random
+import sys
+import time
+from decimal import ROUND_HALF_UP, Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+from usage import CENT, UNIT_SCALE, price_usage, register_deltas, to_scaled  # noqa: E402
+
+
+def make_readings(meters, per_meter, seed=7):
+    rng = random.Random(seed)
+    meter_ids, seconds, values = [], [], []
+
+    for meter_id in range(1, meters + 1):
+        value = rng.uniform(0, 999000)
+        for i in range(per_meter):
+            value += rng.uniform(0, 400)
+            if value >= 1000000:
+                value -= 1000000
+            meter_ids.append(meter_id)
+            seconds.append(i * 3600.0)
+            values.append(round(value, 1))
+
+    return meter_ids, seconds, values
+
+
+def python_usage(meter_ids, seconds, values, start_seconds):
+    totals = {}
+    for i in range(1, len(values)):
+        if meter_ids[i] != meter_ids[i - 1] or seconds[i] < start_seconds:
+            continue
+
+        previous, current = values[i - 1], values[i]
+        delta = current - previous
+        if delta < 0:
+            modulus = 10.0 ** len(str(int(previous)))
+            delta = modulus - previous + current if previous >= 0.9 * modulus else current
+        totals[meter_ids[i]] = totals.get(meter_ids[i], 0.0) + delta
+    return totals
+
+
+def decimal_charges(units, product_rate, management_rate, tax_rate):
+    product = (units * product_rate).quantize(CENT, ROUND_HALF_UP)
+    management = (units * management_rate).quantize(CENT, ROUND_HALF_UP)
+    tax = ((product + management) * tax_rate).quantize(CENT, ROUND_HALF_UP)
+    return product + management + tax
+
+
+def main(meters=20000, per_meter=50):
+    meter_ids, seconds, values = make_readings(meters, per_meter)
+    start_seconds = per_meter * 3600.0 / 2
+
+    rng = random.Random(3)
+    rates = [(Decimal(rng.randint(100000, 400000)).scaleb(-5), Decimal(rng.randint(0, 20000)).scaleb(-5),
+              Decimal(rng.randint(0, 9000)).scaleb(-5)) for _ in range(meters)]
+
+    started = time.perf_counter()
+    totals = python_usage(meter_ids, seconds, values, start_seconds)
+    python_units = [Decimal(int(round(totals.get(m, 0.0) * UNIT_SCALE))).scaleb(-3) for m in range(1, meters + 1)]
+    expected = [decimal_charges(u, *r) for u, r in zip(python_units, rates)]
+    python_time = time.perf_counter() - started
+
+    arrays = np.asarray(meter_ids), np.asarray(seconds), np.asarray(values)
+    started = time.perf_counter()
+    pair_meters, deltas, _ = register_deltas(arrays[0], arrays[1], arrays[2], start_seconds)
+    pulses = np.bincount(pair_meters - 1, weights=deltas, minlength=meters)
+    milli_units = np.rint(pulses * UNIT_SCALE).astype(np.int64)
+    cents = price_usage(milli_units, to_scaled(r[0] for r in rates), to_scaled(r[1] for r in rates),
+                        to_scaled(r[2] for r in rates))
+    numpy_time = time.perf_counter() - started
+
+    assert [int(e.scaleb(2)) for e in expected] == cents['total'].tolist()
+
+    print('meters: {}, readings: {}'.format(meters, len(values)))
+    print('python + Decimal:      {:.1f}ms'.format(python_time * 1000.0))
+    print('numpy + fixed point:   {:.1f}ms'.format(numpy_time * 1000.0))
+    print('speedup: {:.1f}x'.format(python_time / numpy_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
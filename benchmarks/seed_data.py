@@ -0,0 +1,270 @@
+"""
+Seeded generator of realistic benchmark data: dealers with a login each,
+customers clustered around their dealer, service addresses with routing
+zones and rates, tanks and meters with radios, and reading histories where
+tank levels fall at a per-tank rate until a refill and meter registers
+climb. The same seed and scale always build the same rows.
+
+    python benchmarks/seed_data.py [--dealers 2] [--customers 500] [--days 30] [--db /tmp/owl-bench.db]
+
+The users' password column holds a hash of PASSWORD.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+STATES = [
+    ('Charlotte', 'NC', 35.227, -80.843),
+    ('Columbia', 'SC', 34.000, -81.034),
+    ('Knoxville', 'TN', 35.960, -83.920),
+    ('Roanoke', 'VA', 37.270, -79.941),
+    ('Asheville', 'NC', 35.595, -82.551),
+    ('Macon', 'GA', 32.840, -83.632),
+]
+
+STREETS = ['Oak', 'Pine', 'Maple', 'Cedar', 'Hickory', 'Mill', 'Church', 'Lake', 'Ridge', 'Farm']
+SUFFIXES = ['St', 'Rd', 'Ln', 'Dr', 'Way']
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Linda', 'Michael', 'Susan', 'David', 'Karen', 'William', 'Nancy']
+LAST_NAMES = ['Smith', 'Johnson', 'Brown', 'Jones', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor', 'Clark']
+CAPACITIES = [120, 250, 330, 500, 1000]
+
+# first radio network ids, kept apart from the ones the benchmarks provision
+TANK_RADIO_BASE = 100000000
+METER_RADIO_BASE = 200000000
+
+
+class Scale(object):
+    """
+    Row counts of a seeded database
+    """
+
+    def __init__(self, dealers=2, customers=500, addresses=1.3, tanks=1.2, meters=0.2, days=30, readings_per_day=4,
+                 seed=1):
+        """
+        :param dealers: dealers, each with one user
+        :param customers: customers per dealer
+        :param addresses: mean service addresses per customer
+        :param tanks: mean tanks per service address
+        :param meters: share of service addresses with a meter
+        :param days: days of reading history
+        :param readings_per_day: readings per device and day
+        :param seed: random seed
+        """
+        self.dealers = dealers
+        self.customers = customers
+        self.addresses = addresses
+        self.tanks = tanks
+        self.meters = meters
+        self.days = days
+        self.readings_per_day = readings_per_day
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def _count(rng, mean):
+    # at least one, mean on average
+    whole = int(mean)
+    return max(1, whole + (1 if rng.random() < mean - whole else 0))
+
+
+def _street(rng):
+    return '{} {} {}'.format(rng.randint(10, 9999), rng.choice(STREETS), rng.choice(SUFFIXES))
+
+
+def _name(rng):
+    return '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+class Seeder(object):
+    """
+    Builds rows in memory per table and writes them with executemany
+    """
+
+    def __init__(self, session, scale, now=None, chunk_size=5000):
+        self.session = session
+        self.scale = scale
+        self.rng = random.Random(scale.seed)
+        self.now = (now or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+        self.chunk_size = chunk_size
+        self.counts = {}
+
+    def insert(self, model, rows):
+        table = model.__table__
+        for i in range(0, len(rows), self.chunk_size):
+            self.session.execute(table.insert(), rows[i:i + self.chunk_size])
+        self.counts[table.name] = self.counts.get(table.name, 0) + len(rows)
+
+    def run(self):
+        from werkzeug.security import generate_password_hash
+        from models import Customer, Dealer, DealerAccount, Meter, Reading, ServiceAddress, Tank, User
+
+        rng = self.rng
+        scale = self.scale
+        password = generate_password_hash(PASSWORD)
+
+        users, dealers, accounts, customers, addresses, tanks, meters = [], [], [], [], [], [], []
+        readings = []
+
+        for d in range(1, scale.dealers + 1):
+            city, state, lat, lon = STATES[(d - 1) % len(STATES)]
+            users.append({
+                'id': d, 'username': 'dealer{}'.format(d), 'password': password,
+                'email': 'dealer{}@example.com'.format(d),
+                'first_name': rng.choice(FIRST_NAMES), 'last_name': rng.choice(LAST_NAMES), 'last_login': self.now,
+                'is_superuser': False, 'is_staff': False, 'is_active': True, 'date_joined': self.now,
+            })
+            dealers.append({
+                'id': d, 'dealer_name': '{} Propane {}'.format(city, d), 'address1': _street(rng), 'city': city,
+                'state': state, 'postal_code': '{:05d}'.format(rng.randint(10000, 99999)),
+                'email': 'office{}@example.com'.format(d), 'latitude': lat, 'longitude': lon, 'country': 'US',
+                'timezone': 'America/New_York', 'start_of_billing_cycle': rng.randint(1, 28),
+            })
+            accounts.append({'id': d, 'dealer_id': d, 'user_id': d})
+
+            for _ in range(scale.customers):
+                customer_id = len(customers) + 1
+                # a delivery territory of roughly 50km around the dealer
+                c_lat = lat + rng.gauss(0, 0.25)
+                c_lon = lon + rng.gauss(0, 0.3)
+                customers.append({
+                    'id': customer_id, 'dealer_id': d, 'customer_name': _name(rng),
+                    'customer_number': 'C{}-{:06d}'.format(d, customer_id), 'address1': _street(rng), 'city': city,
+                    'state': state, 'postal_code': '{:05d}'.format(rng.randint(10000, 99999)), 'country': 'US',
+                    'email': 'customer{}@example.com'.format(customer_id),
+                    'phone': '555-{:04d}'.format(rng.randint(0, 9999)), 'latitude': c_lat, 'longitude': c_lon,
+                    'active': rng.random() > 0.05,
+                })
+
+                for _ in range(_count(rng, scale.addresses)):
+                    address_id = len(addresses) + 1
+                    a_lat = c_lat + rng.gauss(0, 0.01)
+                    a_lon = c_lon + rng.gauss(0, 0.01)
+                    addresses.append({
+                        'id': address_id, 'customer_id': customer_id,
+                        'service_address_account_number': 'SA{:07d}'.format(address_id), 'address1': _street(rng),
+                        'city': city, 'state': state, 'postal_code': '{:05d}'.format(rng.randint(10000, 99999)),
+                        'country': 'US', 'latitude': a_lat, 'longitude': a_lon,
+                        'routing_zone': 'Z{}{}'.format(int(a_lat * 10) % 10, int(-a_lon * 10) % 10),
+                        'product_rate': round(rng.uniform(1.8, 3.2), 5), 'tax_rate': rng.choice([0.0, 0.04, 0.07]),
+                        'management_rate': round(rng.uniform(0, 0.15), 5), 'current_balance': 0.0,
+                        'short_code': 'S{:07d}'.format(address_id), 'coordinates_locked': False,
+                    })
+
+                    for _ in range(_count(rng, scale.tanks)):
+                        tanks.append(self.tank(len(tanks) + 1, address_id, readings))
+
+                    if rng.random() < scale.meters:
+                        meters.append(self.meter(len(meters) + 1, address_id, readings))
+
+        started = time.perf_counter()
+        self.insert(User, users)
+        self.insert(Dealer, dealers)
+        self.insert(DealerAccount, accounts)
+        self.insert(Customer, customers)
+        self.insert(ServiceAddress, addresses)
+        self.insert(Tank, tanks)
+        self.insert(Meter, meters)
+        self.insert(Reading, readings)
+        self.session.commit()
+        self.counts['seconds'] = round(time.perf_counter() - started, 3)
+        return self.counts
+
+    def history(self):
+        # receiver_time of every reading slot, oldest first
+        step = timedelta(hours=24.0 / self.scale.readings_per_day)
+        total = self.scale.days * self.scale.readings_per_day
+        return [self.now - step * (total - i) for i in range(total)]
+
+    def tank(self, tank_id, address_id, readings):
+        rng = self.rng
+        network_id = str(TANK_RADIO_BASE + tank_id)
+        # percent full burnt per day, higher in a cold snap
+        rate = rng.uniform(0.3, 2.5)
+        level = rng.uniform(30, 95)
+        value = None
+        receiver_time = None
+
+        for receiver_time in self.history():
+            level -= rate / self.scale.readings_per_day * rng.uniform(0.6, 1.4)
+            if level < rng.uniform(8, 25):
+                # delivered: topped up to 80%
+                level = rng.uniform(75, 82)
+            value = round(max(level, 0.0), 1)
+            readings.append({'receiver_time': receiver_time, 'device_type': 'tank', 'device_id': tank_id,
+                             'network_id': network_id, 'sensor_value': value})
+
+        install = self.now - timedelta(days=rng.randint(200, 4000))
+        return {
+            'id': tank_id, 'service_address_id': address_id, 'capacity': rng.choice(CAPACITIES),
+            'usage_billing': rng.random() < 0.2, 'tank_type': rng.choice(['above ground', 'underground']),
+            'tank_manufacturer': rng.choice(['Trinity', 'Worthington', 'American Welding']),
+            'serial_number': 'T{:08d}'.format(tank_id), 'install_date': install,
+            'last_inspection_date': install + timedelta(days=180), 'network_id': network_id,
+            'receiver_time': receiver_time, 'sensor_value': value,
+            'days_to_empty': int(value / rate) if value is not None else None,
+        }
+
+    def meter(self, meter_id, address_id, readings):
+        rng = self.rng
+        network_id = str(METER_RADIO_BASE + meter_id)
+        register = rng.uniform(100, 50000)
+        receiver_time = None
+
+        for receiver_time in self.history():
+            register += rng.uniform(0, 3.0)
+            readings.append({'receiver_time': receiver_time, 'device_type': 'meter', 'device_id': meter_id,
+                             'network_id': network_id, 'sensor_value': round(register, 2)})
+
+        return {
+            'id': meter_id, 'service_address_id': address_id, 'meter_current_read': '{:.2f}'.format(register),
+            'meter_model': rng.choice(['R-275', 'AL-425']), 'meter_multiplier': 1,
+            'meter_pulse_per_rev': rng.choice([1, 10]), 'meter_serial_number': 'M{:08d}'.format(meter_id),
+            'network_id': network_id, 'receiver_time': receiver_time,
+            'sensor_value': round(register, 2) if receiver_time else None,
+        }
+
+
+def add_arguments(parser):
+    defaults = Scale()
+    parser.add_argument('--db', default=standin.DEFAULT_DATABASE, help='SQLite database file')
+    parser.add_argument('--dealers', type=int, default=defaults.dealers)
+    parser.add_argument('--customers', type=int, default=defaults.customers, help='customers per dealer')
+    parser.add_argument('--addresses', type=float, default=defaults.addresses, help='service addresses per customer')
+    parser.add_argument('--tanks', type=float, default=defaults.tanks, help='tanks per service address')
+    parser.add_argument('--meters', type=float, default=defaults.meters, help='share of addresses with a meter')
+    parser.add_argument('--days', type=int, default=defaults.days, help='days of reading history')
+    parser.add_argument('--readings-per-day', type=int, default=defaults.readings_per_day)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def scale_from(args):
+    return Scale(args.dealers, args.customers, args.addresses, args.tanks, args.meters, args.days,
+                 args.readings_per_day, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    standin.boot(args.db, fresh=True, views=False)
+    from extensions import db
+
+    counts = Seeder(db.session, scale_from(args)).run()
+    for name, count in sorted(counts.items()):
+        print('{}: {}'.format(name, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+A local SMTP server that accepts and keeps every message, for exercising the
+mail pipeline without a real relay. Point MAIL_SERVER / MAIL_PORT at it with
+MAIL_USE_TLS off.
+
+    python benchmarks/smtp_sink.py [port] [connect latency ms] [message latency ms]
+"""
+import socketserver
+import sys
+import threading
+import time
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        sink = self.server.sink
+        with sink.lock:
+            sink.connections += 1
+
+        # stands in for TCP + STARTTLS + AUTH round trips of a real relay
+        time.sleep(sink.connect_latency)
+        self.reply('220 sink ready')
+
+        envelope = {'from': None, 'to': []}
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif verb == 'MAIL':
+                envelope = {'from': command[10:], 'to': []}
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                envelope['to'].append(command[8:])
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 end with <CRLF>.<CRLF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line)
+
+                time.sleep(sink.message_latency)
+                with sink.lock:
+                    sink.received += 1
+                    failing = sink.fail_every and sink.received % sink.fail_every == 0
+                    if not failing:
+                        sink.messages.append(dict(envelope, data=b''.join(data)))
+
+                self.reply('451 try again later' if failing else '250 queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink(object):
+    """
+    :param port: 0 picks a free port
+    :param connect_latency: seconds before the greeting of each connection
+    :param message_latency: seconds to accept each message
+    :param fail_every: answer every n-th message with a 451, 0 never
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, connect_latency=0.0, message_latency=0.0, fail_every=0):
+        self.connect_latency = connect_latency
+        self.message_latency = message_latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = 0
+        self.messages = []
+        self.server = ThreadedServer((host, port), SinkHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    connect_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    message_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+    sink = SMTPSink(port=port, connect_latency=connect_ms / 1000.0, message_latency=message_ms / 1000.0)
+    print('smtp sink on {}:{}'.format(sink.host, sink.port))
+    sink.start()
+
+    try:
+        while True:
+            time.sleep(5)
+            print('{} connections, {} messages'.format(sink.connections, len(sink.messages)))
+    except KeyboardInterrupt:
+        sink.stop()
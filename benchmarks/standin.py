@@ -0,0 +1,75 @@
+"""
+Boot the app without MySQL or Redis: the database is a SQLite file and
+every redis client is an in-process fakeredis, so the benchmarks run on a
+laptop or a CI box. Celery tasks run eagerly in the calling thread and
+mail is suppressed.
+
+    import standin
+    app = standin.boot()  # with an app context pushed
+
+Needs fakeredis (pip install -r requirements-dev.txt).
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATABASE = os.path.join(tempfile.gettempdir(), 'owl-bench.db')
+
+
+_app = None
+
+
+def environ(path=DEFAULT_DATABASE):
+    """
+    Point config at the SQLite file and every redis client at fakeredis,
+    without importing the app
+    :param path: SQLite database file
+    """
+    # config reads these at import
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.abspath(path))
+    os.environ['CELERY_TASK_ALWAYS_EAGER'] = '1'
+    os.environ.setdefault('CELERY_BROKER_URL', 'memory://')
+    os.environ.setdefault('CELERY_RESULT_BACKEND', 'cache+memory://')
+
+    import fakeredis
+    import redis
+
+    # one shared fake server, every client sees the same keys; older
+    # fakeredis releases share a module level store instead
+    if hasattr(fakeredis, 'FakeServer'):
+        server = fakeredis.FakeServer()
+        redis.from_url = lambda *args, **kwargs: fakeredis.FakeStrictRedis(server=server)
+    else:
+        redis.from_url = lambda *args, **kwargs: fakeredis.FakeStrictRedis()
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def boot(path=DEFAULT_DATABASE, fresh=False, views=True):
+    """
+    Build the app bound to the stand-ins, push an app context for the
+    calling script and create the schema
+    :param path: SQLite database file
+    :param fresh: delete the file first
+    :param views: passed to create_app()
+    :return: Flask app
+    """
+    global _app
+    if _app is not None:
+        return _app
+
+    if fresh and os.path.exists(path):
+        os.remove(path)
+
+    environ(path)
+    from app import create_app
+    from extensions import db
+
+    _app = create_app(views=views)
+    _app.app_context().push()
+    db.create_all()
+    _app.config['MAIL_SUPPRESS_SEND'] = True
+    _app.extensions['mail'].suppress = True
+    return _app
@@ -0,0 +1,332 @@
+import bisect
+import calendar
+import logging
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+from decimal import Decimal
+import redis
+from sqlalchemy import bindparam, exc, func
+from models import BillingShard, Customer, Dealer, ServiceAddress
+from usage import CENT, meter_usage
+import config
+
+log = logging.getLogger(__name__)
+
+
+def cycle_day(day, start_of_billing_cycle):
+    """
+    The day of day's month a cycle starts, clamped to the month length so
+    a cycle starting on the 31st runs on the last day of shorter months
+    :param day: date
+    :param start_of_billing_cycle: Dealer.start_of_billing_cycle
+    :return: date
+    """
+    last = calendar.monthrange(day.year, day.month)[1]
+    return day.replace(day=max(1, min(start_of_billing_cycle, last)))
+
+
+def billing_period(day, start_of_billing_cycle):
+    """
+    The cycle ending on day: from the previous month's cycle day up to day
+    :param day: date a cycle starts on
+    :param start_of_billing_cycle:
+    :return: (period_start, period_end) dates
+    """
+    previous_month = day.replace(day=1) - timedelta(days=1)
+    return cycle_day(previous_month, start_of_billing_cycle), day
+
+
+def is_cycle_day(day, start_of_billing_cycle):
+    """
+    :param day: date
+    :param start_of_billing_cycle: Dealer.start_of_billing_cycle
+    :return: True when a cycle of the dealer starts on day, as dealers_due() decides
+    """
+    return start_of_billing_cycle is not None and cycle_day(day, start_of_billing_cycle) == day
+
+
+def overlapping_run(session, dealer_id, period_start, period_end):
+    """
+    A checkpointed run of the dealer whose period overlaps this one without
+    being the same period. Resuming the same period is fine, billing an
+    overlapping one charges the shared days twice.
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param period_start: date
+    :param period_end: date
+    :return: (period_start, period_end) of the other run or None
+    """
+    return session.query(BillingShard.period_start, BillingShard.period_end).filter(
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_start < period_end,
+        BillingShard.period_end > period_start,
+        ~((BillingShard.period_start == period_start) & (BillingShard.period_end == period_end))
+    ).order_by(BillingShard.period_end).first()
+
+
+def dealers_due(session, day):
+    """
+    Dealers whose billing cycle starts on day
+    :param session: sqlalchemy session
+    :param day: date
+    :return: list of dealer ids
+    """
+    last = calendar.monthrange(day.year, day.month)[1]
+    query = session.query(Dealer.id)
+
+    if day.day == last:
+        query = query.filter(Dealer.start_of_billing_cycle >= day.day)
+    else:
+        query = query.filter(Dealer.start_of_billing_cycle == day.day)
+
+    return [row.id for row in query.order_by(Dealer.id)]
+
+
+def plan_shards(session, dealer_id, period_start, period_end, shard_size=config.BILLING_SHARD_SIZE):
+    """
+    Split a dealer's service addresses into contiguous id ranges and record
+    them as pending shards before any of them runs. A resumed run gets the
+    recorded ranges and shard numbers back, so a shard task still retrying
+    from an earlier attempt and its resumed twin share one row, and only one
+    of them charges. Addresses no recorded range covers become new shards,
+    numbered after the recorded ones and never spanning one of them.
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param period_start: date the run starts on
+    :param period_end: date the run ends on
+    :param shard_size: addresses per shard
+    :return: list of (shard, first_id, last_id, count)
+    """
+    planned = [tuple(row) for row in session.query(
+        BillingShard.shard,
+        BillingShard.first_service_address_id,
+        BillingShard.last_service_address_id,
+        BillingShard.service_addresses
+    ).filter(
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_end == period_end
+    ).order_by(BillingShard.first_service_address_id)]
+
+    firsts = [first_id for _, first_id, _, _ in planned]
+
+    def gap(address_id):
+        # index of the recorded range after address_id; -1 when a range covers it
+        i = bisect.bisect_right(firsts, address_id)
+        return -1 if i and address_id <= planned[i - 1][2] else i
+
+    ids = [row.id for row in session.query(ServiceAddress.id).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id
+    ).order_by(ServiceAddress.id)]
+
+    shard = max([number for number, _, _, _ in planned] or [-1]) + 1
+    added = []
+
+    for position, group in groupby(ids, gap):
+        if position < 0:
+            continue
+        group = list(group)
+        for i in range(0, len(group), shard_size):
+            chunk = group[i:i + shard_size]
+            added.append((shard, chunk[0], chunk[-1], len(chunk)))
+            shard += 1
+
+    if added:
+        session.add_all([BillingShard(
+            dealer_id=dealer_id,
+            period_start=period_start,
+            period_end=period_end,
+            shard=number,
+            first_service_address_id=first_id,
+            last_service_address_id=last_id,
+            service_addresses=count
+        ) for number, first_id, last_id, count in added])
+
+        try:
+            session.commit()
+        except exc.IntegrityError:
+            session.rollback()
+            # another attempt recorded its plan first, run that one
+            if session.query(BillingShard.id).filter(
+                BillingShard.dealer_id == dealer_id,
+                BillingShard.period_end == period_end
+            ).count() > len(planned):
+                return plan_shards(session, dealer_id, period_start, period_end, shard_size)
+            raise
+
+    return sorted(planned + added)
+
+
+def run_key(dealer_id, period_end):
+    return 'owl:billing:{}:{}'.format(dealer_id, period_end.isoformat())
+
+
+def start_progress(redis_client, dealer_id, period_start, period_end, shards, done):
+    """
+    Progress hash of a run, polled by GET /billing/run
+    :param redis_client: redis connection
+    :param shards: number of shards in the run
+    :param done: shards already applied by an earlier attempt
+    """
+    key = run_key(dealer_id, period_end)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hmset(key, {
+            'dealer_id': dealer_id,
+            'period_start': period_start.isoformat(),
+            'period_end': period_end.isoformat(),
+            'shards': shards,
+            'done': done,
+            'started_at': datetime.utcnow().isoformat(),
+        })
+        pipe.hdel(key, 'finished_at')
+        pipe.expire(key, config.BILLING_PROGRESS_TTL)
+        pipe.execute()
+    except redis.RedisError as err:
+        log.warning('billing progress write failed: %s', err)
+
+
+def bill_shard(session, redis_client, dealer_id, period_start, period_end, shard, first_id, last_id, count):
+    """
+    Price one shard and add the charges to ServiceAddress.current_balance with
+    a single executemany UPDATE. The charges commit with the shard row going
+    from pending to completed, and only when this call made that change, so
+    retries and a resumed run's twin of the shard charge once.
+    :param session: sqlalchemy session
+    :param redis_client: redis connection for progress
+    :param dealer_id:
+    :param period_start: date
+    :param period_end: date
+    :param shard: shard number
+    :param first_id: first service address id of the shard
+    :param last_id: last service address id of the shard
+    :param count: addresses in the shard
+    :return: dict summary
+    """
+    started = time.perf_counter()
+
+    this_shard = (
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_end == period_end,
+        BillingShard.shard == shard
+    )
+
+    done = session.query(BillingShard.total).filter(
+        BillingShard.completed_at != None,  # noqa: E711
+        *this_shard
+    ).scalar()
+
+    if done is not None:
+        return {'shard': shard, 'skipped': True, 'total': str(done)}
+
+    usage = meter_usage(
+        session, dealer_id,
+        datetime.combine(period_start, datetime.min.time()),
+        datetime.combine(period_end, datetime.min.time()),
+        (first_id, last_id)
+    )
+    totals = usage['cents']['total']
+
+    params = [
+        {'b_id': int(address_id), 'b_amount': float(cents) / 100.0}
+        for address_id, cents in zip(usage['address_ids'], totals) if cents
+    ]
+
+    table = ServiceAddress.__table__
+    total = (Decimal(int(totals.sum())) * CENT).quantize(CENT)
+
+    # claim the pending row first; on MySQL a concurrent twin waits on its lock and then finds it completed
+    claimed = session.query(BillingShard).filter(*this_shard).filter(
+        BillingShard.completed_at == None  # noqa: E711
+    ).update({'total': total, 'completed_at': datetime.utcnow()}, synchronize_session=False)
+
+    if not claimed:
+        session.rollback()
+        return {'shard': shard, 'skipped': True}
+
+    if params:
+        session.execute(
+            table.update().where(table.c.id == bindparam('b_id')).values(
+                current_balance=func.coalesce(table.c.current_balance, 0) + bindparam('b_amount')
+            ),
+            params
+        )
+    session.commit()
+
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hincrby(run_key(dealer_id, period_end), 'done', 1)
+        pipe.hincrby(run_key(dealer_id, period_end), 'charged', len(params))
+        pipe.execute()
+    except redis.RedisError as err:
+        log.warning('billing progress write failed: %s', err)
+
+    return {
+        'shard': shard,
+        'charged': len(params),
+        'total': str(total),
+        'ms': round((time.perf_counter() - started) * 1000.0, 3),
+    }
+
+
+def finish_run(session, redis_client, dealer_id, period_end):
+    """
+    Summarise a run from its checkpoints and stamp the progress hash
+    :return: dict summary
+    """
+    shards, total = session.query(func.count(BillingShard.id), func.sum(BillingShard.total)).filter(
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_end == period_end,
+        BillingShard.completed_at != None  # noqa: E711
+    ).one()
+
+    try:
+        redis_client.hset(run_key(dealer_id, period_end), 'finished_at', datetime.utcnow().isoformat())
+    except redis.RedisError as err:
+        log.warning('billing progress write failed: %s', err)
+
+    log.info('billing run for dealer %s ending %s: %d shards, total %s', dealer_id, period_end, shards, total)
+    return {'dealer_id': dealer_id, 'period_end': period_end.isoformat(), 'shards': shards, 'total': str(total or 0)}
+
+
+def run_progress(session, redis_client, dealer_id, period_end):
+    """
+    Progress of a run: the redis hash while it is live, the completed shards always
+    :return: dict
+    """
+    try:
+        progress = dict((k.decode('utf-8'), v.decode('utf-8'))
+                        for k, v in redis_client.hgetall(run_key(dealer_id, period_end)).items())
+    except redis.RedisError:
+        progress = {}
+
+    checkpoints = session.query(BillingShard).filter(
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_end == period_end,
+        BillingShard.completed_at != None  # noqa: E711
+    ).order_by(BillingShard.shard).all()
+
+    progress.update({
+        'period_end': period_end.isoformat(),
+        'checkpoints': [{
+            'shard': c.shard,
+            'first_service_address_id': c.first_service_address_id,
+            'last_service_address_id': c.last_service_address_id,
+            'service_addresses': c.service_addresses,
+            'total': str(c.total),
+            'completed_at': c.completed_at.isoformat(),
+        } for c in checkpoints],
+    })
+    return progress
+
+
+def parse_day(value):
+    """
+    :param value: ISO date string or None
+    :return: date, today (UTC) when missing
+    """
+    if not value:
+        return datetime.utcnow().date()
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
@@ -0,0 +1,205 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+import redis
+from flask import make_response, request, Response
+import config
+
+
+class TTLCache(object):
+    """
+    Bounded in-process cache with per-entry expiry.
+    Least recently used entries are evicted once maxsize is reached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the cached value or default when missing or expired
+        :param key:
+        :param default:
+        :return: value
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting the oldest entries past maxsize
+        :param key:
+        :param value:
+        :param ttl: override the default ttl in seconds
+        :return: None
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache(object):
+    """
+    Redis-backed cache for dealer-scoped GET responses.
+    Keys embed a per-dealer generation counter, so bumping the counter on
+    any write invalidates exactly that dealer's entries; stale generations
+    simply age out through their TTL.
+    """
+
+    def __init__(self, prefix='owl:resp', ttl=60, max_ttl=300, max_bytes=1024 * 1024):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.max_bytes = max_bytes
+        self.redis = None
+        self.get_dealer_id = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.oversized = 0
+        self.errors = 0
+
+    def init_app(self, redis_client, get_dealer_id):
+        """
+        :param redis_client: redis connection
+        :param get_dealer_id: callable returning the dealer id of the current request
+        """
+        self.redis = redis_client
+        self.get_dealer_id = get_dealer_id
+
+    def generation_key(self, dealer_id):
+        return '{}:gen:{}'.format(self.prefix, dealer_id)
+
+    def entry_key(self, dealer_id, generation):
+        query = '&'.join(sorted('{}={}'.format(k, v) for k, v in request.args.items(multi=True)))
+        digest = hashlib.sha1('{}?{}'.format(request.path, query).encode('utf-8')).hexdigest()
+        return '{}:{}:{}:{}'.format(self.prefix, dealer_id, generation, digest)
+
+    def invalidate(self, dealer_id):
+        """
+        Drop every cached response of a dealer
+        :param dealer_id:
+        """
+        try:
+            self.redis.incr(self.generation_key(dealer_id))
+        except redis.RedisError:
+            self.errors += 1
+
+    def cached(self, ttl=None):
+        """
+        Cache a dealer-scoped GET view; place it below @login_required
+        :param ttl: seconds, capped at max_ttl
+        :return: decorator
+        """
+        ttl = min(ttl or self.ttl, self.max_ttl)
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method != 'GET' or self.redis is None:
+                    return view(*args, **kwargs)
+
+                dealer_id = self.get_dealer_id()
+
+                try:
+                    generation = int(self.redis.get(self.generation_key(dealer_id)) or 0)
+                    key = self.entry_key(dealer_id, generation)
+                    entry = self.redis.get(key)
+                except redis.RedisError:
+                    self.errors += 1
+                    return view(*args, **kwargs)
+
+                if entry is not None:
+                    self.hits += 1
+                    return self._hit(entry)
+
+                self.misses += 1
+                resp = make_response(view(*args, **kwargs))
+                self._store(key, resp, ttl)
+                return resp
+
+            return wrapper
+
+        return decorator
+
+    def _hit(self, entry):
+        etag, mimetype, body = entry.split(b'\n', 2)
+        etag = etag.decode('ascii')
+
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(body, mimetype=mimetype.decode('ascii'))
+
+        resp.set_etag(etag)
+        resp.headers['X-Cache'] = 'HIT'
+        return resp
+
+    def _store(self, key, resp, ttl):
+        if resp.status_code != 200 or resp.is_streamed:
+            return
+
+        body = resp.get_data()
+        if len(body) > self.max_bytes:
+            self.oversized += 1
+            return
+
+        etag = resp.get_etag()[0]
+        if etag is None:
+            etag = hashlib.sha1(body).hexdigest()
+            resp.set_etag(etag)
+
+        try:
+            self.redis.set(key, b'\n'.join((etag.encode('ascii'), resp.mimetype.encode('ascii'), body)), ex=ttl)
+            self.stores += 1
+        except redis.RedisError:
+            self.errors += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'oversized': self.oversized,
+            'errors': self.errors,
+            'hit_rate': round(self.hits / float(lookups), 4) if lookups else None,
+        }
+
+
+response_cache = ResponseCache(
+    ttl=config.RESPONSE_CACHE_TTL,
+    max_ttl=config.RESPONSE_CACHE_MAX_TTL,
+    max_bytes=config.RESPONSE_CACHE_MAX_BYTES
+)
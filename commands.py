@@ -0,0 +1,35 @@
+import json
+import click
+from flask.cli import with_appcontext
+from cache import response_cache
+from extensions import db
+from geo import invalidate_index as invalidate_geo_index
+from importer import KINDS as IMPORT_KINDS, READERS as IMPORT_READERS, detect_format, import_rows
+import config
+
+# flask CLI commands, added to the app by app.create_app()
+
+
+@click.command('import')
+@with_appcontext
+@click.argument('kind', type=click.Choice(sorted(IMPORT_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dealer', 'dealer_id', type=int, required=True, help='dealer the rows belong to')
+@click.option('--format', 'fmt', type=click.Choice(sorted(IMPORT_READERS)), help='defaults to the file extension')
+@click.option('--chunk-size', type=int, default=config.IMPORT_CHUNK_SIZE, help='rows per insert and commit')
+def import_command(kind, path, dealer_id, fmt, chunk_size):
+    """Import customers or service-addresses from a JSON, NDJSON or CSV file."""
+    fmt = fmt or detect_format(filename=path)
+    if fmt is None:
+        raise click.UsageError('Can not tell the format of {}, pass --format'.format(path))
+
+    with open(path, 'rb') as stream:
+        summary = import_rows(db.session, kind, dealer_id, IMPORT_READERS[fmt](stream), chunk_size)
+
+    if summary.inserted:
+        response_cache.invalidate(dealer_id)
+        invalidate_geo_index(dealer_id)
+
+    click.echo(json.dumps(summary.to_dict(), indent=2))
+    if summary.fatal or summary.failed:
+        raise SystemExit(1)
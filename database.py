@@ -0,0 +1,131 @@
+import threading
+import time
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+import config
+
+# checkout wait histogram bucket upper bounds, in milliseconds
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PoolMetrics(object):
+    """
+    Process-wide connection pool counters.
+    Checkout wait is the time a request spends in the pool before it gets
+    a connection, including opening a new one when the pool is not full.
+    """
+
+    def __init__(self, buckets=WAIT_BUCKETS_MS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.wait_counts = [0] * (len(self.buckets) + 1)
+
+    def count(self, name):
+        # += on an attribute is not atomic across threads
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds):
+        ms = seconds * 1000.0
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                index = i
+                break
+
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += ms
+            self.wait_max = max(self.wait_max, ms)
+            self.wait_counts[index] += 1
+
+    def stats(self, pool=None):
+        """
+        Counters plus the live state of the pool
+        :param pool: engine.pool, for connections in use and overflow
+        :return: dict
+        """
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.timeouts,
+                'checkout_wait_ms_avg': round(self.wait_total / self.checkouts, 3) if self.checkouts else None,
+                'checkout_wait_ms_max': round(self.wait_max, 3),
+                'checkout_wait_ms_buckets': dict(
+                    ('le_{}'.format(bound), count) for bound, count in zip(self.buckets + ('inf',), self.wait_counts)
+                ),
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+            }
+
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'pool_size': pool.size(),
+                'in_use': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+            })
+
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that reports how long each checkout waited
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            pool_metrics.count('timeouts')
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started)
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    pool_metrics.count('connects')
+
+
+@event.listens_for(TimedQueuePool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    # stale connections found by pre-ping and disconnects seen mid-query
+    pool_metrics.count('invalidations')
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with explicit, instrumented pool settings for MySQL.
+    Other backends (sqlite in development) keep the library defaults.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+        if info.drivername.startswith('mysql'):
+            options.update({
+                'poolclass': TimedQueuePool,
+                'pool_size': config.DB_POOL_SIZE,
+                'max_overflow': config.DB_MAX_OVERFLOW,
+                'pool_recycle': config.DB_POOL_RECYCLE,
+                'pool_timeout': config.DB_POOL_TIMEOUT,
+                'pool_pre_ping': config.DB_POOL_PRE_PING,
+            })
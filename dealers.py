@@ -0,0 +1,55 @@
+from collections import namedtuple
+from flask import g
+from sqlalchemy import event, inspect
+from cache import TTLCache
+from models import DealerAccount
+import config
+
+
+DealerContext = namedtuple('DealerContext', ['user_id', 'dealer_account_id', 'dealer_id'])
+
+# user id -> DealerContext, shared by every request in this worker
+dealer_cache = TTLCache(maxsize=config.DEALER_CACHE_MAXSIZE, ttl=config.DEALER_CACHE_TTL)
+
+
+def resolve_dealer(session, user_id):
+    """
+    Resolve user -> dealer account -> dealer once per request.
+    The result is kept on flask.g for the rest of the request and
+    in the shared TTL cache for subsequent requests.
+    :param session: sqlalchemy session
+    :param user_id: auth_user pk
+    :return: DealerContext or None
+    """
+    ctx = getattr(g, 'dealer_context', None)
+    if ctx is not None and ctx.user_id == user_id:
+        return ctx
+
+    ctx = dealer_cache.get(user_id)
+
+    if ctx is None:
+        account = session.query(DealerAccount.id, DealerAccount.dealer_id).filter(
+            DealerAccount.user_id == user_id
+        ).first()
+
+        if account is None:
+            return None
+
+        ctx = DealerContext(user_id, account.id, account.dealer_id)
+        dealer_cache.set(user_id, ctx)
+
+    g.dealer_context = ctx
+    return ctx
+
+
+@event.listens_for(DealerAccount, 'after_insert')
+@event.listens_for(DealerAccount, 'after_update')
+@event.listens_for(DealerAccount, 'after_delete')
+def invalidate_dealer_account(mapper, connection, target):
+    """
+    Drop cached contexts for every user touched by a DealerAccount change,
+    including the previous user when user_id itself was reassigned
+    """
+    history = inspect(target).attrs.user_id.history
+    for user_id in set(history.deleted or ()) | {target.user_id}:
+        dealer_cache.pop(user_id)
@@ -0,0 +1,69 @@
+import hashlib
+from flask import request, Response
+
+
+def version_token(values):
+    """
+    Version token for a resource from the values of its serialized fields
+    :param values: iterable of field values
+    :return: hex digest
+    """
+    return hashlib.sha1(repr(tuple(values)).encode('utf-8')).hexdigest()
+
+
+def row_etag(obj, fields):
+    """
+    ETag for one row, computed from the attributes the schema exposes
+    without running the serializer
+    :param obj: ORM instance or row tuple
+    :param fields: schema field names
+    :return: etag
+    """
+    return version_token(getattr(obj, field) for field in fields)
+
+
+def collection_etag(rows, fields, *extra):
+    """
+    ETag for a list response: the ordered row versions plus anything else
+    that shapes the document, e.g. the next page cursor
+    :param rows: ORM instances or row tuples
+    :param fields: schema field names
+    :param extra: additional values folded into the token
+    :return: etag
+    """
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(row_etag(row, fields).encode('ascii'))
+    digest.update(repr(extra).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def is_not_modified(etag):
+    """
+    Evaluate If-None-Match. There is no Last-Modified: no table keeps a row
+    modification time, and receiver_time only moves with new readings, so
+    If-Modified-Since would answer 304 after other fields changed.
+    :param etag:
+    :return: bool
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    return False
+
+
+def conditional_response(etag, build):
+    """
+    Answer 304 without building the body when the client copy is current,
+    otherwise build the response and stamp it with the ETag
+    :param etag:
+    :param build: callable returning the full response
+    :return: response
+    """
+    if is_not_modified(etag):
+        resp = Response(status=304)
+    else:
+        resp = build()
+
+    resp.set_etag(etag)
+    return resp
@@ -0,0 +1,102 @@
+import threading
+import redis
+from celery import Celery, Task
+from flask import has_app_context
+from flask_login import LoginManager
+from flask_mail import Mail
+from flask_marshmallow import Marshmallow
+from flask_session import Session
+from database import PooledSQLAlchemy
+import config
+
+# Extensions are created unbound here and bound by app.create_app(), so models,
+# tasks and scripts can import them without building the web app.
+
+# the one engine shared by the views, models and celery tasks
+db = PooledSQLAlchemy()
+
+login_manager = LoginManager()
+login_manager.login_view = config.API_URL_PREFIX + '/auth/login'
+login_manager.login_message = 'Login required to access this API.'
+login_manager.login_message_category = 'primary'
+
+mail = Mail()
+ma = Marshmallow()
+sess = Session()
+
+
+class RedisClient(object):
+    """
+    The shared redis connection, made on first use, so importing a module
+    that talks to redis neither connects nor reads the url at import
+    """
+
+    def __init__(self):
+        self.url = config.REDIS_URL
+        self._client = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.url = app.config.get('REDIS_URL', self.url)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = redis.from_url(self.url)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+redis_client = RedisClient()
+
+
+class ContextTask(Task):
+    """
+    Runs every task inside an app context. A worker builds its app on the
+    first task, without the API views; tasks run eagerly from a request
+    reuse the request's context.
+    """
+    abstract = True
+
+    def __call__(self, *args, **kwargs):
+        if has_app_context():
+            return Task.__call__(self, *args, **kwargs)
+
+        with flask_app().app_context():
+            return Task.__call__(self, *args, **kwargs)
+
+
+# new-style setting names only: celery refuses a mix of old and new names
+celery = Celery('owl', broker=config.CELERY_BROKER_URL, backend=config.CELERY_RESULT_BACKEND, task_cls=ContextTask)
+celery.conf.update(
+    accept_content=config.CELERY_ACCEPT_CONTENT,
+    task_serializer='json',
+    result_serializer='json',
+    task_always_eager=config.CELERY_TASK_ALWAYS_EAGER
+)
+
+_app = None
+
+
+def init_celery(app):
+    """
+    Make app the one celery tasks run in
+    :param app: flask app
+    """
+    global _app
+    _app = app
+
+
+def flask_app():
+    """
+    The app tasks run in, built without views when this process has none
+    :return: flask app
+    """
+    if _app is None:
+        from app import create_app
+        create_app(views=False)
+    return _app
@@ -0,0 +1,208 @@
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import BigInteger, and_, bindparam
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from models import Customer, Reading, ServiceAddress, Tank
+from readings import TANK
+import config
+
+EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400.0
+
+
+class epoch_microseconds(FunctionElement):
+    """
+    Microseconds from 1970-01-01 to a naive UTC DATETIME column as an exact
+    integer computed by the database, so no datetime object is built per row
+    """
+    type = BigInteger()
+    name = 'epoch_microseconds'
+
+
+@compiles(epoch_microseconds)
+def compile_epoch_microseconds(element, compiler, **kw):
+    # MySQL; unlike UNIX_TIMESTAMP() independent of the session time zone
+    return "TIMESTAMPDIFF(MICROSECOND, '1970-01-01 00:00:00', {})".format(compiler.process(element.clauses, **kw))
+
+
+@compiles(epoch_microseconds, 'sqlite')
+def compile_epoch_microseconds_sqlite(element, compiler, **kw):
+    # stored as 'YYYY-MM-DD HH:MM:SS.ffffff'; strftime would round the fraction, so it only gets the seconds
+    column = compiler.process(element.clauses, **kw)
+    return "(CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 + " \
+        "CAST(substr({0}, 21, 6) AS INTEGER))".format(column)
+
+
+def reading_arrays(session, query):
+    """
+    Run a query of (device_id, epoch_microseconds(receiver_time), sensor_value)
+    and collect it into arrays one fetched chunk at a time
+    :param session: sqlalchemy session
+    :param query: sqlalchemy query
+    :return: (device_ids, seconds, values) numpy arrays
+    """
+    result = session.execute(query.statement.execution_options(stream_results=True))
+    device_ids, microseconds, values = [], [], []
+
+    try:
+        while True:
+            rows = result.fetchmany(config.STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            ids, times, readings = zip(*rows)
+            device_ids.append(np.array(ids, dtype=np.int64))
+            microseconds.append(np.array(times, dtype=np.int64))
+            values.append(np.array(readings, dtype=np.float64))
+    finally:
+        result.close()
+
+    if not device_ids:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+
+    # the same float as timedelta.total_seconds()
+    return np.concatenate(device_ids), np.concatenate(microseconds) / 1e6, np.concatenate(values)
+
+
+def load_dealer_readings(session, dealer_id, since):
+    """
+    Load every tank reading of a dealer since a point in time into arrays,
+    ordered by tank and time
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param since: datetime, start of the sliding window
+    :return: (tank_ids, seconds, values) numpy arrays
+    """
+    query = session.query(Reading.device_id, epoch_microseconds(Reading.receiver_time), Reading.sensor_value).join(
+        Tank, and_(Reading.device_type == TANK, Reading.device_id == Tank.id)
+    ).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        Reading.receiver_time >= since,
+        Reading.sensor_value != None  # noqa: E711
+    ).order_by(
+        Reading.device_id, Reading.receiver_time
+    )
+
+    return reading_arrays(session, query)
+
+
+def grouped_median(groups, values, ngroups):
+    """
+    Median of values per group without a python loop
+    :param groups: int array of group indexes in [0, ngroups)
+    :param values: float array
+    :param ngroups:
+    :return: float array of medians, NaN for empty groups
+    """
+    order = np.lexsort((values, groups))
+    ordered = values[order]
+    counts = np.bincount(groups, minlength=ngroups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    medians = np.full(ngroups, np.nan)
+    present = counts > 0
+    lo = starts[present] + (counts[present] - 1) // 2
+    hi = starts[present] + counts[present] // 2
+    medians[present] = (ordered[lo] + ordered[hi]) / 2.0
+    return medians
+
+
+def fit_consumption(tank_ids, seconds, values, refill_jump=config.FORECAST_REFILL_JUMP,
+                    min_points=config.FORECAST_MIN_POINTS):
+    """
+    Fit a robust consumption rate for every tank at once.
+    Readings must be ordered by tank and time. A rise of more than
+    refill_jump between consecutive readings marks a refill, and only the
+    readings since each tank's last refill are used. The rate is the
+    median of the consecutive-pair slopes in that segment.
+    :return: (tanks, latest_values, rates) where rates are units per day
+             consumed, NaN when there are too few points
+    """
+    if not len(tank_ids):
+        empty = np.array([], dtype=np.float64)
+        return np.array([], dtype=np.int64), empty, empty
+
+    same_tank = tank_ids[1:] == tank_ids[:-1]
+    dv = np.diff(values)
+    dt = np.diff(seconds)
+    refill = same_tank & (dv > refill_jump)
+
+    # group = tank index, segment = run of readings between refills
+    group = np.concatenate(([0], np.cumsum(~same_tank)))
+    segment = np.concatenate(([0], np.cumsum(~same_tank | refill)))
+
+    last_idx = np.flatnonzero(np.concatenate((~same_tank, [True])))
+    ngroups = len(last_idx)
+    in_last_segment = segment == segment[last_idx][group]
+
+    pairs = same_tank & ~refill & in_last_segment[1:] & (dt > 0)
+    pair_group = group[1:][pairs]
+    slopes = -dv[pairs] / dt[pairs] * SECONDS_PER_DAY
+
+    rates = grouped_median(pair_group, slopes, ngroups)
+    counts = np.bincount(pair_group, minlength=ngroups)
+    rates[counts < max(min_points - 1, 1)] = np.nan
+
+    return tank_ids[last_idx], values[last_idx], rates
+
+
+def days_to_empty(latest_values, rates, min_rate=config.FORECAST_MIN_RATE, max_days=config.FORECAST_MAX_DAYS):
+    """
+    Whole days until empty at the fitted rate
+    :return: float array, NaN where no forecast is possible
+    """
+    days = np.full(len(rates), np.nan)
+    usable = np.isfinite(rates) & (rates > min_rate)
+    days[usable] = np.floor(np.clip(latest_values[usable] / rates[usable], 0, max_days))
+    return days
+
+
+def forecast_dealer(session, dealer_id, now=None):
+    """
+    Recompute Tank.days_to_empty for a whole dealer fleet and write it back
+    with a single executemany UPDATE
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :return: summary dict
+    """
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+
+    tank_ids, seconds, values = load_dealer_readings(
+        session, dealer_id, now - timedelta(days=config.FORECAST_WINDOW_DAYS)
+    )
+    loaded = time.perf_counter()
+
+    tanks, latest, rates = fit_consumption(tank_ids, seconds, values)
+    days = days_to_empty(latest, rates)
+    fitted = time.perf_counter()
+
+    params = [
+        {'b_id': int(tank_id), 'b_days': None if np.isnan(d) else int(d)}
+        for tank_id, d in zip(tanks, days)
+    ]
+
+    if params:
+        table = Tank.__table__
+        session.execute(
+            table.update().where(table.c.id == bindparam('b_id')).values(days_to_empty=bindparam('b_days')),
+            params
+        )
+        session.commit()
+
+    return {
+        'dealer_id': dealer_id,
+        'readings': len(tank_ids),
+        'tanks': len(tanks),
+        'forecasted': int(np.isfinite(days).sum()),
+        'timings_ms': {
+            'load': round((loaded - started) * 1000.0, 3),
+            'fit': round((fitted - loaded) * 1000.0, 3),
+            'total': round((time.perf_counter() - started) * 1000.0, 3),
+        },
+    }
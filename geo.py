@@ -0,0 +1,307 @@
+import logging
+import time
+import numpy as np
+import redis
+from flask import abort, jsonify, make_response, request
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+from cache import TTLCache
+from extensions import redis_client as app_redis
+from models import Customer, ServiceAddress, Tank
+import config
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat, lon, lats, lons):
+    """
+    Great-circle distance from one point to many, all in radians
+    :param lat: latitude of the origin
+    :param lon: longitude of the origin
+    :param lats: numpy array of latitudes
+    :param lons: numpy array of longitudes
+    :return: numpy array of distances in km
+    """
+    a = np.sin((lats - lat) / 2.0) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class PointIndex(object):
+    """
+    Points kept sorted by latitude in numpy arrays.
+    Radius queries only compute distances for the latitude band that can
+    contain matches; nearest queries compute them for every point, which
+    is a single vectorized pass even for a whole dealer territory.
+    """
+
+    def __init__(self, ids, lats, lons):
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        order = np.argsort(lats, kind='mergesort')
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.lats = lats[order]
+        self.lons = np.radians(np.asarray(lons, dtype=np.float64))[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def within(self, lat, lon, radius_km, limit=None):
+        """
+        Points within radius_km of (lat, lon), nearest first
+        :param lat: degrees
+        :param lon: degrees
+        :param radius_km:
+        :param limit: max number of points returned
+        :return: (ids, distances in km)
+        """
+        lat, lon = np.radians(lat), np.radians(lon)
+        band = radius_km / EARTH_RADIUS_KM
+        lo, hi = np.searchsorted(self.lats, (lat - band, lat + band))
+
+        distances = haversine_km(lat, lon, self.lats[lo:hi], self.lons[lo:hi])
+        hits = np.nonzero(distances <= radius_km)[0]
+        order = hits[np.argsort(distances[hits], kind='mergesort')][:limit]
+        return self.ids[lo:hi][order], distances[order]
+
+    def nearest(self, lat, lon, k):
+        """
+        The k points closest to (lat, lon), nearest first
+        :param lat: degrees
+        :param lon: degrees
+        :param k:
+        :return: (ids, distances in km)
+        """
+        if not len(self.ids):
+            return self.ids, self.lats
+
+        distances = haversine_km(np.radians(lat), np.radians(lon), self.lats, self.lons)
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest], kind='mergesort')]
+        return self.ids[nearest], distances[nearest]
+
+
+class DealerGeoIndex(object):
+    """
+    A dealer's geocoded service addresses and the tanks installed at them
+    """
+
+    def __init__(self, addresses, tanks):
+        self.coordinates = dict((row[0], (row[1], row[2])) for row in addresses)
+        self.addresses = PointIndex(*_columns(addresses, 3))
+        self.tanks = PointIndex(*_columns(tanks, 3))
+        self.tank_addresses = dict((row[0], row[3]) for row in tanks)
+
+    @classmethod
+    def load(cls, session, dealer_id):
+        """
+        Build the index with one query per point set
+        :param session: sqlalchemy session
+        :param dealer_id:
+        :return: DealerGeoIndex
+        """
+        started = time.perf_counter()
+
+        addresses = session.query(
+            ServiceAddress.id, ServiceAddress.latitude, ServiceAddress.longitude
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            Customer.dealer_id == dealer_id,
+            ServiceAddress.latitude != None,  # noqa: E711
+            ServiceAddress.longitude != None  # noqa: E711
+        ).all()
+
+        tanks = session.query(
+            Tank.id, ServiceAddress.latitude, ServiceAddress.longitude, ServiceAddress.id
+        ).join(
+            ServiceAddress, Tank.service_address_id == ServiceAddress.id
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            Customer.dealer_id == dealer_id,
+            ServiceAddress.latitude != None,  # noqa: E711
+            ServiceAddress.longitude != None  # noqa: E711
+        ).all()
+
+        index = cls(addresses, tanks)
+        log.info('geo index for dealer %s: %d addresses, %d tanks in %.1fms', dealer_id,
+                 len(index.addresses), len(index.tanks), (time.perf_counter() - started) * 1000.0)
+        return index
+
+
+def _columns(rows, count):
+    if not rows:
+        return [()] * count
+    return list(zip(*[row[:count] for row in rows]))
+
+
+# dealer id -> DealerGeoIndex, dropped whenever the dealer's points change
+geo_cache = TTLCache(maxsize=config.GEO_INDEX_MAXSIZE, ttl=config.GEO_INDEX_TTL)
+
+# dealer ids whose index every worker drops
+CHANNEL = 'owl:geo:invalidate'
+
+
+def invalidate_index(dealer_id):
+    """
+    Drop a dealer's index in this process and broadcast it to the other
+    workers. Call it after writes that bypass the ORM events below, e.g.
+    executemany inserts and updates, once they are committed.
+    :param dealer_id:
+    """
+    if dealer_id is None:
+        return
+
+    geo_cache.pop(dealer_id)
+    try:
+        app_redis.publish(CHANNEL, dealer_id)
+    except redis.RedisError as err:
+        # the other workers catch up when their entry expires
+        log.warning('geo index broadcast failed: %s', err)
+
+
+def subscribe_invalidations(redis_client):
+    """
+    Drop the indexes other workers invalidate
+    :param redis_client: redis connection
+    :return: pub/sub worker thread
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{CHANNEL: _on_message})
+    return pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+def _on_message(message):
+    geo_cache.pop(int(message['data']))
+
+
+def dealer_geo_index(session, dealer_id):
+    """
+    Cached geo index for a dealer, built on first use
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :return: DealerGeoIndex
+    """
+    index = geo_cache.get(dealer_id)
+
+    if index is None:
+        index = DealerGeoIndex.load(session, dealer_id)
+        geo_cache.set(dealer_id, index)
+
+    return index
+
+
+def point_args():
+    """
+    Parse ?lat=&lon= from the query string
+    :return: (lat, lon) in degrees
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+
+    if lat is None or lon is None or not -90.0 <= lat <= 90.0 or not -180.0 <= lon <= 180.0:
+        msg = {'code': 400, 'message': 'lat and lon are required decimal degrees...'}
+        abort(make_response(jsonify(msg), 400))
+
+    return lat, lon
+
+
+def located_documents(session, serializer, ids, distances, coordinates):
+    """
+    Serialize index hits in distance order with one IN query
+    :param session: sqlalchemy session
+    :param serializer: FastSerializer of the indexed model
+    :param ids: primary keys, nearest first
+    :param distances: matching distances in km
+    :param coordinates: callable pk -> (latitude, longitude)
+    :return: list of documents
+    """
+    ids = [int(pk) for pk in ids]
+    if not ids:
+        return []
+
+    rows = dict((row.id, row) for row in serializer.query(session).filter(serializer.model.id.in_(ids)))
+    documents = []
+
+    for pk, distance in zip(ids, distances):
+        row = rows.get(pk)
+        if row is None:
+            # deleted since the index was built
+            continue
+
+        document = serializer.dump_row(row)
+        document['latitude'], document['longitude'] = coordinates(pk)
+        document['distance_km'] = round(float(distance), 3)
+        documents.append(document)
+
+    return documents
+
+
+def _dealer_of_customer(connection, customer_id):
+    return connection.execute(select([Customer.dealer_id]).where(Customer.id == customer_id)).scalar()
+
+
+def _dealer_of_address(connection, service_address_id):
+    return connection.execute(select([Customer.dealer_id]).where(
+        Customer.id == ServiceAddress.customer_id
+    ).where(
+        ServiceAddress.id == service_address_id
+    )).scalar()
+
+
+def _changed(target, names):
+    state = inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in names)
+
+
+def _invalidate_on_commit(target, dealer_id):
+    # dropped at once for this process, broadcast when the change is visible to the others
+    geo_cache.pop(dealer_id)
+    session = object_session(target)
+    if session is not None and dealer_id is not None:
+        session.info.setdefault('geo_dealers', set()).add(dealer_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def broadcast_invalidations(session):
+    for dealer_id in session.info.pop('geo_dealers', ()):
+        invalidate_index(dealer_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_invalidations(session):
+    session.info.pop('geo_dealers', None)
+
+
+@event.listens_for(ServiceAddress, 'after_insert')
+@event.listens_for(ServiceAddress, 'after_delete')
+def invalidate_address(mapper, connection, target):
+    _invalidate_on_commit(target, _dealer_of_customer(connection, target.customer_id))
+
+
+@event.listens_for(ServiceAddress, 'after_update')
+def invalidate_moved_address(mapper, connection, target):
+    if not _changed(target, ('latitude', 'longitude', 'customer_id')):
+        return
+
+    history = inspect(target).attrs.customer_id.history
+    for customer_id in set(history.deleted or ()) | {target.customer_id}:
+        _invalidate_on_commit(target, _dealer_of_customer(connection, customer_id))
+
+
+@event.listens_for(Tank, 'after_insert')
+@event.listens_for(Tank, 'after_delete')
+def invalidate_tank(mapper, connection, target):
+    _invalidate_on_commit(target, _dealer_of_address(connection, target.service_address_id))
+
+
+@event.listens_for(Tank, 'after_update')
+def invalidate_moved_tank(mapper, connection, target):
+    history = inspect(target).attrs.service_address_id.history
+    if not history.has_changes():
+        return
+
+    for service_address_id in set(history.deleted or ()) | {target.service_address_id}:
+        _invalidate_on_commit(target, _dealer_of_address(connection, service_address_id))
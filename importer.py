@@ -0,0 +1,353 @@
+import codecs
+import csv
+import io
+import json
+import logging
+import re
+import time
+from sqlalchemy import bindparam, exc, or_
+from models import Customer, ServiceAddress
+from schemas import CustomerImportSchema, ServiceAddressImportSchema
+import config
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('json', 'ndjson', 'csv')
+
+CONTENT_TYPES = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'text/csv': 'csv',
+}
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def detect_format(content_type=None, filename=None):
+    """
+    :param content_type: request mimetype
+    :param filename: file name, its extension is used when there is no content type match
+    :return: one of FORMATS or None
+    """
+    if content_type in CONTENT_TYPES:
+        return CONTENT_TYPES[content_type]
+
+    if filename:
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if extension in FORMATS:
+            return extension
+        if extension == 'jsonl':
+            return 'ndjson'
+
+    return None
+
+
+def iter_json_array(stream, read_size=config.IMPORT_READ_SIZE):
+    """
+    Decode the elements of a top level JSON array one at a time, keeping
+    only the unread part of the last block in memory
+    :param stream: file-like object yielding bytes
+    :param read_size: bytes per read
+    :return: generator of (row number, document, None)
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+    number = 0
+
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        head = buffer[position:position + 1]
+
+        if head and not started:
+            if head != '[':
+                raise ValueError('Expected a JSON array')
+            started = True
+            position += 1
+            continue
+
+        if head == ',':
+            position += 1
+            continue
+
+        if head == ']':
+            return
+
+        if head:
+            try:
+                document, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise ValueError('Invalid JSON after row {}'.format(number))
+            else:
+                # a bare number at the end of the buffer may continue in the next read
+                if end < len(buffer) or eof:
+                    number += 1
+                    position = end
+                    yield number, document, None
+                    continue
+
+        if eof:
+            raise ValueError('Unterminated JSON array after row {}'.format(number) if started else
+                             'Expected a JSON array')
+
+        data = stream.read(read_size)
+        eof = not data
+        buffer = buffer[position:] + utf8.decode(data, final=eof)
+        position = 0
+
+
+def iter_ndjson_rows(stream):
+    """
+    One document per line; a line that does not parse is a row error
+    :param stream: file-like object yielding bytes lines
+    :return: generator of (row number, document or None, error or None)
+    """
+    number = 0
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        number += 1
+        try:
+            yield number, json.loads(line.decode('utf-8-sig')), None
+        except ValueError as err:
+            yield number, None, {'_row': ['Invalid JSON: {}'.format(err)]}
+
+
+def iter_csv_rows(stream):
+    """
+    One document per CSV record, keyed by the header row; empty cells are null
+    :param stream: file-like object yielding bytes
+    :return: generator of (row number, document, None)
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+    for number, row in enumerate(reader, 1):
+        yield number, dict(
+            (key.strip(), (value.strip() or None) if value is not None else None)
+            for key, value in row.items() if key
+        ), None
+
+
+READERS = {
+    'json': iter_json_array,
+    'ndjson': iter_ndjson_rows,
+    'csv': iter_csv_rows,
+}
+
+
+def resolve_customers(session, dealer_id, rows):
+    """
+    Point every service address row at one of the dealer's customers,
+    by customer_id or customer_number, with one query per chunk
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param rows: validated dicts, customer_id is filled in place
+    :return: dict of row position -> error messages
+    """
+    ids = set(row['customer_id'] for row in rows if row.get('customer_id') is not None)
+    numbers = set(row['customer_number'] for row in rows
+                  if row.get('customer_id') is None and row.get('customer_number') is not None)
+
+    known = set()
+    by_number = {}
+    if ids or numbers:
+        for customer_id, customer_number in session.query(Customer.id, Customer.customer_number).filter(
+            Customer.dealer_id == dealer_id,
+            or_(Customer.id.in_(bindparam('b_ids', expanding=True)),
+                Customer.customer_number.in_(bindparam('b_numbers', expanding=True)))
+        ).params(
+            # placeholders, an empty expanding IN is not supported
+            b_ids=sorted(ids) or [0], b_numbers=sorted(numbers) or ['']
+        ):
+            known.add(customer_id)
+            by_number.setdefault(customer_number, customer_id)
+
+    errors = {}
+    for position, row in enumerate(rows):
+        if row.get('customer_id') is None:
+            row['customer_id'] = by_number.get(row.get('customer_number'))
+
+        if row['customer_id'] is None:
+            errors[position] = {'customer_number': ['No customer with this customer_number...']}
+        elif row['customer_id'] not in known:
+            errors[position] = {'customer_id': ['Customer {} not found...'.format(row['customer_id'])]}
+
+    return errors
+
+
+def prepare_customers(session, dealer_id, rows):
+    for row in rows:
+        row['dealer_id'] = dealer_id
+    return {}
+
+
+def prepare_service_addresses(session, dealer_id, rows):
+    errors = resolve_customers(session, dealer_id, rows)
+    for row in rows:
+        row.pop('customer_number', None)
+    return errors
+
+
+# kind -> (model, import schema, prepare(session, dealer_id, rows) -> errors)
+KINDS = {
+    'customers': (Customer, CustomerImportSchema, prepare_customers),
+    'service-addresses': (ServiceAddress, ServiceAddressImportSchema, prepare_service_addresses),
+}
+
+
+class ImportSummary(object):
+    """
+    Counts and the first IMPORT_MAX_ERRORS row errors of a run, so memory
+    stays flat however many rows fail
+    """
+
+    def __init__(self, kind, dealer_id):
+        self.kind = kind
+        self.dealer_id = dealer_id
+        self.rows = 0
+        self.inserted = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+        self.fatal = None
+        self.started = time.perf_counter()
+
+    def error(self, number, messages):
+        self.failed += 1
+        if len(self.errors) < config.IMPORT_MAX_ERRORS:
+            self.errors.append({'row': number, 'errors': messages})
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'dealer_id': self.dealer_id,
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+            'fatal': self.fatal,
+            'ms': round((time.perf_counter() - self.started) * 1000.0, 3),
+        }
+
+
+def insert_chunk(session, table, columns, rows, numbers, summary):
+    """
+    One multi-row INSERT and commit for the chunk. When the database rejects
+    it the rows are retried one by one so only the offending ones fail.
+    """
+    values = [dict((column, row.get(column)) for column in columns) for row in rows]
+
+    try:
+        # executemany: PyMySQL sends it as multi-row INSERTs, without sqlalchemy
+        # compiling a bind parameter per value as insert().values(rows) would
+        session.execute(table.insert(), values)
+        session.commit()
+        summary.inserted += len(values)
+        return
+    except exc.DBAPIError:
+        session.rollback()
+
+    for number, row in zip(numbers, values):
+        try:
+            session.execute(table.insert(), row)
+            session.commit()
+            summary.inserted += 1
+        except exc.DBAPIError as err:
+            session.rollback()
+            summary.error(number, {'_row': [str(err.orig)]})
+
+
+def import_chunk(session, kind, dealer_id, chunk, summary):
+    """
+    Validate a chunk against the import schema, resolve references and insert it
+    :param chunk: list of (row number, document)
+    """
+    model, schema_class, prepare = KINDS[kind]
+
+    documents = []
+    for number, document in chunk:
+        if isinstance(document, dict):
+            documents.append((number, document))
+        else:
+            summary.error(number, {'_row': ['Expected an object...']})
+
+    result = schema_class(many=True).load([document for _, document in documents], session=session)
+
+    numbers = []
+    rows = []
+    for position, (number, _) in enumerate(documents):
+        if position in result.errors:
+            summary.error(number, result.errors[position])
+        else:
+            numbers.append(number)
+            rows.append(result.data[position])
+
+    errors = prepare(session, dealer_id, rows)
+    if errors:
+        for position in sorted(errors):
+            summary.error(numbers[position], errors[position])
+        numbers = [n for position, n in enumerate(numbers) if position not in errors]
+        rows = [row for position, row in enumerate(rows) if position not in errors]
+
+    if rows:
+        table = model.__table__
+        columns = [name for name in table.columns.keys() if name in schema_class.Meta.fields or name == 'dealer_id']
+        insert_chunk(session, table, columns, rows, numbers, summary)
+
+    summary.chunks += 1
+
+
+def import_rows(session, kind, dealer_id, records, chunk_size=config.IMPORT_CHUNK_SIZE):
+    """
+    Stream records into the database chunk by chunk. Only one chunk is held
+    in memory; each chunk is committed on its own, so rows of earlier chunks
+    stay imported if the run stops.
+    :param session: sqlalchemy session
+    :param kind: one of KINDS
+    :param dealer_id: owner of the imported rows
+    :param records: generator of (row number, document, parse error) from READERS
+    :param chunk_size: rows per INSERT and commit
+    :return: ImportSummary
+    """
+    summary = ImportSummary(kind, dealer_id)
+    chunk = []
+    records = iter(records)
+
+    while True:
+        # only the reader's errors are parse errors, import_chunk's propagate
+        try:
+            number, document, error = next(records)
+        except StopIteration:
+            break
+        except (ValueError, csv.Error) as err:
+            # a broken JSON array or CSV file cannot be resumed after the damage;
+            # the rows read before it are still imported
+            summary.fatal = str(err)
+            break
+
+        summary.rows += 1
+
+        if error is not None:
+            summary.error(number, error)
+            continue
+
+        chunk.append((number, document))
+        if len(chunk) >= chunk_size:
+            import_chunk(session, kind, dealer_id, chunk, summary)
+            chunk = []
+
+    if chunk:
+        import_chunk(session, kind, dealer_id, chunk, summary)
+
+    log.info('imported %d of %d %s for dealer %s, %d failed', summary.inserted, summary.rows, kind, dealer_id,
+             summary.failed)
+    return summary
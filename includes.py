@@ -0,0 +1,68 @@
+from flask import abort, jsonify, make_response, request
+from etags import collection_etag
+from models import Meter, ServiceAddress, Tank
+from serializers import meter_serializer, serviceaddress_serializer, tank_serializer
+
+INCLUDES = ('service_addresses', 'tanks', 'meters')
+
+# one batched query per included relation, whatever the page size
+MAX_INCLUDE_QUERIES = len(INCLUDES)
+
+
+def requested_includes():
+    """
+    Parse ?include=service_addresses,tanks,meters
+    :return: tuple of relation names in INCLUDES order
+    """
+    value = request.args.get('include')
+
+    if not value:
+        return ()
+
+    wanted = set(name.strip() for name in value.split(',') if name.strip())
+    unknown = wanted.difference(INCLUDES)
+
+    if unknown:
+        msg = {'code': 400, 'message': 'Unknown include: {}. Available includes: {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(INCLUDES)
+        )}
+        abort(make_response(jsonify(msg), 400))
+
+    return tuple(name for name in INCLUDES if name in wanted)
+
+
+def load_included(session, customer_ids, includes):
+    """
+    Load the Customer -> ServiceAddress -> Tank/Meter graph for a set of
+    customers with one query per relation. Tanks and meters are selected
+    through a sub-select on the service addresses, so the query count does
+    not depend on how many addresses the customers have.
+    :param session: sqlalchemy session
+    :param customer_ids: ids of the customers in the response
+    :param includes: tuple from requested_includes()
+    :return: (included documents, etag of the included rows)
+    """
+    included = {}
+    etags = []
+
+    if not includes or not customer_ids:
+        return included, None
+
+    addresses = session.query(ServiceAddress.id).filter(ServiceAddress.customer_id.in_(customer_ids))
+
+    relations = (
+        ('service_addresses', serviceaddress_serializer, ServiceAddress,
+         ServiceAddress.customer_id.in_(customer_ids)),
+        ('tanks', tank_serializer, Tank, Tank.service_address_id.in_(addresses.subquery())),
+        ('meters', meter_serializer, Meter, Meter.service_address_id.in_(addresses.subquery())),
+    )
+
+    for name, serializer, model, criterion in relations:
+        if name not in includes:
+            continue
+
+        rows = serializer.query(session).filter(criterion).order_by(model.id).all()
+        included[name] = serializer.dump_rows(rows)
+        etags.append(collection_etag(rows, serializer.fields))
+
+    return included, ','.join(etags)
@@ -0,0 +1,220 @@
+import json
+import logging
+import smtplib
+import time
+from collections import deque
+import redis
+from flask_mail import BadHeaderError, Message
+import config
+
+log = logging.getLogger(__name__)
+
+QUEUE_KEY = 'owl:mail:queue'
+RETRY_KEY = 'owl:mail:retry'
+DEAD_KEY = 'owl:mail:dead'
+SCHEDULED_KEY = 'owl:mail:scheduled'
+
+
+def mail_payload(to, subject, html=None, body=None, sender=None):
+    """
+    A queued message as a plain dict, serialized as JSON
+    :param to: recipient address or list of addresses
+    :param subject:
+    :param html: html part
+    :param body: text part
+    :param sender: defaults to MAIL_DEFAULT_SENDER when sent
+    :return: dict
+    """
+    return {
+        'to': [to] if isinstance(to, str) else list(to),
+        'subject': subject,
+        'html': html,
+        'body': body,
+        'sender': sender,
+        'attempts': 0,
+    }
+
+
+def enqueue(redis_client, payloads):
+    """
+    Append payloads to the mail queue
+    :param redis_client: redis connection
+    :param payloads: list of mail_payload() dicts
+    :return: queue length
+    """
+    return redis_client.rpush(QUEUE_KEY, *[json.dumps(p, sort_keys=True) for p in payloads])
+
+
+def schedule_flush(redis_client, delay=config.MAIL_BATCH_DELAY):
+    """
+    Claim the right to queue the next flush; messages queued while a flush is
+    pending ride along with it instead of creating a task each
+    :param redis_client: redis connection
+    :param delay: seconds the flush waits to collect a batch
+    :return: True when the caller should queue the flush task
+    """
+    return bool(redis_client.set(SCHEDULED_KEY, 1, ex=delay + config.MAIL_FLUSH_TIME_LIMIT, nx=True))
+
+
+def take_batch(redis_client, size):
+    """
+    Atomically remove up to size payloads from the head of the queue
+    :param redis_client: redis connection
+    :param size:
+    :return: list of dicts
+    """
+    pipe = redis_client.pipeline()
+    pipe.lrange(QUEUE_KEY, 0, size - 1)
+    pipe.ltrim(QUEUE_KEY, size, -1)
+    raw, _ = pipe.execute()
+    return [json.loads(item.decode('utf-8')) for item in raw]
+
+
+def promote_retries(redis_client, now=None):
+    """
+    Move retries whose backoff has elapsed back onto the queue
+    :param redis_client: redis connection
+    :param now: epoch seconds
+    :return: number of payloads moved
+    """
+    now = time.time() if now is None else now
+    due = redis_client.zrangebyscore(RETRY_KEY, '-inf', now)
+    if not due:
+        return 0
+
+    pipe = redis_client.pipeline()
+    pipe.zrem(RETRY_KEY, *due)
+    pipe.rpush(QUEUE_KEY, *due)
+    pipe.execute()
+    return len(due)
+
+
+def defer(redis_client, payload, error):
+    """
+    Park a failed payload for a later attempt with exponential backoff,
+    or on the dead letter list once MAIL_MAX_ATTEMPTS is reached
+    :param redis_client: redis connection
+    :param payload: dict
+    :param error: exception raised while sending
+    :return: True when another attempt is scheduled
+    """
+    payload['attempts'] = payload.get('attempts', 0) + 1
+    payload['error'] = str(error)[:200]
+    raw = json.dumps(payload, sort_keys=True)
+
+    if payload['attempts'] >= config.MAIL_MAX_ATTEMPTS:
+        redis_client.rpush(DEAD_KEY, raw)
+        return False
+
+    backoff = config.MAIL_RETRY_BACKOFF * 2 ** (payload['attempts'] - 1)
+    redis_client.zadd(RETRY_KEY, **{raw: time.time() + backoff})
+    return True
+
+
+def build_message(payload, default_sender):
+    msg = Message(payload['subject'], sender=payload.get('sender') or default_sender, recipients=payload['to'])
+    msg.body = payload.get('body')
+    msg.html = payload.get('html')
+    return msg
+
+
+class RateLimiter(object):
+    """
+    Spaces calls at least 1 / rate seconds apart
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at = 0.0
+
+    def wait(self):
+        now = time.perf_counter()
+        if now < self.next_at:
+            time.sleep(self.next_at - now)
+            now = self.next_at
+        self.next_at = now + self.interval
+
+
+def permanent(error):
+    # 5xx replies and refused recipients will fail the same way next time
+    if isinstance(error, (BadHeaderError, smtplib.SMTPRecipientsRefused)):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+def send_batch(mail, redis_client, payloads, limiter):
+    """
+    Send payloads over one SMTP session. A dropped connection is reopened and
+    only the message that hit it is retried; if the server can't be reached
+    at all the unsent rest of the batch is retried later.
+    :param mail: flask_mail.Mail
+    :param redis_client: redis connection for retries
+    :param payloads: list of dicts
+    :param limiter: RateLimiter
+    :return: dict of sent, retried and dead counts
+    """
+    counts = {'sent': 0, 'retried': 0, 'dead': 0}
+    pending = deque(payloads)
+
+    def failed(payload, error):
+        log.warning('mail to %s failed: %s', payload['to'], error)
+        if permanent(error):
+            payload['attempts'] = config.MAIL_MAX_ATTEMPTS - 1
+        counts['retried' if defer(redis_client, payload, error) else 'dead'] += 1
+
+    try:
+        with mail.connect() as connection:
+            while pending:
+                payload = pending.popleft()
+                limiter.wait()
+
+                try:
+                    connection.send(build_message(payload, mail.default_sender))
+                    counts['sent'] += 1
+                except (BadHeaderError, smtplib.SMTPException, OSError) as err:
+                    failed(payload, err)
+                    if not isinstance(err, (BadHeaderError, smtplib.SMTPResponseException)):
+                        connection.host = connection.configure_host()
+    except (smtplib.SMTPException, OSError) as err:
+        log.error('smtp session failed: %s', err)
+        while pending:
+            failed(pending.popleft(), err)
+
+    return counts
+
+
+def flush_queue(mail, redis_client, batch_size=config.MAIL_BATCH_SIZE, rate=config.MAIL_RATE_PER_SECOND,
+                time_limit=config.MAIL_FLUSH_TIME_LIMIT):
+    """
+    Drain the mail queue in batches until it is empty or time_limit passes
+    :param mail: flask_mail.Mail
+    :param redis_client: redis connection
+    :param batch_size: messages per SMTP session
+    :param rate: messages per second, 0 for unlimited
+    :param time_limit: seconds
+    :return: dict of sent, retried, dead and batches counts
+    """
+    deadline = time.perf_counter() + time_limit
+    limiter = RateLimiter(rate)
+    totals = {'sent': 0, 'retried': 0, 'dead': 0, 'batches': 0}
+
+    try:
+        promote_retries(redis_client)
+        # later messages are queued with a flush of their own
+        redis_client.delete(SCHEDULED_KEY)
+
+        while time.perf_counter() < deadline:
+            payloads = take_batch(redis_client, batch_size)
+            if not payloads:
+                break
+
+            for name, count in send_batch(mail, redis_client, payloads, limiter).items():
+                totals[name] += count
+            totals['batches'] += 1
+    except redis.RedisError as err:
+        log.error('mail queue unavailable: %s', err)
+
+    if totals['batches']:
+        log.info('mail flush: %(sent)d sent, %(retried)d retried, %(dead)d dead in %(batches)d batches', totals)
+
+    return totals
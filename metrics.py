@@ -0,0 +1,459 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+import redis
+from flask import _app_ctx_stack, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import config
+
+log = logging.getLogger(__name__)
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# statements or round trips per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+# worker id -> JSON snapshot of that worker's metric families
+WORKERS_KEY = 'owl:metrics:workers'
+
+
+class Histogram(object):
+    """
+    Prometheus style histogram, callers hold the lock
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (le, count) pairs as exported, the last one is +Inf
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestStats(object):
+    """
+    What one request did, filled in by the engine and redis hooks while it
+    runs in this thread
+    """
+    __slots__ = ('context', 'endpoint', 'method', 'started', 'status', 'sampled', 'queries', 'db_time', 'query_started',
+                 'statements', 'redis_calls', 'redis_time')
+
+    def __init__(self, context, endpoint, method, sampled):
+        self.context = context
+        self.endpoint = endpoint
+        self.method = method
+        self.started = time.perf_counter()
+        self.status = None
+        self.sampled = sampled
+        self.queries = 0
+        self.db_time = 0.0
+        self.query_started = None
+        self.statements = []
+        self.redis_calls = 0
+        self.redis_time = 0.0
+
+
+class EndpointMetrics(object):
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statuses = {}
+        self.sampled = 0
+        self.queries = Histogram(COUNT_BUCKETS)
+        self.db_time = Histogram(DB_TIME_BUCKETS)
+        self.redis_calls = Histogram(COUNT_BUCKETS)
+        self.redis_time = 0.0
+        self.slow = 0
+
+
+class RequestMetrics(object):
+    """
+    Per-endpoint request latency, SQL and redis cost for this worker.
+    Every request is timed; a sample_rate share of them also counts its SQL
+    statements, database time and redis round trips and keeps its SQL for
+    the slow request log. The hooks are a couple of perf_counter() calls per
+    statement, so the sample rate only needs lowering on very busy workers.
+
+    Counters live in each worker. A scrape lands on any one of them, so each
+    worker also publishes a snapshot to redis every publish_interval seconds
+    and render() merges the live snapshots, every series labelled with its
+    worker: each series stays monotonic whichever worker answers.
+    """
+
+    def __init__(self, sample_rate=1.0, slow_ms=1000, slow_sql_max=50, enabled=True, publish_interval=15,
+                 worker_ttl=300):
+        """
+        :param sample_rate: share of requests whose SQL and redis calls are measured, 0 to 1
+        :param slow_ms: requests slower than this are logged, with their SQL when sampled
+        :param slow_sql_max: statements logged per slow request
+        :param enabled: False leaves the app uninstrumented
+        :param publish_interval: seconds between snapshots published to redis
+        :param worker_ttl: seconds after which a worker that stopped publishing is dropped
+        """
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.slow_sql_max = slow_sql_max
+        self.enabled = enabled
+        self.publish_interval = publish_interval
+        self.worker_ttl = worker_ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._redis = None
+        self._published = 0.0
+        self.endpoints = {}
+        self.engine_hooked = False
+
+    def init_app(self, app, redis_client=None):
+        """
+        Register the request hooks, and the engine and redis hooks once
+        :param app: flask app
+        :param redis_client: redis connection whose round trips are counted
+        """
+        if not self.enabled:
+            return
+
+        app.before_request(self.start_request)
+        app.after_request(self.record_status)
+        app.teardown_appcontext(self.finish_request)
+
+        if not self.engine_hooked:
+            # every engine, so tasks and CLI commands with an app context are covered too
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            self.engine_hooked = True
+
+        if redis_client is not None:
+            self._redis = redis_client
+            self.instrument_redis(redis_client)
+
+    def current(self):
+        return getattr(self._local, 'stats', None)
+
+    def start_request(self):
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        self._local.stats = RequestStats(_app_ctx_stack.top, request.endpoint or 'unmatched', request.method, sampled)
+
+    def record_status(self, response):
+        stats = self.current()
+        if stats is not None:
+            stats.status = response.status_code
+        return response
+
+    def finish_request(self, exception=None):
+        stats = self.current()
+        # tasks run eagerly push and tear down app contexts of their own
+        if stats is None or stats.context is not _app_ctx_stack.top:
+            return
+        self._local.stats = None
+
+        elapsed = time.perf_counter() - stats.started
+        status = stats.status or 500
+        slow = elapsed * 1000.0 >= self.slow_ms
+
+        with self._lock:
+            metrics = self.endpoints.get(stats.endpoint)
+            if metrics is None:
+                metrics = self.endpoints[stats.endpoint] = EndpointMetrics()
+
+            metrics.latency.observe(elapsed)
+            key = (stats.method, status)
+            metrics.statuses[key] = metrics.statuses.get(key, 0) + 1
+            if stats.sampled:
+                metrics.sampled += 1
+                metrics.queries.observe(stats.queries)
+                metrics.db_time.observe(stats.db_time)
+                metrics.redis_calls.observe(stats.redis_calls)
+                metrics.redis_time += stats.redis_time
+            if slow:
+                metrics.slow += 1
+
+        if slow:
+            self.log_slow(stats, elapsed, status)
+
+        now = time.time()
+        if self._redis is not None and now - self._published >= self.publish_interval:
+            self._published = now
+            self.publish()
+
+    def log_slow(self, stats, elapsed, status):
+        if not stats.sampled:
+            log.warning('slow request %s %s %s in %.1fms (not sampled)', stats.method, stats.endpoint, status,
+                        elapsed * 1000.0)
+            return
+
+        lines = ['{:>9.3f}ms  {}'.format(ms, ' '.join(statement.split()))
+                 for ms, statement in stats.statements[:self.slow_sql_max]]
+        if stats.queries > self.slow_sql_max:
+            lines.append('... {} more statements'.format(stats.queries - self.slow_sql_max))
+
+        log.warning('slow request %s %s %s in %.1fms: %d queries in %.1fms, %d redis round trips in %.1fms\n%s',
+                    stats.method, stats.endpoint, status, elapsed * 1000.0, stats.queries, stats.db_time * 1000.0,
+                    stats.redis_calls, stats.redis_time * 1000.0, '\n'.join(lines))
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.current()
+        if stats is not None and stats.sampled:
+            stats.query_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.current()
+        if stats is None or stats.query_started is None:
+            return
+
+        elapsed = time.perf_counter() - stats.query_started
+        stats.query_started = None
+        stats.queries += 1
+        stats.db_time += elapsed
+        if len(stats.statements) < self.slow_sql_max:
+            # parameters are left out, they hold customer data
+            stats.statements.append((elapsed * 1000.0, statement))
+
+    def instrument_redis(self, redis_client):
+        """
+        Count round trips on the client's connections: a single command and
+        a whole pipeline are each one send and one wait for the replies.
+        Clients without a connection pool (test doubles) are left alone.
+        """
+        pool = getattr(redis_client, 'connection_pool', None)
+        if pool is None or getattr(pool.connection_class, 'instrumented', False):
+            return
+
+        metrics = self
+        base = pool.connection_class
+
+        class InstrumentedConnection(base):
+            instrumented = True
+
+            def send_packed_command(self, command, *args, **kwargs):
+                stats = metrics.current()
+                if stats is not None and stats.sampled:
+                    stats.redis_calls += 1
+                    started = time.perf_counter()
+                    try:
+                        return base.send_packed_command(self, command, *args, **kwargs)
+                    finally:
+                        stats.redis_time += time.perf_counter() - started
+                return base.send_packed_command(self, command, *args, **kwargs)
+
+            def read_response(self, *args, **kwargs):
+                stats = metrics.current()
+                if stats is not None and stats.sampled:
+                    started = time.perf_counter()
+                    try:
+                        return base.read_response(self, *args, **kwargs)
+                    finally:
+                        stats.redis_time += time.perf_counter() - started
+                return base.read_response(self, *args, **kwargs)
+
+        InstrumentedConnection.__name__ = 'Instrumented' + base.__name__
+        pool.connection_class = InstrumentedConnection
+        # connections made before this keep their class, drop them
+        pool.disconnect()
+
+    def families(self):
+        """
+        This worker's metrics
+        :return: list of (name, kind, help text, samples), samples being (sample name, labels, value)
+        """
+        families = []
+
+        def family(name, kind, help_text):
+            samples = []
+            families.append((name, kind, help_text, samples))
+            return samples
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+
+            samples = family('owl_http_request_duration_seconds', 'histogram', 'Request latency by endpoint')
+            for endpoint, metrics in endpoints:
+                _histogram(samples, 'owl_http_request_duration_seconds', {'endpoint': endpoint}, metrics.latency)
+
+            samples = family('owl_http_requests_total', 'counter', 'Requests by endpoint, method and status')
+            for endpoint, metrics in endpoints:
+                for (method, status), count in sorted(metrics.statuses.items()):
+                    _sample(samples, 'owl_http_requests_total',
+                            {'endpoint': endpoint, 'method': method, 'status': status}, count)
+
+            samples = family('owl_http_slow_requests_total', 'counter', 'Requests over the slow request threshold')
+            for endpoint, metrics in endpoints:
+                _sample(samples, 'owl_http_slow_requests_total', {'endpoint': endpoint}, metrics.slow)
+
+            samples = family('owl_http_sampled_requests_total', 'counter',
+                             'Requests whose SQL and redis calls were measured')
+            for endpoint, metrics in endpoints:
+                _sample(samples, 'owl_http_sampled_requests_total', {'endpoint': endpoint}, metrics.sampled)
+
+            samples = family('owl_db_queries_per_request', 'histogram', 'SQL statements per sampled request')
+            for endpoint, metrics in endpoints:
+                _histogram(samples, 'owl_db_queries_per_request', {'endpoint': endpoint}, metrics.queries)
+
+            samples = family('owl_db_seconds_per_request', 'histogram', 'Database time per sampled request')
+            for endpoint, metrics in endpoints:
+                _histogram(samples, 'owl_db_seconds_per_request', {'endpoint': endpoint}, metrics.db_time)
+
+            samples = family('owl_redis_round_trips_per_request', 'histogram',
+                             'Redis round trips per sampled request')
+            for endpoint, metrics in endpoints:
+                _histogram(samples, 'owl_redis_round_trips_per_request', {'endpoint': endpoint}, metrics.redis_calls)
+
+            samples = family('owl_redis_seconds_total', 'counter', 'Redis time of sampled requests')
+            for endpoint, metrics in endpoints:
+                _sample(samples, 'owl_redis_seconds_total', {'endpoint': endpoint}, round(metrics.redis_time, 6))
+
+        return families
+
+    @staticmethod
+    def worker_id():
+        # read on every call, a forked worker must not report as its parent
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def publish(self):
+        """
+        Store this worker's snapshot for the workers that answer scrapes
+        """
+        snapshot = json.dumps({'at': time.time(), 'families': self.families()})
+        try:
+            self._redis.hset(WORKERS_KEY, self.worker_id(), snapshot)
+        except redis.RedisError as err:
+            log.warning('metrics snapshot write failed: %s', err)
+
+    def collect(self):
+        """
+        The other workers' live snapshots; stale ones are deleted
+        :return: dict of worker id -> families
+        """
+        if self._redis is None:
+            return {}
+
+        try:
+            snapshots = self._redis.hgetall(WORKERS_KEY)
+        except redis.RedisError as err:
+            log.warning('metrics snapshot read failed: %s', err)
+            return {}
+
+        me = self.worker_id()
+        now = time.time()
+        workers = {}
+        stale = []
+
+        for worker, raw in snapshots.items():
+            worker = worker.decode('utf-8')
+            if worker == me:
+                continue
+
+            snapshot = json.loads(raw.decode('utf-8'))
+            if now - snapshot['at'] > self.worker_ttl:
+                stale.append(worker)
+            else:
+                workers[worker] = snapshot['families']
+
+        if stale:
+            try:
+                self._redis.hdel(WORKERS_KEY, *stale)
+            except redis.RedisError as err:
+                log.warning('metrics snapshot cleanup failed: %s', err)
+
+        return workers
+
+    def render(self, gauges=None):
+        """
+        Every live worker's metrics in the Prometheus text exposition format,
+        each sample labelled with its worker
+        :param gauges: extra {metric name: number} of this worker to export as gauges
+        :return: str
+        """
+        families = self.families()
+        for name, value in sorted((gauges or {}).items()):
+            families.append((name, 'gauge', None, [(name, {}, value)]))
+
+        merged = OrderedDict()
+        workers = [(self.worker_id(), families)] + sorted(self.collect().items())
+
+        for worker, worker_families in workers:
+            for name, kind, help_text, samples in worker_families:
+                if name not in merged:
+                    merged[name] = (kind, help_text, [])
+                merged[name][2].extend(
+                    (sample, dict(labels, worker=worker), value) for sample, labels, value in samples
+                )
+
+        lines = []
+        for name, (kind, help_text, samples) in merged.items():
+            _header(lines, name, kind, help_text)
+            for sample, labels, value in samples:
+                _line(lines, sample, labels, value)
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+
+def _header(lines, name, kind, help_text):
+    if help_text:
+        lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _line(lines, name, labels, value):
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+            for key, label in sorted(labels.items())
+        ))
+    lines.append('{} {}'.format(name, value))
+
+
+def _sample(samples, name, labels, value):
+    samples.append((name, labels, value))
+
+
+def _histogram(samples, name, labels, histogram):
+    for bound, count in histogram.cumulative():
+        _sample(samples, name + '_bucket', dict(labels, le=bound), count)
+    _sample(samples, name + '_sum', labels, round(histogram.sum, 6))
+    _sample(samples, name + '_count', labels, histogram.count)
+
+
+def numeric_gauges(prefix, stats):
+    """
+    The numeric values of a stats() dict as gauges
+    :param prefix: metric name prefix
+    :param stats: dict from PoolMetrics.stats(), ResponseCache.stats()...
+    :return: dict of metric name -> number
+    """
+    return dict(
+        ('{}_{}'.format(prefix, key), value) for key, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    )
+
+
+request_metrics = RequestMetrics(
+    sample_rate=config.METRICS_SAMPLE_RATE,
+    slow_ms=config.METRICS_SLOW_REQUEST_MS,
+    slow_sql_max=config.METRICS_SLOW_SQL_MAX,
+    enabled=config.METRICS_ENABLED,
+    publish_interval=config.METRICS_PUBLISH_INTERVAL,
+    worker_ttl=config.METRICS_WORKER_TTL
+)
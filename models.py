@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, Numeric, String, DateTime, Float, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, BigInteger, Numeric, String, Date, DateTime, Float, Boolean, ForeignKey, Text, Index, \
+    UniqueConstraint, DDL, event
 from sqlalchemy.orm import relationship
-from app import db
+from extensions import db
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -148,7 +149,7 @@ class ServiceAddress(db.Model):
     def __repr__(self):
         if self.id:
             return '{} {} {} {} {} {}'.format(
-                self.customer,
+                self.customer_id,
                 self.address1,
                 self.address2,
                 self.city,
@@ -159,6 +160,7 @@ class ServiceAddress(db.Model):
 
 class Tank(db.Model):
     __tablename__ = 'frontend_tank'
+    id = Column(Integer, primary_key=True)
     service_address_id = Column(Integer, ForeignKey('frontend_serviceaddress.id'), nullable=False)
     service_address = relationship('ServiceAddress')
     capacity = Column(Integer, nullable=True)
@@ -179,13 +181,14 @@ class Tank(db.Model):
     def __repr__(self):
         if self.id:
             return '{} {}'.format(
-                self.service_address,
+                self.service_address_id,
                 self.capacity
             )
 
 
 class Meter(db.Model):
     __tablename__ = 'frontend_meter'
+    id = Column(Integer, primary_key=True)
     service_address_id = Column(Integer, ForeignKey('frontend_serviceaddress.id'), nullable=False)
     service_address = relationship('ServiceAddress')
     meter_current_read = Column(String(255), nullable=True)
@@ -202,6 +205,93 @@ class Meter(db.Model):
     def __repr__(self):
         if self.id:
             return '{} {}'.format(
-                self.service_address,
+                self.service_address_id,
                 self.meter_current_read
             )
+
+
+class Reading(db.Model):
+    """
+    Append-only sensor history for tanks and meters.
+    On MySQL the primary key is widened to (id, receiver_time) after
+    create so the table can be range partitioned by time.
+    """
+    __tablename__ = 'frontend_reading'
+    __table_args__ = (
+        # covers "last N readings for a device" without touching the rows
+        Index('ix_reading_device_time', 'device_type', 'device_id', 'receiver_time', 'sensor_value'),
+    )
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    receiver_time = Column(DateTime, nullable=False)
+    device_type = Column(String(8), nullable=False)
+    device_id = Column(Integer, nullable=False)
+    network_id = Column(String(255), nullable=True)
+    sensor_value = Column(Float(), nullable=True)
+
+    def __repr__(self):
+        return '{} {} {} {}'.format(
+            self.device_type,
+            self.device_id,
+            self.receiver_time,
+            self.sensor_value
+        )
+
+
+class BillingShard(db.Model):
+    """
+    One shard of a billing run, written as planned (no total) before any
+    shard runs, so a resumed run reuses the same ranges and shard numbers.
+    total and completed_at are set in the same transaction as the balance
+    update, which only applies while the row is still pending.
+    """
+    __tablename__ = 'frontend_billing_shard'
+    __table_args__ = (
+        UniqueConstraint('dealer_id', 'period_end', 'shard', name='uq_billing_shard'),
+    )
+    id = Column(Integer, primary_key=True)
+    dealer_id = Column(ForeignKey('frontend_dealer.id'), nullable=False)
+    period_start = Column(Date, nullable=False)
+    period_end = Column(Date, nullable=False)
+    shard = Column(Integer, nullable=False)
+    first_service_address_id = Column(Integer, nullable=False)
+    last_service_address_id = Column(Integer, nullable=False)
+    service_addresses = Column(Integer, nullable=False)
+    total = Column(Numeric(precision=12, scale=2), nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return '{} {} {} {}'.format(
+            self.dealer_id,
+            self.period_end,
+            self.shard,
+            self.total
+        )
+
+
+class DealerAlertSetting(db.Model):
+    """
+    Low-tank alert thresholds of a dealer; unset columns fall back to config
+    """
+    __tablename__ = 'frontend_dealer_alert_setting'
+    id = Column(Integer, primary_key=True)
+    dealer_id = Column(ForeignKey('frontend_dealer.id'), nullable=False, unique=True)
+    enabled = Column(Boolean, default=True)
+    low_level = Column(Float(), nullable=True)
+    low_days = Column(Integer, nullable=True)
+    clear_margin = Column(Float(), nullable=True)
+    clear_days = Column(Integer, nullable=True)
+    notify_email = Column(String(255), nullable=True)
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.dealer_id,
+            self.low_level,
+            self.low_days
+        )
+
+
+# start with a single catch-all partition, monthly ranges are split off by readings.add_reading_partitions()
+event.listen(Reading.__table__, 'after_create', DDL(
+    'ALTER TABLE frontend_reading DROP PRIMARY KEY, ADD PRIMARY KEY (id, receiver_time) '
+    'PARTITION BY RANGE (TO_DAYS(receiver_time)) (PARTITION pmax VALUES LESS THAN MAXVALUE)'
+).execute_if(dialect='mysql'))
@@ -0,0 +1,89 @@
+from flask import abort, request, Response, stream_with_context
+from serializers import encode
+import config
+
+
+def page_args():
+    """
+    Parse keyset pagination arguments from the query string
+    ?after=<id>&limit=<n>
+    :return: (after, limit)
+    """
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', default=config.PAGE_SIZE_DEFAULT, type=int)
+
+    if limit is None or limit < 1:
+        abort(400)
+
+    return after, min(limit, config.PAGE_SIZE_MAX)
+
+
+def wants_stream():
+    """
+    True when the client asked for the streamed response mode
+    :return: bool
+    """
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def keyset_page(query, column, after=None, limit=config.PAGE_SIZE_DEFAULT):
+    """
+    Fetch one page of query ordered by column, starting after the given key.
+    One extra row is read to know whether another page exists.
+    :param query: sqlalchemy query
+    :param column: unique, indexed column to page on
+    :param after: last key of the previous page
+    :param limit: page size
+    :return: (rows, next_after)
+    """
+    if after is not None:
+        query = query.filter(column > after)
+
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], column.key)
+
+    return rows, next_after
+
+
+def stream_json(key, query, column, dump, chunk_size=config.STREAM_CHUNK_SIZE):
+    """
+    Stream query results as {"<key>": [...], "status_code": 200}, written
+    chunk by chunk from a server-side cursor so memory stays flat.
+    :param key: name of the list in the response document
+    :param query: sqlalchemy query
+    :param column: ordering column
+    :param dump: callable serializing a list of rows into a list of dicts
+    :param chunk_size: rows fetched and written per chunk
+    :return: streamed response
+    """
+    query = query.order_by(column).execution_options(stream_results=True).yield_per(chunk_size)
+
+    def generate():
+        yield '{{{}:['.format(encode(key))
+
+        chunk = []
+        first = True
+
+        for row in query:
+            chunk.append(row)
+
+            if len(chunk) >= chunk_size:
+                yield _encode_chunk(dump(chunk), first)
+                first = False
+                chunk = []
+
+        if chunk:
+            yield _encode_chunk(dump(chunk), first)
+
+        yield '],"status_code":200}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _encode_chunk(items, first):
+    body = ','.join(encode(item) for item in items)
+    return body if first else ',' + body
@@ -0,0 +1,184 @@
+import logging
+import time
+from sqlalchemy import bindparam
+from models import Customer, ServiceAddress, Tank
+from radio_index import RadioEntry, device_query
+from readings import TANK
+import config
+
+log = logging.getLogger(__name__)
+
+PROVISION = 'provision'
+DEPROVISION = 'deprovision'
+
+
+def parse_items(data):
+    """
+    Validate a bulk request body
+    :param data: list of {"tank_id", "network_id", "action"} objects,
+    action defaults to provision
+    :return: (list of (position, action, tank_id, network_id), list of per-item errors)
+    """
+    items = []
+    errors = []
+
+    for position, item in enumerate(data):
+        try:
+            action = item.get('action', PROVISION)
+            tank_id = item['tank_id']
+            network_id = item['network_id']
+            if action not in (PROVISION, DEPROVISION) or isinstance(tank_id, bool) or \
+                    not isinstance(tank_id, int) or network_id in (None, ''):
+                raise ValueError
+        except (AttributeError, KeyError, ValueError):
+            errors.append({'index': position, 'code': 400, 'message': 'Expected tank_id, network_id and an '
+                           'optional action of provision or deprovision...'})
+            continue
+
+        items.append((position, action, tank_id, str(network_id)))
+
+    return items, errors
+
+
+def load_tanks(session, dealer_id, tank_ids):
+    """
+    The dealer's tanks among tank_ids, one query per PROVISION_QUERY_CHUNK ids
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param tank_ids: set of ints
+    :return: dict tank id -> row of id, network_id, service_address_id, customer_id
+    """
+    tank_ids = sorted(tank_ids)
+    tanks = {}
+
+    # an expanding parameter skips building a bind object per id
+    query = session.query(
+        Tank.id, Tank.network_id, Tank.service_address_id, ServiceAddress.customer_id
+    ).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        Tank.id.in_(bindparam('b_ids', expanding=True))
+    )
+
+    for i in range(0, len(tank_ids), config.PROVISION_QUERY_CHUNK):
+        for row in query.params(b_ids=tank_ids[i:i + config.PROVISION_QUERY_CHUNK]):
+            tanks[row.id] = row
+
+    return tanks
+
+
+def load_owners(session, network_ids):
+    """
+    Which device of any dealer holds each radio
+    :param session: sqlalchemy session
+    :param network_ids: set of strings
+    :return: dict network_id -> (device_type, device_id)
+    """
+    network_ids = sorted(network_ids)
+    owners = {}
+
+    # SQLAlchemy 1.2 does not carry an expanding parameter through the union
+    for i in range(0, len(network_ids), config.PROVISION_QUERY_CHUNK):
+        for row in device_query(session, network_ids=network_ids[i:i + config.PROVISION_QUERY_CHUNK]):
+            owners[row.network_id] = (row.device_type, row.device_id)
+
+    return owners
+
+
+def plan_changes(items, tanks, owners):
+    """
+    Apply the items in order to an in-memory copy of the current state, so
+    each item gets the answer the single-item endpoints would have given
+    after the ones before it
+    :param items: from parse_items()
+    :param tanks: from load_tanks()
+    :param owners: from load_owners(), updated in place
+    :return: (per-item results, dict tank id -> final network_id of changed tanks)
+    """
+    radios = dict((tank_id, row.network_id) for tank_id, row in tanks.items())
+    results = []
+
+    for position, action, tank_id, network_id in items:
+        result = {'index': position, 'action': action, 'tank_id': tank_id, 'network_id': network_id}
+        results.append(result)
+
+        if tank_id not in tanks:
+            result.update(code=404, message='Tank {} not found...'.format(tank_id))
+            continue
+
+        if action == PROVISION:
+            owner = owners.get(network_id)
+            if owner is not None and owner != (TANK, tank_id):
+                result.update(code=409, message='Radio {} is already provisioned...'.format(network_id))
+                continue
+
+            previous = radios[tank_id]
+            if previous and previous != network_id:
+                owners.pop(previous, None)
+            owners[network_id] = (TANK, tank_id)
+            radios[tank_id] = network_id
+        else:
+            if radios[tank_id] != network_id:
+                result.update(code=404, message='Radio {} is not provisioned on tank {}...'.format(
+                    network_id, tank_id))
+                continue
+
+            owners.pop(network_id, None)
+            radios[tank_id] = None
+
+        result['code'] = 200
+
+    changed = dict((tank_id, network_id) for tank_id, network_id in radios.items()
+                   if network_id != tanks[tank_id].network_id)
+    return results, changed
+
+
+def bulk_provision(session, dealer_id, items):
+    """
+    Provision and deprovision many radios: two set-based lookups, one
+    executemany UPDATE and one commit for the whole batch
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param items: from parse_items()
+    :return: (per-item results, RadioEntry list to add, network_ids to remove, timings in ms)
+    """
+    started = time.perf_counter()
+
+    tanks = load_tanks(session, dealer_id, set(item[2] for item in items))
+    owners = load_owners(session, set(item[3] for item in items))
+    loaded = time.perf_counter()
+
+    results, changed = plan_changes(items, tanks, owners)
+
+    if changed:
+        table = Tank.__table__
+        session.execute(
+            table.update().where(table.c.id == bindparam('b_id')).values(network_id=bindparam('b_network_id')),
+            [{'b_id': tank_id, 'b_network_id': network_id} for tank_id, network_id in changed.items()]
+        )
+    session.commit()
+
+    added = []
+    removed = []
+    for tank_id, network_id in sorted(changed.items()):
+        previous = tanks[tank_id].network_id
+        if previous:
+            removed.append(previous)
+        if network_id:
+            row = tanks[tank_id]
+            added.append(RadioEntry(network_id, TANK, tank_id, row.service_address_id, row.customer_id, dealer_id))
+
+    # a radio moved between tanks of the batch is removed from one and added to the other
+    removed = sorted(set(removed) - set(entry.network_id for entry in added))
+
+    timings = {
+        'load': round((loaded - started) * 1000.0, 3),
+        'apply': round((time.perf_counter() - loaded) * 1000.0, 3),
+    }
+    log.info('bulk provisioning for dealer %s: %d items, %d tanks changed in %sms',
+             dealer_id, len(items), len(changed), timings['load'] + timings['apply'])
+
+    return results, added, removed, timings
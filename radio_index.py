@@ -0,0 +1,251 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import literal
+from cache import TTLCache
+from models import Customer, Meter, ServiceAddress, Tank
+from readings import METER, TANK, query_columns
+import config
+
+log = logging.getLogger(__name__)
+
+RadioEntry = namedtuple('RadioEntry', [
+    'network_id', 'device_type', 'device_id', 'service_address_id', 'customer_id', 'dealer_id'
+])
+
+CHANNEL = 'owl:radio-index'
+
+
+def device_query(session, network_id=None, dealer_id=None, network_ids=None):
+    """
+    Every provisioned tank and meter with its service address, customer and dealer
+    :param session: sqlalchemy session, or None to only build the statement
+    :param network_id: restrict to a single network_id
+    :param dealer_id: restrict to one dealer's devices
+    :param network_ids: restrict to a list of network_ids
+    :return: union query of RadioEntry columns
+    """
+    def devices(model, device_type):
+        query = query_columns(session, [
+            model.network_id.label('network_id'),
+            literal(device_type).label('device_type'),
+            model.id.label('device_id'),
+            model.service_address_id.label('service_address_id'),
+            ServiceAddress.customer_id.label('customer_id'),
+            Customer.dealer_id.label('dealer_id')
+        ]).join(
+            ServiceAddress, model.service_address_id == ServiceAddress.id
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            model.network_id != None  # noqa: E711
+        )
+
+        if network_id is not None:
+            query = query.filter(model.network_id == network_id)
+
+        if network_ids is not None:
+            query = query.filter(model.network_id.in_(network_ids))
+
+        if dealer_id is not None:
+            query = query.filter(Customer.dealer_id == dealer_id)
+
+        return query
+
+    return devices(Tank, TANK).union_all(devices(Meter, METER))
+
+
+class RadioIndex(object):
+    """
+    network_id -> RadioEntry hash index answering gateway lookups from memory.
+    Built from the database on first use, refreshed every refresh seconds and
+    kept current in between by provision/deprovision events, which are also
+    broadcast to the other workers over redis pub/sub.
+    """
+
+    def __init__(self, refresh=config.RADIO_INDEX_REFRESH):
+        self.refresh = refresh
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.fallback_hits = 0
+        self._entries = {}
+        self._missing = TTLCache(maxsize=config.RADIO_INDEX_NEGATIVE_MAXSIZE, ttl=config.RADIO_INDEX_NEGATIVE_TTL)
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self._redis = None
+
+    def load(self, session):
+        """
+        Rebuild the whole index with a single query
+        :param session: sqlalchemy session
+        :return: number of entries
+        """
+        started = time.perf_counter()
+        entries = self.replace(RadioEntry(*row) for row in device_query(session))
+        log.info('radio index loaded %d devices in %.1fms', len(entries), (time.perf_counter() - started) * 1000.0)
+        return len(entries)
+
+    def replace(self, entries):
+        """
+        Swap in a freshly loaded set of entries
+        :param entries: iterable of RadioEntry
+        :return: dict network_id -> RadioEntry
+        """
+        entries = dict((entry.network_id, entry) for entry in entries)
+
+        with self._lock:
+            self._entries = entries
+            self._missing.clear()
+            self.loaded_at = time.time()
+
+        return entries
+
+    def ensure_loaded(self, session):
+        if self.loaded_at is not None and time.time() - self.loaded_at <= self.refresh:
+            return
+
+        if self.loaded_at is None:
+            with self._loading:
+                if self.loaded_at is None:
+                    self.load(session)
+
+        elif self._loading.acquire(False):
+            # only one thread rebuilds, the others keep serving the current map
+            try:
+                self.load(session)
+            finally:
+                self._loading.release()
+
+    def lookup(self, session, network_id):
+        """
+        Find the device behind a network_id, falling back to the
+        database on a miss
+        :param session: sqlalchemy session
+        :param network_id: string
+        :return: RadioEntry or None
+        """
+        self.ensure_loaded(session)
+        network_id = str(network_id)
+
+        entry, fallback = self.peek(network_id)
+        if not fallback:
+            return entry
+
+        return self.resolved(network_id, device_query(session, network_id).first())
+
+    def peek(self, network_id):
+        """
+        Memory-only lookup
+        :param network_id: string
+        :return: (RadioEntry or None, True when the database should be asked)
+        """
+        entry = self._entries.get(network_id)
+        if entry is not None:
+            self.hits += 1
+            return entry, False
+
+        self.misses += 1
+        return None, not self._missing.get(network_id)
+
+    def resolved(self, network_id, row):
+        """
+        Remember the outcome of a database fallback query
+        :param network_id: string
+        :param row: device_query() row or None
+        :return: RadioEntry or None
+        """
+        if row is None:
+            self._missing.set(network_id, True)
+            return None
+
+        entry = RadioEntry(*row)
+        self.fallback_hits += 1
+        self.add(entry, publish=False)
+        return entry
+
+    def add(self, entry, publish=True):
+        with self._lock:
+            self._entries[entry.network_id] = entry
+            self._missing.pop(entry.network_id)
+
+        if publish:
+            self._publish({'op': 'add', 'entry': entry._asdict()})
+
+    def remove(self, network_id, publish=True):
+        network_id = str(network_id)
+
+        with self._lock:
+            self._entries.pop(network_id, None)
+
+        if publish:
+            self._publish({'op': 'remove', 'network_id': network_id})
+
+    def update(self, added, removed, publish=True):
+        """
+        Apply a batch of provisioning changes under one lock with one broadcast
+        :param added: list of RadioEntry
+        :param removed: list of network_ids
+        :param publish: broadcast to the other workers
+        """
+        with self._lock:
+            for network_id in removed:
+                self._entries.pop(network_id, None)
+            for entry in added:
+                self._entries[entry.network_id] = entry
+                self._missing.pop(entry.network_id)
+
+        if publish and (added or removed):
+            self._publish({'op': 'batch', 'add': [entry._asdict() for entry in added], 'remove': list(removed)})
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'fallback_hits': self.fallback_hits,
+            'hit_rate': round(self.hits / float(lookups), 4) if lookups else None,
+            'loaded_at': self.loaded_at,
+        }
+
+    def subscribe(self, redis_client):
+        """
+        Apply provision/deprovision events published by other workers
+        :param redis_client: redis connection
+        :return: pub/sub worker thread
+        """
+        self._redis = redis_client
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CHANNEL: self._on_message})
+        return pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def _publish(self, event):
+        if self._redis is None:
+            return
+
+        try:
+            self._redis.publish(CHANNEL, json.dumps(event))
+        except Exception as err:
+            # the periodic refresh catches up if the broadcast is lost
+            log.warning('radio index broadcast failed: %s', err)
+
+    def _on_message(self, message):
+        self.apply(json.loads(message['data'].decode('utf-8')))
+
+    def apply(self, event):
+        """
+        Apply a provision/deprovision event received from another worker
+        :param event: decoded pub/sub message
+        """
+        if event['op'] == 'add':
+            self.add(RadioEntry(**event['entry']), publish=False)
+        elif event['op'] == 'remove':
+            self.remove(event['network_id'], publish=False)
+        elif event['op'] == 'batch':
+            self.update([RadioEntry(**entry) for entry in event['add']], event['remove'], publish=False)
+
+
+radio_index = RadioIndex()
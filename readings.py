@@ -0,0 +1,389 @@
+import json
+import logging
+import math
+import re
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, case, literal, or_, text
+from sqlalchemy.orm import Query
+from models import Customer, Meter, Reading, ServiceAddress, Tank
+import config
+
+log = logging.getLogger(__name__)
+
+# Reading.device_type values
+TANK = 'tank'
+METER = 'meter'
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+# Z, +HH:MM or +HHMM after the time; strptime's %z takes no colon before Python 3.7
+UTC_OFFSET = re.compile(r'(?<=\d)(Z|([+-])(\d{2}):?(\d{2}))$')
+
+
+def parse_datetime(value):
+    """
+    Parse an ISO-8601 timestamp as sent by clients and gateways; a UTC
+    offset is applied, so the result is naive UTC like the stored times
+    :param value: string
+    :return: datetime or None, also for a value that is not a string
+    """
+    if not value or not isinstance(value, str):
+        return None
+
+    offset = timedelta(0)
+    match = UTC_OFFSET.search(value)
+    if match:
+        value = value[:match.start()]
+        if match.group(2):
+            offset = timedelta(hours=int(match.group(3)), minutes=int(match.group(4)))
+            if match.group(2) == '-':
+                offset = -offset
+
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt) - offset
+        except ValueError:
+            continue
+
+    return None
+
+
+def history_window(start=None, end=None):
+    """
+    Clamp a requested history range to a bounded window
+    :param start: datetime or None
+    :param end: datetime or None
+    :return: (start, end)
+    """
+    end = end or datetime.utcnow()
+    max_start = end - timedelta(days=config.HISTORY_MAX_DAYS)
+    start = start or end - timedelta(days=config.HISTORY_DEFAULT_DAYS)
+    return max(start, max_start), end
+
+
+def latest_readings(session, device_type, device_id, limit):
+    """
+    Last N readings for a device, newest first.
+    Served by a reverse scan of ix_reading_device_time only.
+    :return: list of (receiver_time, sensor_value)
+    """
+    return session.query(Reading.receiver_time, Reading.sensor_value).filter(
+        Reading.device_type == device_type,
+        Reading.device_id == device_id
+    ).order_by(
+        Reading.receiver_time.desc()
+    ).limit(min(limit, config.HISTORY_MAX_RECORDS)).all()
+
+
+def readings_between(session, device_type, device_id, start, end, limit=config.HISTORY_MAX_RECORDS):
+    """
+    Readings for a device in [start, end), newest first.
+    The time bounds let MySQL prune partitions and bound the index range.
+    :return: list of (receiver_time, sensor_value)
+    """
+    return session.query(Reading.receiver_time, Reading.sensor_value).filter(
+        Reading.device_type == device_type,
+        Reading.device_id == device_id,
+        Reading.receiver_time >= start,
+        Reading.receiver_time < end
+    ).order_by(
+        Reading.receiver_time.desc()
+    ).limit(min(limit, config.HISTORY_MAX_RECORDS)).all()
+
+
+def dump_readings(rows):
+    return [
+        {'receiver_time': row.receiver_time.isoformat(), 'sensor_value': row.sensor_value}
+        for row in rows
+    ]
+
+
+def parse_readings(lines):
+    """
+    Validate raw reading documents from a gateway batch
+    :param lines: iterable of dicts with network_id, receiver_time, sensor_value
+    :return: (readings, errors) where readings are (network_id, receiver_time, sensor_value)
+    """
+    readings = []
+    errors = []
+
+    for index, item in enumerate(lines):
+        try:
+            network_id = str(item['network_id'])
+            receiver_time = parse_datetime(item['receiver_time'])
+            sensor_value = float(item['sensor_value'])
+        except (KeyError, TypeError, ValueError):
+            errors.append({'index': index, 'code': 400,
+                           'message': 'network_id, receiver_time and sensor_value are required'})
+            continue
+
+        if receiver_time is None:
+            errors.append({'index': index, 'code': 400, 'message': 'receiver_time is not an ISO-8601 timestamp'})
+            continue
+
+        if not math.isfinite(sensor_value):
+            errors.append({'index': index, 'code': 400, 'message': 'sensor_value is not a finite number'})
+            continue
+
+        readings.append((network_id, receiver_time, sensor_value))
+
+    return readings, errors
+
+
+def iter_ndjson(stream):
+    """
+    Decode a newline delimited JSON body one line at a time
+    :param stream: file-like object yielding bytes lines
+    :return: generator of documents
+    """
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line.decode('utf-8'))
+
+
+def query_columns(session, columns):
+    """
+    Column query on a session, or a session-less Query that only builds the
+    statement (the async service executes those on its own driver)
+    :param session: sqlalchemy session or None
+    :param columns: list of columns
+    :return: query
+    """
+    if session is None:
+        return Query(columns)
+    return session.query(*columns)
+
+
+def device_lookup_query(session, dealer_id, network_ids):
+    """
+    The dealer's tanks and meters behind a set of network_ids
+    :param session: sqlalchemy session, or None to only build the statement
+    :param dealer_id:
+    :param network_ids: list of network_id strings
+    :return: union query of (device_type, device_id, network_id)
+    """
+    tanks = query_columns(session, [
+        literal(TANK).label('device_type'), Tank.id.label('device_id'), Tank.network_id.label('network_id')
+    ]).select_from(
+        Tank
+    ).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        Tank.network_id.in_(network_ids)
+    )
+
+    meters = query_columns(session, [
+        literal(METER).label('device_type'), Meter.id.label('device_id'), Meter.network_id.label('network_id')
+    ]).select_from(
+        Meter
+    ).join(
+        ServiceAddress, Meter.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        Meter.network_id.in_(network_ids)
+    )
+
+    return tanks.union_all(meters)
+
+
+def resolve_devices(session, dealer_id, network_ids):
+    """
+    Map network_ids to the dealer's tanks and meters in a single query
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param network_ids: iterable of network_id strings
+    :return: dict network_id -> (device_type, device_id)
+    """
+    network_ids = list(set(network_ids))
+    if not network_ids:
+        return {}
+
+    query = device_lookup_query(session, dealer_id, network_ids)
+    return dict((row.network_id, (row.device_type, row.device_id)) for row in query)
+
+
+def latest_state_statement(model):
+    table = model.__table__
+    return table.update().where(and_(
+        table.c.id == bindparam('b_id'),
+        or_(table.c.receiver_time == None, table.c.receiver_time <= bindparam('b_time'))  # noqa: E711
+    )).values(
+        receiver_time=bindparam('b_time'),
+        sensor_value=bindparam('b_value')
+    )
+
+
+def latest_state_case_statement(model, params):
+    """
+    Latest-state update of many devices in one statement, for drivers
+    without executemany (aiomysql): CASE on the id picks each device's
+    time and value, the receiver_time guard still skips newer rows
+    :param model: Tank or Meter
+    :param params: update params from latest_state_params()
+    :return: sqlalchemy update
+    """
+    table = model.__table__
+    times = case(dict((p['b_id'], p['b_time']) for p in params), value=table.c.id)
+    values = case(dict((p['b_id'], p['b_value']) for p in params), value=table.c.id)
+    return table.update().where(and_(
+        table.c.id.in_([p['b_id'] for p in params]),
+        or_(table.c.receiver_time == None, table.c.receiver_time <= times)  # noqa: E711
+    )).values(
+        receiver_time=times,
+        sensor_value=values
+    )
+
+
+def ingest_readings(session, dealer_id, readings):
+    """
+    Store a gateway batch: one query to resolve devices, one executemany
+    insert into the history table and one executemany update per device
+    type for the latest state, committed together.
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param readings: list of (network_id, receiver_time, sensor_value)
+    :return: dict with counts, unknown network_ids and per-phase timings in ms
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    devices = resolve_devices(session, dealer_id, (r[0] for r in readings))
+    timings['resolve'] = time.perf_counter() - started
+
+    rows, latest, unknown = plan_ingest(devices, readings)
+
+    phase = time.perf_counter()
+    if rows:
+        session.execute(Reading.__table__.insert(), rows)
+    timings['insert'] = time.perf_counter() - phase
+
+    phase = time.perf_counter()
+    updated = 0
+    for model, params in latest_state_params(latest):
+        updated += updated_rows(session.execute(latest_state_statement(model), params), params)
+    timings['update'] = time.perf_counter() - phase
+
+    phase = time.perf_counter()
+    session.commit()
+    timings['commit'] = time.perf_counter() - phase
+    timings['total'] = time.perf_counter() - started
+
+    return ingest_result(dealer_id, rows, latest, unknown, updated, timings)
+
+
+def plan_ingest(devices, readings):
+    """
+    Split a parsed batch into history rows and the newest reading per device
+    :param devices: dict from resolve_devices()
+    :param readings: list of (network_id, receiver_time, sensor_value)
+    :return: (history rows, {(device_type, device_id): update params}, unknown network_ids)
+    """
+    rows = []
+    latest = {}
+    unknown = set()
+
+    for network_id, receiver_time, sensor_value in readings:
+        device = devices.get(network_id)
+        if device is None:
+            unknown.add(network_id)
+            continue
+
+        rows.append({
+            'device_type': device[0],
+            'device_id': device[1],
+            'network_id': network_id,
+            'receiver_time': receiver_time,
+            'sensor_value': sensor_value,
+        })
+
+        current = latest.get(device)
+        if current is None or current['b_time'] <= receiver_time:
+            latest[device] = {'b_id': device[1], 'b_time': receiver_time, 'b_value': sensor_value}
+
+    return rows, latest, unknown
+
+
+def latest_state_params(latest):
+    """
+    Group latest-state updates by model
+    :param latest: dict from plan_ingest()
+    :return: list of (model, list of update params)
+    """
+    updates = []
+    for device_type, model in ((TANK, Tank), (METER, Meter)):
+        params = [p for (dt, _), p in latest.items() if dt == device_type]
+        if params:
+            updates.append((model, params))
+    return updates
+
+
+def updated_rows(result, params):
+    """
+    Rows a latest-state update changed; the receiver_time guard skips
+    devices that already hold a newer reading
+    :param result: result of the executemany update
+    :param params: the update params
+    :return: int
+    """
+    # -1 when the driver can not tell
+    return result.rowcount if result.rowcount >= 0 else len(params)
+
+
+def ingest_result(dealer_id, rows, latest, unknown, updated, timings):
+    timings = dict((k, round(v * 1000.0, 3)) for k, v in timings.items())
+    log.info('ingested %d readings for %d devices (dealer %s), %d updated, in %sms',
+             len(rows), len(latest), dealer_id, updated, timings['total'])
+
+    return {
+        'inserted': len(rows),
+        'updated': updated,
+        'unknown_network_ids': sorted(unknown),
+        'timings_ms': timings,
+        # popped by the endpoints to queue the tanks for alert evaluation
+        'tank_ids': sorted(device_id for device_type, device_id in latest if device_type == TANK),
+    }
+
+
+def add_reading_partitions(connection, months_ahead=config.READING_PARTITION_MONTHS_AHEAD, today=None):
+    """
+    Split monthly RANGE partitions off the catch-all pmax partition of
+    frontend_reading so that upcoming months always have their own partition.
+    MySQL only.
+    :param connection: sqlalchemy connection
+    :param months_ahead: number of future months to keep partitioned
+    :return: list of created partition names
+    """
+    existing = set(row[0] for row in connection.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'frontend_reading'"
+    )))
+
+    today = today or datetime.utcnow().date()
+    month = today.replace(day=1)
+    partitions = []
+
+    for _ in range(months_ahead + 1):
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        name = 'p{}'.format(month.strftime('%Y%m'))
+
+        if name not in existing:
+            partitions.append("PARTITION {} VALUES LESS THAN (TO_DAYS('{}'))".format(
+                name, next_month.isoformat()
+            ))
+
+        month = next_month
+
+    if partitions:
+        connection.execute(text(
+            'ALTER TABLE frontend_reading REORGANIZE PARTITION pmax INTO ({}, '
+            'PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(', '.join(partitions))
+        ))
+
+    return [p.split()[1] for p in partitions]
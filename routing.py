@@ -0,0 +1,275 @@
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import redis
+from sqlalchemy import or_
+from models import Customer, Dealer, ServiceAddress, Tank
+from geo import EARTH_RADIUS_KM
+import config
+
+log = logging.getLogger(__name__)
+
+
+def due_stops(session, dealer_id, threshold, within_days):
+    """
+    Geocoded dealer tanks at or below the fill threshold or running out soon
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param threshold: sensor_value (percent full) at or below which a tank is due
+    :param within_days: days_to_empty at or below which a tank is due
+    :return: list of rows
+    """
+    return session.query(
+        Tank.id.label('tank_id'),
+        ServiceAddress.id.label('service_address_id'),
+        ServiceAddress.routing_zone,
+        ServiceAddress.latitude,
+        ServiceAddress.longitude,
+        Tank.capacity,
+        Tank.sensor_value,
+        Tank.days_to_empty
+    ).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        ServiceAddress.latitude != None,  # noqa: E711
+        ServiceAddress.longitude != None,  # noqa: E711
+        or_(Tank.sensor_value <= threshold, Tank.days_to_empty <= within_days)
+    ).order_by(
+        ServiceAddress.routing_zone, Tank.id
+    ).all()
+
+
+def project_km(lats, lons):
+    """
+    Equirectangular projection to planar km around the points' mean latitude,
+    accurate to well under a percent across a routing zone
+    :param lats: degrees
+    :param lons: degrees
+    :return: (n, 2) array of x, y in km
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    scale = np.cos(lats.mean()) if len(lats) else 1.0
+    return np.column_stack((lons * scale, lats)) * EARTH_RADIUS_KM
+
+
+def nearest_neighbor(points, start=0):
+    """
+    Greedy tour over the points, always driving to the closest unvisited stop
+    :param points: (n, 2) planar coordinates
+    :param start: index of the first stop
+    :return: visiting order as an index array
+    """
+    count = len(points)
+    order = np.empty(count, dtype=np.int64)
+    visited = np.zeros(count, dtype=bool)
+    current = start
+
+    for position in range(count):
+        order[position] = current
+        visited[current] = True
+
+        if position == count - 1:
+            break
+
+        distances = (points[:, 0] - points[current, 0]) ** 2 + (points[:, 1] - points[current, 1]) ** 2
+        distances[visited] = np.inf
+        current = int(np.argmin(distances))
+
+    return order
+
+
+def two_opt(points, order, max_passes=config.ROUTE_2OPT_MAX_PASSES, deadline=None):
+    """
+    Improve an open path (its first stop fixed) by reversing segments.
+    For every segment start the gains of all possible segment ends are
+    evaluated in one vectorized step and the best one is applied. This is
+    a local search: the result has no crossing a single reversal removes,
+    it is not guaranteed optimal.
+    :param points: (n, 2) planar coordinates
+    :param order: initial visiting order
+    :param max_passes: full sweeps without improvement end the search early
+    :param deadline: time.perf_counter() value to stop at, None for no limit
+    :return: improved visiting order
+    """
+    order = order.copy()
+    path = points[order]
+    count = len(order)
+
+    if count < 4 or deadline is not None and time.perf_counter() > deadline:
+        return order
+
+    x, y = path[:, 0].copy(), path[:, 1].copy()
+    # edges[k] joins stop k and k + 1; the path end has no outgoing edge
+    edges = np.append(np.hypot(x[1:] - x[:-1], y[1:] - y[:-1]), 0.0)
+
+    for _ in range(max_passes):
+        improved = False
+
+        for i in range(1, count - 1):
+            # removing edges i-1 and j, adding (i-1, j) and (i, j+1) for every j > i
+            gains = edges[i - 1] + edges[i + 1:] - np.hypot(x[i + 1:] - x[i - 1], y[i + 1:] - y[i - 1])
+            gains[:-1] -= np.hypot(x[i + 2:] - x[i], y[i + 2:] - y[i])
+
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                j = i + 1 + best
+                order[i:j + 1] = order[i:j + 1][::-1]
+                x[i:j + 1] = x[i:j + 1][::-1]
+                y[i:j + 1] = y[i:j + 1][::-1]
+                edges[i:j] = edges[i:j][::-1]
+                edges[i - 1] = np.hypot(x[i] - x[i - 1], y[i] - y[i - 1])
+                if j < count - 1:
+                    edges[j] = np.hypot(x[j + 1] - x[j], y[j + 1] - y[j])
+                improved = True
+
+            if deadline is not None and time.perf_counter() > deadline:
+                return order
+
+        if not improved:
+            break
+
+    return order
+
+
+def path_legs(points):
+    if len(points) < 2:
+        return np.zeros(len(points))
+    return np.append(0.0, np.hypot(*(points[1:] - points[:-1]).T))
+
+
+def plan_zone(stops, depot=None, deadline=None):
+    """
+    Order one routing zone's stops, starting from the depot when known
+    :param stops: due_stops() rows of a single zone
+    :param depot: (latitude, longitude) of the dealer yard or None
+    :param deadline: see two_opt(); past it zones keep their nearest-neighbour order
+    :return: route document
+    """
+    lats = [row.latitude for row in stops]
+    lons = [row.longitude for row in stops]
+
+    if depot is not None:
+        lats.insert(0, depot[0])
+        lons.insert(0, depot[1])
+
+    points = project_km(lats, lons)
+    order = two_opt(points, nearest_neighbor(points), deadline=deadline)
+    legs = path_legs(points[order])
+
+    offset = 1 if depot is not None else 0
+    route = []
+
+    for index, leg in zip(order, legs):
+        if index < offset:
+            continue
+
+        row = stops[index - offset]
+        route.append({
+            'tank_id': row.tank_id,
+            'service_address_id': row.service_address_id,
+            'latitude': row.latitude,
+            'longitude': row.longitude,
+            'capacity': row.capacity,
+            'sensor_value': row.sensor_value,
+            'days_to_empty': row.days_to_empty,
+            'leg_km': round(float(leg), 3),
+        })
+
+    return {
+        'routing_zone': stops[0].routing_zone,
+        'stops': route,
+        'distance_km': round(float(legs.sum()), 3),
+    }
+
+
+def plan_routes(session, dealer_id, threshold=config.ROUTE_THRESHOLD, within_days=config.ROUTE_DUE_DAYS):
+    """
+    Delivery runs for a dealer, one ordered route per routing zone
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param threshold: see due_stops()
+    :param within_days: see due_stops()
+    :return: plan document
+    """
+    started = time.perf_counter()
+
+    depot = session.query(Dealer.latitude, Dealer.longitude).filter(Dealer.id == dealer_id).first()
+    if depot is None or depot.latitude is None or depot.longitude is None:
+        depot = None
+
+    stops = due_stops(session, dealer_id, threshold, within_days)
+    loaded = time.perf_counter()
+
+    zones = {}
+    for row in stops:
+        zones.setdefault(row.routing_zone, []).append(row)
+
+    # one 2-opt budget for the whole plan, not per zone
+    deadline = time.perf_counter() + config.ROUTE_2OPT_TIME_LIMIT
+    routes = [plan_zone(zone_stops, depot, deadline)
+              for _, zone_stops in sorted(zones.items(), key=lambda z: z[0] or '')]
+
+    log.info('planned %d stops in %d zones for dealer %s', len(stops), len(routes), dealer_id)
+
+    return {
+        'dealer_id': dealer_id,
+        'threshold': threshold,
+        'within_days': within_days,
+        'stops': len(stops),
+        'routes': routes,
+        'planned_at': datetime.utcnow().isoformat(),
+        'timings_ms': {
+            'load': round((loaded - started) * 1000.0, 3),
+            'plan': round((time.perf_counter() - loaded) * 1000.0, 3),
+        },
+        'status_code': 200,
+    }
+
+
+def plan_key(dealer_id, threshold, within_days, day=None):
+    day = day or datetime.utcnow().date()
+    params = hashlib.sha1('{}:{}'.format(threshold, within_days).encode('utf-8')).hexdigest()[:12]
+    return 'owl:routes:{}:{}:{}'.format(dealer_id, day.isoformat(), params)
+
+
+def cached_plan(redis_client, session, dealer_id, threshold=config.ROUTE_THRESHOLD,
+                within_days=config.ROUTE_DUE_DAYS, refresh=False):
+    """
+    Today's plan from redis, computed and stored on a miss or refresh.
+    Entries expire at the end of the (UTC) day.
+    :param redis_client: redis connection
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param refresh: recompute even when a plan is cached
+    :return: (plan document as json bytes, True when served from cache)
+    """
+    key = plan_key(dealer_id, threshold, within_days)
+
+    if not refresh:
+        try:
+            body = redis_client.get(key)
+        except redis.RedisError as err:
+            log.warning('route cache read failed: %s', err)
+            body = None
+
+        if body is not None:
+            return body, True
+
+    body = json.dumps(plan_routes(session, dealer_id, threshold, within_days), sort_keys=True).encode('utf-8')
+
+    now = datetime.utcnow()
+    ttl = int((datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()) + 1
+
+    try:
+        redis_client.set(key, body, ex=ttl)
+    except redis.RedisError as err:
+        log.warning('route cache write failed: %s', err)
+
+    return body, False
@@ -1,4 +1,6 @@
+from marshmallow import fields
 from marshmallow_sqlalchemy import ModelSchema
+from models import Customer, ServiceAddress
 
 
 class CustomerSchema(ModelSchema):
@@ -25,3 +27,60 @@ class ServiceAddressSchema(ModelSchema):
 
 serviceaddress_schema = ServiceAddressSchema()
 serviceaddresses_schema = ServiceAddressSchema(many=True)
+
+
+class TankSchema(ModelSchema):
+
+    class Meta:
+        fields = ('id', 'service_address_id', 'capacity', 'tank_type', 'network_id', 'receiver_time',
+                  'sensor_value', 'days_to_empty')
+
+
+tank_schema = TankSchema()
+tanks_schema = TankSchema(many=True)
+
+
+class MeterSchema(ModelSchema):
+
+    class Meta:
+        fields = ('id', 'service_address_id', 'meter_current_read', 'meter_model', 'meter_multiplier',
+                  'meter_pulse_per_rev', 'network_id', 'receiver_time', 'sensor_value')
+
+
+meter_schema = MeterSchema()
+meters_schema = MeterSchema(many=True)
+
+
+class CustomerImportSchema(CustomerSchema):
+    """
+    A bulk import row: the customer fields plus the optional contact and
+    location columns, typed and required as the model columns are.
+    Loads to a dict for multi-row inserts instead of a model instance.
+    """
+
+    def make_instance(self, data):
+        return data
+
+    class Meta:
+        model = Customer
+        fields = tuple(f for f in CustomerSchema.Meta.fields if f != 'id') + (
+            'address2', 'country', 'email', 'phone', 'latitude', 'longitude', 'active')
+
+
+class ServiceAddressImportSchema(ServiceAddressSchema):
+    """
+    A bulk import row; customer_id may be left out when customer_number
+    names one of the dealer's customers
+    """
+    customer_id = fields.Integer(allow_none=True)
+    customer_number = fields.String(allow_none=True)
+
+    def make_instance(self, data):
+        return data
+
+    class Meta:
+        model = ServiceAddress
+        include_fk = True
+        fields = tuple(f for f in ServiceAddressSchema.Meta.fields if f != 'id') + (
+            'customer_number', 'address1', 'address2', 'city', 'state', 'postal_code', 'country', 'phone',
+            'latitude', 'longitude', 'notes', 'routing_zone', 'product_rate', 'tax_rate', 'management_rate')
@@ -0,0 +1,131 @@
+import datetime
+import decimal
+import json
+from flask import abort, jsonify, make_response, request, Response
+from models import Customer, Meter, ServiceAddress, Tank
+from schemas import CustomerSchema, MeterSchema, ServiceAddressSchema, TankSchema
+
+UTC = datetime.timezone.utc
+
+
+def _iso(value):
+    # same rendering as marshmallow's DateTime field: naive values are UTC
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return value.isoformat()
+
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return _iso(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+# compact separators and no indent keep encoding in the C accelerator
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=_default)
+encode = _encoder.encode
+
+
+def requested_fields(schema_cls):
+    """
+    Parse a sparse fieldset (?fields=a,b,c) against the schema.
+    The primary key is always included and the result keeps schema order.
+    :param schema_cls: ModelSchema subclass
+    :return: tuple of field names
+    """
+    fields = schema_cls.Meta.fields
+    value = request.args.get('fields')
+
+    if not value:
+        return tuple(fields)
+
+    wanted = set(name.strip() for name in value.split(',') if name.strip())
+    unknown = wanted.difference(fields)
+
+    if unknown:
+        msg = {'code': 400, 'message': 'Unknown fields: {}. Available fields: {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(fields)
+        )}
+        abort(make_response(jsonify(msg), 400))
+
+    wanted.add('id')
+    return tuple(field for field in fields if field in wanted)
+
+
+class FastSerializer(object):
+    """
+    Row-tuple serializer compiled from a ModelSchema's Meta.fields.
+    It selects only those columns and builds the output dicts with a
+    generated function instead of marshmallow's per-field dispatch.
+    """
+
+    def __init__(self, schema_cls, model, fields=None):
+        self.schema_cls = schema_cls
+        self.model = model
+        self.fields = tuple(fields or schema_cls.Meta.fields)
+        self.columns = [getattr(model, field) for field in self.fields]
+        self.dump_row, self.dump_rows = self._compile()
+        self._projections = {}
+
+    def project(self, fields):
+        """
+        Serializer selecting and emitting only a subset of the fields
+        :param fields: tuple from requested_fields()
+        :return: FastSerializer
+        """
+        if fields == self.fields:
+            return self
+
+        serializer = self._projections.get(fields)
+        if serializer is None:
+            serializer = self._projections[fields] = FastSerializer(self.schema_cls, self.model, fields)
+        return serializer
+
+    def _compile(self):
+        items = []
+        for index, (field, column) in enumerate(zip(self.fields, self.columns)):
+            python_type = _python_type(column)
+            if python_type is not None and issubclass(python_type, (datetime.date, datetime.datetime)):
+                items.append('{!r}: _iso(row[{}])'.format(field, index))
+            else:
+                items.append('{!r}: row[{}]'.format(field, index))
+
+        body = '{' + ', '.join(items) + '}'
+        source = (
+            'def dump_row(row):\n'
+            '    return {body}\n'
+            'def dump_rows(rows):\n'
+            '    return [{body} for row in rows]\n'
+        ).format(body=body)
+
+        namespace = {'_iso': _iso}
+        exec(compile(source, '<serializer {}>'.format(','.join(self.fields)), 'exec'), namespace)
+        return namespace['dump_row'], namespace['dump_rows']
+
+    def query(self, session):
+        """
+        Core-level column query returning plain row tuples
+        :param session: sqlalchemy session
+        :return: query
+        """
+        return session.query(*self.columns)
+
+    def response(self, document, status=200):
+        return Response(encode(document), status=status, mimetype='application/json')
+
+
+def _python_type(column):
+    try:
+        return column.property.columns[0].type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+customer_serializer = FastSerializer(CustomerSchema, Customer)
+serviceaddress_serializer = FastSerializer(ServiceAddressSchema, ServiceAddress)
+tank_serializer = FastSerializer(TankSchema, Tank)
+meter_serializer = FastSerializer(MeterSchema, Meter)
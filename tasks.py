@@ -0,0 +1,222 @@
+import logging
+from celery import chord
+from celery.schedules import crontab
+from celery.signals import worker_process_init
+from flask import current_app
+from sqlalchemy import exc
+from alerts import alert_mail, run_pass
+from billing import bill_shard, billing_period, dealers_due, finish_run, is_cycle_day, overlapping_run, parse_day, \
+    plan_shards, start_progress
+from cache import response_cache
+from extensions import celery, db, flask_app, redis_client
+from forecast import forecast_dealer
+from mailer import enqueue, flush_queue, mail_payload, schedule_flush
+from models import BillingShard, Dealer
+from readings import add_reading_partitions, parse_datetime
+from routing import cached_plan
+from usage import usage_report
+import config
+
+log = logging.getLogger(__name__)
+
+# Celery tasks, each run in an app context by extensions.ContextTask.
+# Workers import this module only, not the API views:
+#
+#     celery -A tasks worker
+#     celery -A tasks beat
+
+celery.conf.beat_schedule = {
+    'maintain-reading-partitions': {
+        'task': 'tasks.maintain_reading_partitions',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'forecast-all-dealers': {
+        'task': 'tasks.forecast_all_dealers',
+        'schedule': crontab(hour=2, minute=0),
+    },
+    # catches tanks left queued by a lost evaluation task
+    'evaluate-alerts': {
+        'task': 'tasks.evaluate_alerts_task',
+        'schedule': crontab(),
+    },
+    # picks up retries and anything a missed flush left behind
+    'flush-mail-queue': {
+        'task': 'tasks.flush_mail_task',
+        'schedule': crontab(),
+    },
+    'start-billing-cycles': {
+        'task': 'tasks.start_billing_cycles',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    # after the forecast so days_to_empty is current
+    'plan-all-dealer-routes': {
+        'task': 'tasks.plan_all_dealer_routes',
+        'schedule': crontab(hour=4, minute=0),
+    },
+}
+
+
+@worker_process_init.connect
+def reset_engine(**kwargs):
+    """Forked celery workers must not reuse the parent's pooled connections."""
+    with flask_app().app_context():
+        db.engine.dispose()
+
+
+@celery.task
+def flush_mail_task():
+    """Send the queued mail in batches, one SMTP session per batch."""
+    return flush_queue(current_app.extensions['mail'], redis_client)
+
+
+@celery.task
+def evaluate_alerts_task():
+    """Raise and clear low-tank alerts for tanks with new readings and mail each dealer a digest."""
+    raised, counts = run_pass(db.session, redis_client)
+    payloads = [alert_mail(settings, alerts) for settings, alerts in raised.values() if settings.email]
+
+    if payloads:
+        queue_mail(payloads)
+
+    return counts
+
+
+@celery.task
+def maintain_reading_partitions():
+    """Keep monthly frontend_reading partitions ahead of incoming data."""
+    with db.engine.begin() as connection:
+        return add_reading_partitions(connection)
+
+
+@celery.task
+def forecast_dealer_task(dealer_id):
+    """Recompute days_to_empty for every tank of one dealer."""
+    result = forecast_dealer(db.session, dealer_id)
+    response_cache.invalidate(dealer_id)
+    return result
+
+
+@celery.task
+def forecast_all_dealers():
+    """Fan out one forecast task per dealer."""
+    dealer_ids = [row.id for row in db.session.query(Dealer.id)]
+
+    for dealer_id in dealer_ids:
+        forecast_dealer_task.delay(dealer_id)
+
+    return len(dealer_ids)
+
+
+@celery.task
+def plan_routes_task(dealer_id, threshold=config.ROUTE_THRESHOLD, within_days=config.ROUTE_DUE_DAYS):
+    """Plan today's delivery runs for one dealer and cache them."""
+    cached_plan(redis_client, db.session, dealer_id, threshold, within_days, refresh=True)
+    return dealer_id
+
+
+@celery.task
+def plan_all_dealer_routes():
+    """Fan out one route planning task per dealer."""
+    dealer_ids = [row.id for row in db.session.query(Dealer.id)]
+
+    for dealer_id in dealer_ids:
+        plan_routes_task.delay(dealer_id)
+
+    return len(dealer_ids)
+
+
+@celery.task
+def meter_usage_task(dealer_id, start, end):
+    """Meter consumption and usage charges of one dealer for a period."""
+    return usage_report(db.session, dealer_id, parse_datetime(start), parse_datetime(end))
+
+
+@celery.task
+def billing_run_task(dealer_id, day=None):
+    """Bill one dealer's cycle ending on day, one chord member per shard."""
+    day = parse_day(day)
+    start_of_cycle = db.session.query(Dealer.start_of_billing_cycle).filter(Dealer.id == dealer_id).scalar()
+
+    if not is_cycle_day(day, start_of_cycle):
+        log.warning('billing run for dealer %s refused: %s is not a cycle day', dealer_id, day)
+        return None
+
+    period_start, period_end = billing_period(day, start_of_cycle)
+    other = overlapping_run(db.session, dealer_id, period_start, period_end)
+
+    if other is not None:
+        log.warning('billing run for dealer %s ending %s refused: overlaps the run %s..%s',
+                    dealer_id, period_end, other[0], other[1])
+        return None
+
+    shards = plan_shards(db.session, dealer_id, period_start, period_end)
+    done = db.session.query(BillingShard.id).filter(
+        BillingShard.dealer_id == dealer_id,
+        BillingShard.period_end == period_end,
+        BillingShard.completed_at != None  # noqa: E711
+    ).count()
+    start_progress(redis_client, dealer_id, period_start, period_end, len(shards), done)
+
+    finish = finish_billing_run_task.s(dealer_id, period_end.isoformat())
+
+    if not shards:
+        return finish.delay([]).id
+
+    return chord(
+        bill_shard_task.s(dealer_id, period_start.isoformat(), period_end.isoformat(), *shard) for shard in shards
+    )(finish).id
+
+
+@celery.task(bind=True, max_retries=3)
+def bill_shard_task(self, dealer_id, period_start, period_end, shard, first_id, last_id, count):
+    """Price one shard of service addresses and apply the charges."""
+    try:
+        return bill_shard(db.session, redis_client, dealer_id, parse_day(period_start), parse_day(period_end),
+                          shard, first_id, last_id, count)
+    except exc.OperationalError as err:
+        db.session.rollback()
+        raise self.retry(exc=err, countdown=30)
+
+
+@celery.task
+def finish_billing_run_task(results, dealer_id, period_end):
+    """Summarise a billing run once every shard is applied."""
+    response_cache.invalidate(dealer_id)
+    return finish_run(db.session, redis_client, dealer_id, parse_day(period_end))
+
+
+@celery.task
+def start_billing_cycles():
+    """Start a billing run for every dealer whose cycle begins today."""
+    dealer_ids = dealers_due(db.session, parse_day(None))
+
+    for dealer_id in dealer_ids:
+        billing_run_task.delay(dealer_id)
+
+    return len(dealer_ids)
+
+
+def send_email(to, subject, msg_body, **kwargs):
+    """
+    Send Mail function
+    :param to:
+    :param subject:
+    :param template:
+    :param kwargs:
+    :return: mail queue length
+    """
+    return queue_mail([mail_payload(to, subject, html=msg_body, body='message')])
+
+
+def queue_mail(payloads):
+    """
+    Queue mail and make sure a flush is on its way
+    :param payloads: list of mailer.mail_payload() dicts
+    :return: mail queue length
+    """
+    length = enqueue(redis_client, payloads)
+
+    if schedule_flush(redis_client):
+        flush_mail_task.apply_async(countdown=config.MAIL_BATCH_DELAY)
+
+    return length
@@ -0,0 +1,117 @@
+"""
+Query count of ?include= on the customer list and detail: the customers
+query plus at most one batched query per included relation, whatever the
+page size or the number of addresses behind it. Runs on the SQLite and
+fakeredis stand-in of the benchmarks, skipped without fakeredis.
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests/test_includes.py
+    python -m unittest tests.test_includes
+"""
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import standin  # noqa: E402
+import seed_data  # noqa: E402
+
+try:
+    import fakeredis  # noqa: F401
+except ImportError:
+    fakeredis = None
+
+PREFIX = '/api/v1.0'
+BASE = dict(base_url='https://localhost')
+
+# statements of the login, not of the resource
+AUTH_STATEMENT = re.compile(r'\bFROM (auth_user|frontend_dealer_account)\b')
+
+
+@unittest.skipIf(fakeredis is None, 'the stand-in needs fakeredis, see requirements-dev.txt')
+class IncludeQueryCountTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = standin.boot(os.path.join(tempfile.gettempdir(), 'owl-test-includes.db'), fresh=True)
+
+        from extensions import db
+        from models import Customer
+        seed_data.Seeder(db.session, seed_data.Scale(dealers=1, customers=40, days=1)).run()
+        cls.customer_id = db.session.query(Customer.id).order_by(Customer.id).first()[0]
+        db.session.remove()
+
+        cls.client = cls.app.test_client()
+        with cls.client.session_transaction(**BASE) as session:
+            session['user_id'] = '1'
+            session['_fresh'] = True
+
+        # the first request loads the dealer and the radio index
+        cls.client.get(PREFIX + '/customers', **BASE)
+
+    def count_statements(self, url):
+        from sqlalchemy import event
+        from cache import response_cache
+        from extensions import db
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not AUTH_STATEMENT.search(statement):
+                statements.append(statement)
+
+        # a cached response would run no query at all
+        response_cache.invalidate(1)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            resp = self.client.get(url, **BASE)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(resp.status_code, 200, resp.get_data(as_text=True))
+        return len(statements), json.loads(resp.get_data(as_text=True))
+
+    def include_combinations(self):
+        from includes import INCLUDES
+        for size in range(len(INCLUDES) + 1):
+            for includes in itertools.combinations(INCLUDES, size):
+                yield includes
+
+    def assert_capped(self, url):
+        from includes import MAX_INCLUDE_QUERIES
+
+        for includes in self.include_combinations():
+            query = '?include={}'.format(','.join(includes)) if includes else ''
+            count, doc = self.count_statements(url + query)
+
+            self.assertLessEqual(count, 1 + MAX_INCLUDE_QUERIES, '{}{}'.format(url, query))
+            self.assertEqual(sorted(doc.get('included', {})), sorted(includes))
+
+    def test_list(self):
+        self.assert_capped(PREFIX + '/customers')
+
+    def test_detail(self):
+        self.assert_capped(PREFIX + '/customer/{}'.format(self.customer_id))
+
+    def test_detail_etag_follows_includes(self):
+        url = PREFIX + '/customer/{}'.format(self.customer_id)
+        etags = set()
+
+        from cache import response_cache
+
+        for includes in self.include_combinations():
+            response_cache.invalidate(1)
+            query = '?include={}'.format(','.join(includes)) if includes else ''
+            etags.add(self.client.get(url + query, **BASE).headers['ETag'])
+
+        self.assertEqual(len(etags), len(list(self.include_combinations())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+import time
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+import numpy as np
+from sqlalchemy import and_, exists, true
+from models import Customer, Meter, Reading, ServiceAddress, Tank
+from forecast import EPOCH, epoch_microseconds, reading_arrays
+from readings import METER
+import config
+
+# fixed point scales: usage in thousandths of a unit, rates as stored (Numeric scale 5)
+UNIT_SCALE = 1000
+RATE_DIGITS = 5
+RATE_SCALE = 10 ** RATE_DIGITS
+CENT = Decimal('0.01')
+MILLI = Decimal('0.001')
+INT64_MAX = int(np.iinfo(np.int64).max)
+
+
+def load_meter_readings(session, dealer_id, since, until, address_range=None):
+    """
+    Every meter register reading of a dealer in a time range as arrays,
+    ordered by meter and time
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param since: datetime
+    :param until: datetime, exclusive
+    :param address_range: (first, last) service address id, inclusive
+    :return: (meter_ids, seconds, values) numpy arrays
+    """
+    query = session.query(Reading.device_id, epoch_microseconds(Reading.receiver_time), Reading.sensor_value).join(
+        Meter, and_(Reading.device_type == METER, Reading.device_id == Meter.id)
+    ).join(
+        ServiceAddress, Meter.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        Reading.receiver_time >= since,
+        Reading.receiver_time < until,
+        Reading.sensor_value != None  # noqa: E711
+    )
+
+    if address_range is not None:
+        query = query.filter(ServiceAddress.id.between(*address_range))
+
+    query = query.order_by(
+        Reading.device_id, Reading.receiver_time
+    )
+
+    return reading_arrays(session, query)
+
+
+def register_deltas(meter_ids, seconds, values, start_seconds, rollover_fraction=config.METER_ROLLOVER_FRACTION):
+    """
+    Register increase between consecutive readings of the same meter,
+    for every pair whose closing reading falls in the period.
+    A register that drops from near the next power of ten wrapped around;
+    any other drop is a reset or meter swap and counts from zero.
+    :param meter_ids: int array ordered by meter and time
+    :param seconds: reading times
+    :param values: register values
+    :param start_seconds: period start, pairs closing before it belong to the previous period
+    :param rollover_fraction: how close to the wrap point the previous value must be
+    :return: (meter id of each counted pair, delta, rollover flag)
+    """
+    previous, current = values[:-1], values[1:]
+    counted = (meter_ids[1:] == meter_ids[:-1]) & (seconds[1:] >= start_seconds)
+
+    delta = current - previous
+    dropped = delta < 0
+    # the register size: the smallest power of ten above the previous value,
+    # 999999.5 wraps at 1e6; at least 10 so values up to 1 have a size too
+    modulus = 10.0 ** np.maximum(np.ceil(np.log10(np.maximum(previous, 1.0))), 1.0)
+    rolled = dropped & (previous >= rollover_fraction * modulus)
+
+    delta = np.where(rolled, modulus - previous + current, np.where(dropped, current, delta))
+    return meter_ids[1:][counted], delta[counted], rolled[counted]
+
+
+def to_scaled(values, digits=RATE_DIGITS):
+    """
+    Decimal (or None) values as exact integers of 10 ** -digits
+    :param values: iterable of Decimal or None
+    :param digits: decimal places kept
+    :return: int64 array
+    """
+    return np.asarray([
+        int(Decimal(v or 0).scaleb(digits).to_integral_value(ROUND_HALF_UP)) for v in values
+    ], dtype=np.int64)
+
+
+def round_div(numerators, denominator):
+    # exact ROUND_HALF_UP integer division, halves of credits round away from zero like Decimal
+    magnitudes = (abs(numerators) + denominator // 2) // denominator
+    return np.where(numerators < 0, -magnitudes, magnitudes)
+
+
+def magnitude(values):
+    return max(abs(int(values.min())), abs(int(values.max()))) if len(values) else 0
+
+
+def fixed_product(left, right):
+    """
+    Elementwise product of two integer arrays, on python ints (object
+    arrays) when int64 could overflow; half the int64 range is kept free
+    for the rounding and the sums that follow
+    :param left: int64 or object array
+    :param right: int64 or object array
+    :return: int64 or object array
+    """
+    if magnitude(left) * magnitude(right) > INT64_MAX // 2:
+        return left.astype(object) * right.astype(object)
+    return left * right
+
+
+def price_usage(milli_units, product_rates, management_rates, tax_rates):
+    """
+    Price usage per address with exact integer fixed point math, equal to
+    Decimal arithmetic with ROUND_HALF_UP to the cent at each line
+    :param milli_units: int64 array, usage in thousandths of a unit
+    :param product_rates: int64 array, price per unit scaled by RATE_SCALE
+    :param management_rates: int64 array, fee per unit scaled by RATE_SCALE
+    :param tax_rates: int64 array, fraction scaled by RATE_SCALE
+    :return: dict of int64 cent arrays: product, management, tax, total; arrays of
+             python ints when the amounts do not fit int64
+    """
+    per_cent = UNIT_SCALE * RATE_SCALE // 100
+    product = round_div(fixed_product(milli_units, product_rates), per_cent)
+    management = round_div(fixed_product(milli_units, management_rates), per_cent)
+    tax = round_div(fixed_product(product + management, tax_rates), RATE_SCALE)
+
+    return {
+        'product': product,
+        'management': management,
+        'tax': tax,
+        'total': product + management + tax,
+    }
+
+
+def meter_usage(session, dealer_id, start, end, address_range=None):
+    """
+    Consumption and charges for every meter of a dealer over [start, end).
+    Units are register pulses / meter_pulse_per_rev * meter_multiplier.
+    Addresses are charged when one of their tanks has usage_billing set.
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param start: datetime
+    :param end: datetime
+    :param address_range: (first, last) service address id, restricts the run to one shard
+    :return: dict with meters, addresses (with cent arrays) and timings
+    """
+    started = time.perf_counter()
+    in_range = ServiceAddress.id.between(*address_range) if address_range is not None else true()
+
+    meters = session.query(
+        Meter.id, Meter.service_address_id, Meter.meter_multiplier, Meter.meter_pulse_per_rev
+    ).join(
+        ServiceAddress, Meter.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        in_range
+    ).order_by(Meter.id).all()
+
+    billable = exists().where(and_(Tank.service_address_id == ServiceAddress.id, Tank.usage_billing == True))  # noqa: E712
+    addresses = session.query(
+        ServiceAddress.id, ServiceAddress.product_rate, ServiceAddress.management_rate, ServiceAddress.tax_rate
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Customer.dealer_id == dealer_id,
+        billable,
+        in_range
+    ).order_by(ServiceAddress.id).all()
+
+    meter_ids, seconds, values = load_meter_readings(
+        session, dealer_id, start - timedelta(days=config.USAGE_LOOKBACK_DAYS), end, address_range
+    )
+    loaded = time.perf_counter()
+
+    ids = np.asarray([m.id for m in meters], dtype=np.int64)
+    multipliers = np.asarray([m.meter_multiplier or 1 for m in meters], dtype=np.float64)
+    pulses_per_rev = np.asarray([m.meter_pulse_per_rev or 1 for m in meters], dtype=np.float64)
+
+    pair_meters, deltas, rolled = register_deltas(meter_ids, seconds, values, (start - EPOCH).total_seconds())
+    positions = np.searchsorted(ids, pair_meters)
+
+    pulses = np.bincount(positions, weights=deltas, minlength=len(ids))
+    rollovers = np.bincount(positions, weights=rolled, minlength=len(ids)).astype(np.int64)
+    units = pulses / pulses_per_rev * multipliers
+    meter_milli_units = np.rint(units * UNIT_SCALE).astype(np.int64)
+
+    address_ids = np.asarray([a.id for a in addresses], dtype=np.int64)
+    meter_addresses = np.asarray([m.service_address_id for m in meters], dtype=np.int64)
+    slots = np.searchsorted(address_ids, meter_addresses)
+    charged = np.zeros(len(ids), dtype=bool)
+    if len(address_ids):
+        found = slots < len(address_ids)
+        charged[found] = address_ids[slots[found]] == meter_addresses[found]
+
+    milli_units = np.zeros(len(address_ids), dtype=np.int64)
+    np.add.at(milli_units, slots[charged], meter_milli_units[charged])
+
+    cents = price_usage(
+        milli_units,
+        to_scaled(a.product_rate for a in addresses),
+        to_scaled(a.management_rate for a in addresses),
+        to_scaled(a.tax_rate for a in addresses),
+    )
+
+    return {
+        'meter_ids': ids,
+        'meter_milli_units': meter_milli_units,
+        'pulses': pulses,
+        'rollovers': rollovers,
+        'address_ids': address_ids,
+        'milli_units': milli_units,
+        'cents': cents,
+        'timings_ms': {
+            'load': round((loaded - started) * 1000.0, 3),
+            'compute': round((time.perf_counter() - loaded) * 1000.0, 3),
+        },
+    }
+
+
+def _amount(cents):
+    return str((Decimal(int(cents)) * CENT).quantize(CENT))
+
+
+def usage_report(session, dealer_id, start, end):
+    """
+    JSON document of meter_usage(); amounts are decimal strings
+    :param session: sqlalchemy session
+    :param dealer_id:
+    :param start: datetime
+    :param end: datetime
+    :return: dict
+    """
+    usage = meter_usage(session, dealer_id, start, end)
+    cents = usage['cents']
+
+    return {
+        'dealer_id': dealer_id,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'meters': [{
+            'meter_id': int(meter_id),
+            'pulses': float(pulses),
+            'units': str(Decimal(int(milli)) * MILLI),
+            'rollovers': int(rolls),
+        } for meter_id, pulses, milli, rolls in zip(
+            usage['meter_ids'], usage['pulses'], usage['meter_milli_units'], usage['rollovers']
+        )],
+        'service_addresses': [{
+            'service_address_id': int(address_id),
+            'units': str(Decimal(int(milli)) * MILLI),
+            'product': _amount(product),
+            'management': _amount(management),
+            'tax': _amount(tax),
+            'total': _amount(total),
+        } for address_id, milli, product, management, tax, total in zip(
+            usage['address_ids'], usage['milli_units'],
+            cents['product'], cents['management'], cents['tax'], cents['total']
+        )],
+        'total': _amount(cents['total'].sum()),
+        'timings_ms': usage['timings_ms'],
+    }
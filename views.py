@@ -0,0 +1,1350 @@
+from datetime import datetime
+from datetime import timedelta
+import hashlib
+import hmac
+import threading
+import time
+import config
+import json
+import redis
+from collections import OrderedDict
+from itertools import islice
+from flask import Blueprint, abort, current_app, make_response, redirect, request, Response, render_template, \
+    url_for, flash, g, jsonify
+from flask_swagger import swagger
+from flask_login import login_required, login_user, logout_user, current_user
+from marshmallow import ValidationError
+from sqlalchemy import exc
+from sqlalchemy.orm import load_only
+from database import pool_metrics
+from extensions import db, login_manager, redis_client
+from models import *
+from schemas import CustomerSchema, ServiceAddressSchema, TankSchema, MeterSchema
+from forms import LoginForm
+from alerts import active_alerts, dealer_tank_ids, dealer_thresholds, mark_changed
+from billing import billing_period, is_cycle_day, overlapping_run, parse_day, run_progress
+from cache import response_cache
+from dealers import resolve_dealer
+from etags import collection_etag, conditional_response, row_etag
+from forecast import forecast_dealer
+from geo import dealer_geo_index, invalidate_index as invalidate_geo_index, located_documents, point_args, \
+    subscribe_invalidations as subscribe_geo_invalidations
+from importer import KINDS as IMPORT_KINDS, READERS as IMPORT_READERS, detect_format, import_rows
+from includes import load_included, requested_includes
+from metrics import numeric_gauges, request_metrics
+from provisioning import bulk_provision, parse_items
+from routing import cached_plan
+from usage import usage_report
+from radio_index import RadioEntry, device_query, radio_index
+from serializers import customer_serializer, meter_serializer, requested_fields, serviceaddress_serializer, \
+    tank_serializer
+from pagination import keyset_page, page_args, stream_json, wants_stream
+from readings import TANK, dump_readings, history_window, ingest_readings, iter_ndjson, \
+    latest_readings, parse_datetime, parse_readings, readings_between
+from tasks import billing_run_task, evaluate_alerts_task, forecast_dealer_task, meter_usage_task, plan_routes_task
+
+# the API, registered on the app by app.create_app()
+api = Blueprint('api', __name__)
+
+# errors
+errors = {
+    'ObjectDoesNotExistError': {
+        'message': "The selected object was not found.",
+        'status': 404,
+    },
+    'ResourceDoesNotExist': {
+        'message': "A resource with that ID no longer exists.",
+        'status': 410,
+        'extra': "Any extra information you want.",
+    },
+}
+
+# prefix the api default path
+api_url_prefix = config.API_URL_PREFIX
+
+# pre-serialized swagger spec, see apidocs()
+apidocs_cache = None
+apidocs_lock = threading.Lock()
+
+
+# load the user
+@login_manager.user_loader
+def load_user(id):
+    try:
+        return db.session.query(User).get(int(id))
+    except exc.SQLAlchemyError as db_err:
+        return None
+
+
+@api.before_app_first_request
+def load_radio_index():
+    radio_index.load(db.session)
+    radio_index.subscribe(redis_client)
+    subscribe_geo_invalidations(redis_client)
+
+
+# run before each request
+@api.before_app_request
+def before_request():
+    g.user = current_user
+
+
+def url_map_fingerprint():
+    """
+    Cheap digest of the registered routes, used to notice route changes in debug mode
+    :return: hex digest
+    """
+    rules = sorted('{} {}'.format(rule.rule, ','.join(sorted(rule.methods)))
+                   for rule in current_app.url_map.iter_rules())
+    return hashlib.sha1('\n'.join(rules).encode('utf-8')).hexdigest()
+
+
+def build_apidocs():
+    """
+    Generate the swagger spec and serialize it once
+    :return: dict with body bytes, strong etag and route fingerprint
+    """
+    swag = swagger(current_app)
+    swag['info']['version'] = '1.0'
+    swag['info']['title'] = 'OWL Network API'
+    body = json.dumps(swag, sort_keys=True).encode('utf-8')
+
+    return {
+        'body': body,
+        'etag': hashlib.sha1(body).hexdigest(),
+        'fingerprint': url_map_fingerprint(),
+    }
+
+
+@api.route('/api/v1.0/docs')
+def apidocs():
+    """
+    Swagger spec, built on first request and served from memory.
+    In debug mode it is rebuilt when the routes change or on ?refresh=true.
+    """
+    global apidocs_cache
+
+    with apidocs_lock:
+        stale = apidocs_cache is None or current_app.debug and (
+            request.args.get('refresh', '').lower() in ('1', 'true', 'yes') or
+            apidocs_cache['fingerprint'] != url_map_fingerprint()
+        )
+
+        if stale:
+            apidocs_cache = build_apidocs()
+
+        spec = apidocs_cache
+
+    resp = Response(spec['body'], mimetype='application/json')
+    resp.set_etag(spec['etag'])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = config.APIDOCS_MAX_AGE
+    return resp.make_conditional(request)
+
+
+# default routes
+@api.route('/', methods=['GET'])
+@api.route('/api/', methods=['GET'])
+@api.route('/api/v1.0', methods=['GET'])
+@api.route('/api/v1.0/index', methods=['GET'])
+@login_required
+def index():
+    """
+    OWL API Routes: Full List
+    :return: list
+    """
+    endpoints = {
+        '/': 'api/v1.0/index',
+        'alerts': '/api/v1.0/alerts',
+        'alerts/settings': '/api/v1.0/alerts/settings',
+        'billing/run': '/api/v1.0/billing/run?day=<date>',
+        'customers': '/api/v1.0/customers',
+        'customer/<id>': '/api/v1.0/customer/<id>',
+        'service-addresses': '/api/v1.0/customer/<id>/service-addresses',
+        'service-address/<id>': '/api/v1.0/customer/<id>/service-address/<id>',
+        'tanks': '/api/v1.0/tanks',
+        'tanks/forecast': '/api/v1.0/tanks/forecast',
+        'routes': '/api/v1.0/routes?threshold=<percent>&days=<days>',
+        'tanks/nearest': '/api/v1.0/tanks/nearest?lat=<lat>&lon=<lon>&k=<k>',
+        'service-addresses/nearby': '/api/v1.0/service-addresses/nearby?lat=<lat>&lon=<lon>&radius_km=<km>',
+        'tank/<id>': '/api/v1.0/tank/<id>',
+        'tank/<id>/history': '/api/v1.0/tank/<id>/history',
+        'tank/<id>/history/<limit>': '/api/v1.0/tank/<id>/history/<limit>',
+        'tank/<id>/provision/<radio-id>': '/api/v1.0/tank/<id>/provision/<radio-id>',
+        'tank/<id>/deprovision/<radio-id>': '/api/v1.0/tank/<id>/deprovision/<radio-id>',
+        'tanks/provision': '/api/v1.0/tanks/provision',
+        'import/<kind>': '/api/v1.0/import/<customers|service-addresses>?format=<json|ndjson|csv>',
+        'meters': '/api/v1.0/meters',
+        'meter/<id>': '/api/v1.0/meter/<id>',
+        'meters/usage': '/api/v1.0/meters/usage?start=<iso>&end=<iso>',
+        'metrics': '/metrics',
+        'radios': '/api/v1.0/radios',
+        'radio/<id>': '/api/v1.0/radio/<id>',
+        'radio/lookup/<id>': '/api/v1.0/radio/lookup/<id>',
+        'readings/batch': '/api/v1.0/readings/batch',
+    }
+
+    ordered_endpoints = OrderedDict(sorted(endpoints.items(), key=lambda t: t[0]))
+    resp = jsonify(ordered_endpoints)
+    resp.status_code = 200
+    return resp
+
+
+@api.route(api_url_prefix + '/customers', methods=['GET', 'POST'])
+@login_required
+@response_cache.cached()
+def get_customers():
+    """
+    The Customer List/Create API Endpoint
+    GET: List all customers,
+    ?include=service_addresses,tanks,meters returns a compound document
+    POST: Create a new customer
+    :return: list or pk
+    """
+
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        # select only the requested columns as plain row tuples
+        serializer = customer_serializer.project(requested_fields(CustomerSchema))
+        query = serializer.query(db.session).filter(
+            Customer.dealer_id == id
+        )
+
+        if wants_stream():
+            return stream_json('customers', query, Customer.id, serializer.dump_rows)
+
+        after, limit = page_args()
+        customers, next_after = keyset_page(query, Customer.id, after, limit)
+
+        # compound document, one batched query per included relation
+        includes = requested_includes()
+        included, included_etag = load_included(db.session, [row.id for row in customers], includes)
+
+        def build():
+            doc = {'customers': serializer.dump_rows(customers), 'next_after': next_after, 'status_code': 200}
+            if includes:
+                doc['included'] = included
+            return serializer.response(doc)
+
+        return conditional_response(
+            collection_etag(customers, serializer.fields, next_after, included_etag),
+            build
+        )
+
+    elif request.method == 'POST':
+        data = request.get_json()
+
+        try:
+            # create the new customer record
+            customer = CustomerSchema.load(data)
+            customer.dealer_id = id
+            new_customer = Customer(customer)
+            db.session.add(new_customer)
+            db.session.commit()
+            response_cache.invalidate(id)
+
+            # send the response
+            resp = CustomerSchema(customer)
+            resp.status_code = 201
+            return jsonify(resp)
+
+        except ValidationError as err:
+            return make_response(jsonify(err.messages))
+
+
+@api.route(api_url_prefix + '/customer/<int:customer_pk_id>', methods=['GET', 'PUT'])
+@login_required
+@response_cache.cached()
+def get_customer(customer_pk_id):
+    """
+    The Customer API Endpoint
+    GET: Customer instance by ID, supports ?include= like the list
+    PUT: Update Customer Instance
+    :return: customer_pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        try:
+            fields = requested_fields(CustomerSchema)
+            customer = db.session.query(Customer).options(load_only(*fields)).filter(
+                Customer.id == customer_pk_id,
+                Customer.dealer_id == id
+            ).first()
+
+            if customer:
+                customer_schema = CustomerSchema(only=fields)
+                includes = requested_includes()
+                included, included_etag = load_included(db.session, [customer.id], includes)
+
+                def build():
+                    doc = {'customer': customer_schema.dump(customer).data, 'status_code': 200}
+                    if includes:
+                        doc['included'] = included
+                    return jsonify(doc)
+
+                return conditional_response(
+                    collection_etag([customer], fields, included_etag),
+                    build
+                )
+
+        except exc.SQLAlchemyError as err:
+            db.session.rollback()
+            msg = {'code': 500, 'message': str(err)}
+            return make_response(jsonify(msg), 500)
+
+    elif request.method == 'PUT':
+        data = request.get_json()
+
+        try:
+            customer = db.session.query(Customer).filter(
+                Customer.id == customer_pk_id,
+                Customer.dealer_id == id
+            ).one()
+
+            if customer:
+                resp = CustomerSchema.load(customer)
+                resp.status_code = 202
+                return jsonify(resp)
+
+        except exc.SQLAlchemyError as err:
+            db.session.rollback()
+            msg = {'code': 500, 'message': str(err)}
+            return make_response(jsonify(msg), 500)
+
+
+@api.route(api_url_prefix + '/customer/<int:customer_pk_id>/service-addresses', methods=['GET', 'POST'])
+@login_required
+@response_cache.cached()
+def service_addresses(customer_pk_id):
+    """
+    The Service Address List/Create API Endpoint
+    GET: List all Customer Service Addresses
+    POST: Create a new customer service address
+    :param customer_pk_id
+    :return: list or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        try:
+
+            serializer = serviceaddress_serializer.project(requested_fields(ServiceAddressSchema))
+            query = serializer.query(db.session).join(
+                Customer, ServiceAddress.customer_id == Customer.id
+            ).filter(
+                ServiceAddress.customer_id == customer_pk_id,
+                Customer.dealer_id == id
+            )
+
+            if wants_stream():
+                return stream_json('service_address', query, ServiceAddress.id, serializer.dump_rows)
+
+            after, limit = page_args()
+            sa, next_after = keyset_page(query, ServiceAddress.id, after, limit)
+
+            if sa:
+                return conditional_response(
+                    collection_etag(sa, serializer.fields, next_after),
+                    lambda: serializer.response({
+                        'service_address': serializer.dump_rows(sa),
+                        'next_after': next_after,
+                        'status_code': 200
+                    })
+                )
+
+            else:
+                resp = {'code': 404, 'message': 'Service address not found...'}
+                return jsonify(resp)
+
+        except exc.SQLAlchemyError as err:
+            return make_response(jsonify(err))
+
+    elif request.method == 'POST':
+        data = request.get_json()
+        customer_id = request.json(['customer_id'])
+
+        try:
+            customer = db.session.query(Customer).filter(
+                Customer.id == customer_id
+            ).one()
+
+            if customer:
+
+                try:
+                    sa = ServiceAddressSchema.load(data)
+                    sa.customer_id = customer.id
+                    new_sa = ServiceAddress(sa)
+                    db.session.add(new_sa)
+                    db.session.commit()
+                    response_cache.invalidate(id)
+
+                    return ServiceAddressSchema.jsonify(sa)
+
+                except ValidationError as err:
+                    return make_response(jsonify(err.messages))
+
+            else:
+                # show message about object ownership
+                msg = {'code': 404, 'message': 'Object permission error.  Operation aborted...'}
+                return make_response(jsonify(msg))
+
+        except exc.SQLAlchemyError as err:
+            msg = err.messages
+            return make_response(jsonify(msg))
+
+
+@api.route(api_url_prefix + '/customer/<int:customer_pk_id>/service-address/<int:serviceaddress_pk_id>',
+           methods=['GET', 'PUT'])
+@login_required
+@response_cache.cached()
+def service_address(customer_pk_id, serviceaddress_pk_id):
+    """
+    The Service Address API Endpoint
+    GET: Service Addresses Instance by ID
+    PUT: Partial Update on Service Address Instance
+    :return: list or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        try:
+            fields = requested_fields(ServiceAddressSchema)
+            sa = db.session.query(ServiceAddress).options(load_only(*fields)).join(
+                Customer, ServiceAddress.customer_id == Customer.id
+            ).filter(
+                ServiceAddress.id == serviceaddress_pk_id,
+                ServiceAddress.customer_id == customer_pk_id,
+                Customer.dealer_id == id
+            ).first()
+
+            if sa:
+                serviceaddress_schema = ServiceAddressSchema(only=fields)
+                return conditional_response(
+                    row_etag(sa, fields),
+                    lambda: jsonify({'service_address': serviceaddress_schema.dump(sa).data, 'status_code': 200})
+                )
+
+            else:
+                # no service address found for this customer
+                msg = {'code': 404, 'message': 'Service Address {} not found for customer ID: {}'.format(
+                    serviceaddress_pk_id, customer_pk_id
+                )}
+
+                # send the response
+                return make_response(jsonify(msg))
+
+        except exc.SQLAlchemyError as err:
+            msg = {'code': 404, 'message': str(err)}
+            return make_response(jsonify(msg))
+
+    elif request.method == 'PUT':
+        pass
+
+
+@api.route(api_url_prefix + '/tanks', methods=['GET', 'POST'])
+@login_required
+@response_cache.cached()
+def tanks():
+    """
+    The Tank List or Create API Endpoint
+    GET: List Dealer Tanks
+    POST: Create New Tank
+    :return: list or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        serializer = tank_serializer.project(requested_fields(TankSchema))
+        query = serializer.query(db.session).join(
+            ServiceAddress, Tank.service_address_id == ServiceAddress.id
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            Customer.dealer_id == id
+        )
+
+        if wants_stream():
+            return stream_json('tanks', query, Tank.id, serializer.dump_rows)
+
+        after, limit = page_args()
+        tanks, next_after = keyset_page(query, Tank.id, after, limit)
+
+        return conditional_response(
+            collection_etag(tanks, serializer.fields, next_after),
+            lambda: serializer.response({
+                'tanks': serializer.dump_rows(tanks),
+                'next_after': next_after,
+                'status_code': 200
+            })
+        )
+
+    elif request.method == 'POST':
+        pass
+
+
+@api.route(api_url_prefix + '/tank/<int:tank_pk_id>', methods=['GET', 'PUT'])
+@login_required
+@response_cache.cached()
+def tank(tank_pk_id):
+    """
+    The Tank List or Create API Endpoint
+    GET:  Tank instance by ID
+    PUT: Partial Update of Tank instance
+    :return: tank or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        fields = requested_fields(TankSchema)
+        tank = get_dealer_tank(id, tank_pk_id, fields)
+
+        if tank is None:
+            msg = {'code': 404, 'message': 'Tank {} not found...'.format(tank_pk_id)}
+            return make_response(jsonify(msg), 404)
+
+        tank_schema = TankSchema(only=fields)
+        return conditional_response(
+            row_etag(tank, fields),
+            lambda: jsonify({'tank': tank_schema.dump(tank).data, 'status_code': 200})
+        )
+
+    elif request.method == 'PUT':
+        pass
+
+
+@api.route(api_url_prefix + '/tank/<int:tank_pk_id>/history', methods=['GET'])
+@login_required
+@response_cache.cached()
+def tank_history(tank_pk_id):
+    """
+    Tank Data History API Endpoint by Tank ID
+    GET: Tank instance data history, newest first
+    ?start=<iso datetime>&end=<iso datetime> bound the range,
+    defaulting to the last HISTORY_DEFAULT_DAYS days
+    :param tank_pk_id:
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        if get_dealer_tank_id(id, tank_pk_id) is None:
+            msg = {'code': 404, 'message': 'Tank {} not found...'.format(tank_pk_id)}
+            return make_response(jsonify(msg), 404)
+
+        start, end = history_window(
+            parse_datetime(request.args.get('start')),
+            parse_datetime(request.args.get('end'))
+        )
+        rows = readings_between(db.session, TANK, tank_pk_id, start, end)
+        return jsonify({'tank_id': tank_pk_id, 'history': dump_readings(rows), 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/tank/<int:tank_pk_id>/history/<int:num_records>', methods=['GET'])
+@login_required
+@response_cache.cached()
+def tank_history_records(tank_pk_id, num_records):
+    """
+    Tank Data History API Endpoint by Tank ID and
+    Number of Records to Return in the Response
+    GET: Tank instance data history and number of records to return
+    :param tank_pk_id:
+    :param num_records: capped at HISTORY_MAX_RECORDS
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        if get_dealer_tank_id(id, tank_pk_id) is None:
+            msg = {'code': 404, 'message': 'Tank {} not found...'.format(tank_pk_id)}
+            return make_response(jsonify(msg), 404)
+
+        rows = latest_readings(db.session, TANK, tank_pk_id, num_records)
+        return jsonify({'tank_id': tank_pk_id, 'history': dump_readings(rows), 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/readings/batch', methods=['POST'])
+@login_required
+def readings_batch():
+    """
+    The Bulk Reading Ingestion API Endpoint for radio gateways
+    POST: JSON array (or {"readings": [...]}) or application/x-ndjson body
+    of {network_id, receiver_time, sensor_value} documents
+    :return: counts, unknown network ids, validation errors and timings
+    """
+    id = get_dealer(current_user.id)
+
+    started = time.perf_counter()
+
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+            # one row past the cap is enough to refuse the batch, the rest is never read
+            data = list(islice(iter_ndjson(request.stream), config.READING_BATCH_MAX + 1))
+        else:
+            data = request.get_json(force=True)
+            if isinstance(data, dict):
+                data = data.get('readings')
+    except ValueError:
+        data = None
+
+    if not isinstance(data, list):
+        msg = {'code': 400, 'message': 'Expected a JSON array or NDJSON stream of readings...'}
+        return make_response(jsonify(msg), 400)
+
+    if len(data) > config.READING_BATCH_MAX:
+        msg = {'code': 413, 'message': 'Batches are limited to {} readings...'.format(config.READING_BATCH_MAX)}
+        return make_response(jsonify(msg), 413)
+
+    readings, errors = parse_readings(data)
+    parsed = time.perf_counter()
+
+    try:
+        result = ingest_readings(db.session, id, readings)
+    except exc.SQLAlchemyError as err:
+        db.session.rollback()
+        msg = {'code': 500, 'message': str(err)}
+        return make_response(jsonify(msg), 500)
+
+    if result['inserted']:
+        response_cache.invalidate(id)
+
+    if mark_changed(redis_client, result.pop('tank_ids')):
+        evaluate_alerts_task.apply_async(countdown=config.ALERT_BATCH_DELAY)
+
+    result['timings_ms']['parse'] = round((parsed - started) * 1000.0, 3)
+    result.update({'received': len(data), 'errors': errors, 'status_code': 201})
+    return make_response(jsonify(result), 201)
+
+
+@api.route(api_url_prefix + '/tanks/forecast', methods=['POST'])
+@login_required
+def tanks_forecast():
+    """
+    The Days to Empty Recompute API Endpoint
+    POST: recompute days_to_empty for all dealer tanks,
+    ?async=true queues the celery task instead of waiting for it
+    :return: summary or task id
+    """
+    id = get_dealer(current_user.id)
+
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        task = forecast_dealer_task.delay(id)
+        return make_response(jsonify({'task_id': task.id, 'status_code': 202}), 202)
+
+    result = forecast_dealer(db.session, id)
+    response_cache.invalidate(id)
+    result['status_code'] = 200
+    return jsonify(result)
+
+
+@api.route(api_url_prefix + '/routes', methods=['GET'])
+@login_required
+def delivery_routes():
+    """
+    The Delivery Run Planner API Endpoint
+    GET: today's runs, one ordered route per routing zone, for tanks at or
+    below ?threshold= percent or due within ?days= days.
+    Plans are cached per dealer per day, ?refresh=true recomputes and
+    ?async=true queues the celery task instead
+    :return: plan or task id
+    """
+    id = get_dealer(current_user.id)
+    threshold = request.args.get('threshold', default=config.ROUTE_THRESHOLD, type=float)
+    within_days = request.args.get('days', default=config.ROUTE_DUE_DAYS, type=int)
+
+    if threshold is None or within_days is None:
+        abort(400)
+
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        task = plan_routes_task.delay(id, threshold, within_days)
+        return make_response(jsonify({'task_id': task.id, 'status_code': 202}), 202)
+
+    refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+    body, hit = cached_plan(redis_client, db.session, id, threshold, within_days, refresh=refresh)
+
+    resp = Response(body, mimetype='application/json')
+    resp.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return resp
+
+
+@api.route(api_url_prefix + '/alerts', methods=['GET'])
+@login_required
+def get_alerts():
+    """
+    The Low Tank Alerts API Endpoint
+    GET: the dealer's raised alerts, lowest tanks first
+    :return: alerts
+    """
+    id = get_dealer(current_user.id)
+
+    try:
+        alerts = active_alerts(redis_client, id)
+    except redis.RedisError as err:
+        msg = {'code': 503, 'message': 'Alert state unavailable: {}'.format(err)}
+        return make_response(jsonify(msg), 503)
+
+    return jsonify({'alerts': alerts, 'status_code': 200})
+
+
+# settings field -> accepted json types
+ALERT_SETTING_FIELDS = {
+    'enabled': (bool,),
+    'low_level': (int, float),
+    'low_days': (int,),
+    'clear_margin': (int, float),
+    'clear_days': (int,),
+    'notify_email': (str,),
+}
+
+
+@api.route(api_url_prefix + '/alerts/settings', methods=['GET', 'PUT'])
+@login_required
+def alert_settings():
+    """
+    The Alert Settings API Endpoint
+    GET: thresholds in effect, config defaults where the dealer has none
+    PUT: set any of enabled, low_level, low_days, clear_margin, clear_days
+    and notify_email; null restores the default. The dealer's tanks are
+    queued for an alert pass under the new thresholds.
+    :return: thresholds
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'PUT':
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or set(data) - set(ALERT_SETTING_FIELDS):
+            fields = ', '.join(sorted(ALERT_SETTING_FIELDS))
+            msg = {'code': 400, 'message': 'Expected a JSON object of {}...'.format(fields)}
+            return make_response(jsonify(msg), 400)
+
+        for field, value in data.items():
+            types = ALERT_SETTING_FIELDS[field]
+            if value is not None and (not isinstance(value, types) or (bool not in types and isinstance(value, bool))):
+                msg = {'code': 400, 'message': 'Invalid value for {}...'.format(field)}
+                return make_response(jsonify(msg), 400)
+
+        setting = db.session.query(DealerAlertSetting).filter(DealerAlertSetting.dealer_id == id).first()
+        if setting is None:
+            setting = DealerAlertSetting(dealer_id=id)
+            db.session.add(setting)
+
+        for field, value in data.items():
+            setattr(setting, field, value)
+        db.session.commit()
+
+        # raised alerts follow the new thresholds without waiting for readings
+        if mark_changed(redis_client, dealer_tank_ids(db.session, id)):
+            evaluate_alerts_task.apply_async(countdown=config.ALERT_BATCH_DELAY)
+
+    thresholds = dealer_thresholds(db.session, [id])[id]
+    doc = thresholds._asdict()
+    doc['status_code'] = 200
+    return jsonify(doc)
+
+
+@api.route(api_url_prefix + '/billing/run', methods=['GET', 'POST'])
+@login_required
+def billing_run():
+    """
+    The Billing Cycle Run API Endpoint
+    GET: progress and shard checkpoints of the run ending on ?day=<date>
+    POST: queue the run for the cycle ending on ?day=<date>, which must be
+    a cycle day of the dealer and not overlap another run; runs resume,
+    shards already applied are skipped
+    Both default to today.
+    :return: progress or task id
+    """
+    id = get_dealer(current_user.id)
+
+    try:
+        day = parse_day(request.args.get('day'))
+    except ValueError:
+        msg = {'code': 400, 'message': 'day must be an ISO date...'}
+        return make_response(jsonify(msg), 400)
+
+    start_of_cycle = db.session.query(Dealer.start_of_billing_cycle).filter(Dealer.id == id).scalar()
+    period_start, period_end = billing_period(day, start_of_cycle)
+
+    if request.method == 'POST':
+        if not is_cycle_day(day, start_of_cycle):
+            msg = {'code': 400, 'message': '{} is not a billing cycle day of this dealer...'.format(day.isoformat())}
+            return make_response(jsonify(msg), 400)
+
+        other = overlapping_run(db.session, id, period_start, period_end)
+        if other is not None:
+            msg = {'code': 409, 'message': 'The period overlaps the billing run {} to {}...'.format(
+                other[0].isoformat(), other[1].isoformat())}
+            return make_response(jsonify(msg), 409)
+
+        task = billing_run_task.delay(id, day.isoformat())
+        return make_response(jsonify({
+            'task_id': task.id,
+            'period_start': period_start.isoformat(),
+            'period_end': period_end.isoformat(),
+            'status_code': 202
+        }), 202)
+
+    progress = run_progress(db.session, redis_client, id, period_end)
+    progress['status_code'] = 200
+    return jsonify(progress)
+
+
+@api.route(api_url_prefix + '/service-addresses/nearby', methods=['GET'])
+@login_required
+def service_addresses_nearby():
+    """
+    Service Addresses Near a Point API Endpoint
+    GET: ?lat=&lon=&radius_km= dealer service addresses within the radius,
+    nearest first, at most ?limit= of them
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+    lat, lon = point_args()
+    radius_km = request.args.get('radius_km', default=10.0, type=float)
+    limit = request.args.get('limit', default=config.PAGE_SIZE_DEFAULT, type=int)
+
+    if radius_km is None or radius_km <= 0 or limit is None or limit < 1:
+        abort(400)
+
+    index = dealer_geo_index(db.session, id)
+    ids, distances = index.addresses.within(
+        lat, lon, min(radius_km, config.GEO_RADIUS_MAX_KM), min(limit, config.GEO_RESULTS_MAX)
+    )
+
+    return serviceaddress_serializer.response({
+        'service_addresses': located_documents(
+            db.session, serviceaddress_serializer, ids, distances, index.coordinates.get
+        ),
+        'status_code': 200
+    })
+
+
+@api.route(api_url_prefix + '/tanks/nearest', methods=['GET'])
+@login_required
+def tanks_nearest():
+    """
+    Nearest Tanks API Endpoint
+    GET: ?lat=&lon=&k= the k dealer tanks closest to a truck position
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+    lat, lon = point_args()
+    k = request.args.get('k', default=config.GEO_NEAREST_DEFAULT, type=int)
+
+    if k is None or k < 1:
+        abort(400)
+
+    index = dealer_geo_index(db.session, id)
+    ids, distances = index.tanks.nearest(lat, lon, min(k, config.GEO_RESULTS_MAX))
+
+    return tank_serializer.response({
+        'tanks': located_documents(
+            db.session, tank_serializer, ids, distances,
+            lambda tank_id: index.coordinates[index.tank_addresses[tank_id]]
+        ),
+        'status_code': 200
+    })
+
+
+@api.route(api_url_prefix + '/radios', methods=['GET'])
+@login_required
+@response_cache.cached()
+def radios():
+    """
+    The Radio List API Endpoint
+    GET:  List of Dealer Radios
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        radios = [RadioEntry(*row)._asdict() for row in device_query(db.session, dealer_id=id)]
+        return jsonify({'radios': radios, 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/radio/<int:radio_pk_id>', methods=['GET', 'PUT'])
+@login_required
+def radio(radio_pk_id):
+    """
+    The Radio List API Endpoint
+    GET: Radio instance by ID
+    PUT: Partial Update on API exposed fields
+    :return: list
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        return radio_response(id, radio_pk_id)
+
+    elif request.method == 'PUT':
+        pass
+
+
+@api.route(api_url_prefix + '/radio/lookup/<int:dealer_radio_id>', methods=['GET'])
+@login_required
+def radio_lookup(dealer_radio_id):
+    """
+    The Radio Lookup by Dealer Radio ID API Endpoint
+    GET: Radio instance - network_id, tank or meter, service address, customer, dealer.
+    Answered from the in-memory radio index, the database is only read on a miss.
+    :param dealer_radio_id: the radio network_id
+    :return: radio instance
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        return radio_response(id, dealer_radio_id)
+
+
+@api.route(api_url_prefix + '/stats/radio-index', methods=['GET'])
+@login_required
+def radio_index_stats():
+    """
+    Radio Index Hit/Miss Counters for this worker
+    :return: stats
+    """
+    return jsonify({'radio_index': radio_index.stats(), 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/stats/pool', methods=['GET'])
+@login_required
+def pool_stats():
+    """
+    Database Connection Pool Counters for this worker
+    :return: stats
+    """
+    return jsonify({'pool': pool_metrics.stats(db.engine.pool), 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/stats/response-cache', methods=['GET'])
+@login_required
+def response_cache_stats():
+    """
+    Response Cache Hit/Miss Counters for this worker
+    :return: stats
+    """
+    return jsonify({'response_cache': response_cache.stats(), 'status_code': 200})
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Request, database, redis and cache metrics in the Prometheus text
+    format, for the scraper rather than API clients. Counters of every live
+    worker are included, labelled by worker; the pool, cache and radio
+    index gauges are this worker's. Disabled unless METRICS_TOKEN is set.
+    :return: text/plain
+    """
+    if not config.METRICS_TOKEN:
+        msg = {'code': 404, 'message': 'Not found...'}
+        return make_response(jsonify(msg), 404)
+
+    expected = 'Bearer {}'.format(config.METRICS_TOKEN).encode('utf-8')
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+        msg = {'code': 401, 'message': 'A valid metrics token is required...'}
+        return make_response(jsonify(msg), 401)
+
+    gauges = numeric_gauges('owl_db_pool', pool_metrics.stats(db.engine.pool))
+    gauges.update(numeric_gauges('owl_response_cache', response_cache.stats()))
+    gauges.update(numeric_gauges('owl_radio_index', radio_index.stats()))
+    return Response(request_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@api.route(api_url_prefix + '/meters', methods=['GET', 'POST'])
+@login_required
+@response_cache.cached()
+def meters():
+    """
+    The Meter List or Create API Endpoint
+    GET: List of Dealer Meters
+    POST:  Create New Meter
+    :return: list or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+
+        serializer = meter_serializer.project(requested_fields(MeterSchema))
+        query = serializer.query(db.session).join(
+            ServiceAddress, Meter.service_address_id == ServiceAddress.id
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            Customer.dealer_id == id
+        )
+
+        if wants_stream():
+            return stream_json('meters', query, Meter.id, serializer.dump_rows)
+
+        after, limit = page_args()
+        meters, next_after = keyset_page(query, Meter.id, after, limit)
+
+        return conditional_response(
+            collection_etag(meters, serializer.fields, next_after),
+            lambda: serializer.response({
+                'meters': serializer.dump_rows(meters),
+                'next_after': next_after,
+                'status_code': 200
+            })
+        )
+
+    elif request.method == 'POST':
+        pass
+
+
+@api.route(api_url_prefix + '/meters/usage', methods=['GET'])
+@login_required
+@response_cache.cached()
+def meters_usage():
+    """
+    The Meter Usage and Charges API Endpoint
+    GET: consumption per meter and usage charges per billable service
+    address for ?start=<iso datetime>&end=<iso datetime>, defaulting to the
+    last USAGE_DEFAULT_DAYS days; ?async=true queues the celery task
+    :return: usage report or task id
+    """
+    id = get_dealer(current_user.id)
+    end = parse_datetime(request.args.get('end')) or datetime.utcnow()
+    start = parse_datetime(request.args.get('start')) or end - timedelta(days=config.USAGE_DEFAULT_DAYS)
+
+    if start >= end:
+        msg = {'code': 400, 'message': 'start must be before end...'}
+        return make_response(jsonify(msg), 400)
+
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        task = meter_usage_task.delay(id, start.isoformat(), end.isoformat())
+        return make_response(jsonify({'task_id': task.id, 'status_code': 202}), 202)
+
+    report = usage_report(db.session, id, start, end)
+    report['status_code'] = 200
+    return jsonify(report)
+
+
+@api.route(api_url_prefix + '/meter/<int:meter_pk_id>', methods=['GET', 'PUT'])
+@login_required
+@response_cache.cached()
+def meter(meter_pk_id):
+    """
+    The Meter API Endpoint
+    GET: meter instance
+    PUT: Partial Update of meter instance
+    :param Meter instance
+    :return: meter or pk
+    """
+    id = get_dealer(current_user.id)
+
+    if request.method == 'GET':
+        fields = requested_fields(MeterSchema)
+        meter = db.session.query(Meter).options(load_only(*fields)).join(
+            ServiceAddress, Meter.service_address_id == ServiceAddress.id
+        ).join(
+            Customer, ServiceAddress.customer_id == Customer.id
+        ).filter(
+            Meter.id == meter_pk_id,
+            Customer.dealer_id == id
+        ).first()
+
+        if meter is None:
+            msg = {'code': 404, 'message': 'Meter {} not found...'.format(meter_pk_id)}
+            return make_response(jsonify(msg), 404)
+
+        meter_schema = MeterSchema(only=fields)
+        return conditional_response(
+            row_etag(meter, fields),
+            lambda: jsonify({'meter': meter_schema.dump(meter).data, 'status_code': 200})
+        )
+
+    elif request.method == 'PUT':
+        pass
+
+
+@api.route(api_url_prefix + '/tank/<int:tank_pk_id>/provision/<int:radio_pk_id>', methods=['POST'])
+@login_required
+def provision_radio(tank_pk_id, radio_pk_id):
+    """
+    The Provison Radio API Endpoint
+    POST: Provision tank by ID Radio by ID
+    :param tank_pk_id:
+    :param radio_pk_id: the radio network_id
+    :return: response
+    """
+    id = get_dealer(current_user.id)
+    network_id = str(radio_pk_id)
+
+    tank = get_dealer_tank(id, tank_pk_id)
+    if tank is None:
+        msg = {'code': 404, 'message': 'Tank {} not found...'.format(tank_pk_id)}
+        return make_response(jsonify(msg), 404)
+
+    current = radio_index.lookup(db.session, network_id)
+    if current is not None and (current.device_type, current.device_id) != (TANK, tank.id):
+        msg = {'code': 409, 'message': 'Radio {} is already provisioned...'.format(network_id)}
+        return make_response(jsonify(msg), 409)
+
+    previous = tank.network_id
+    tank.network_id = network_id
+    db.session.commit()
+    response_cache.invalidate(id)
+
+    if previous and previous != network_id:
+        radio_index.remove(previous)
+
+    entry = RadioEntry(network_id, TANK, tank.id, tank.service_address_id, tank.service_address.customer_id, id)
+    radio_index.add(entry)
+    return jsonify({'radio': entry._asdict(), 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/tank/<int:tank_pk_id>/deprovision/<int:radio_pk_id>', methods=['POST'])
+@login_required
+def deprovision_radio(tank_pk_id, radio_pk_id):
+    """
+    The deprovison Radio API Endpoint
+    POST: Remove the radio from the tank
+    :param tank_pk_id:
+    :param radio_pk_id: the radio network_id
+    :return: response
+    """
+    id = get_dealer(current_user.id)
+    network_id = str(radio_pk_id)
+
+    tank = get_dealer_tank(id, tank_pk_id)
+    if tank is None or tank.network_id != network_id:
+        msg = {'code': 404, 'message': 'Radio {} is not provisioned on tank {}...'.format(network_id, tank_pk_id)}
+        return make_response(jsonify(msg), 404)
+
+    tank.network_id = None
+    db.session.commit()
+    response_cache.invalidate(id)
+
+    radio_index.remove(network_id)
+    return jsonify({'tank_id': tank_pk_id, 'network_id': network_id, 'status_code': 200})
+
+
+@api.route(api_url_prefix + '/import/<kind>', methods=['POST'])
+@login_required
+def import_records(kind):
+    """
+    The Bulk Import API Endpoint
+    POST: stream a JSON array, NDJSON or CSV body of customers or
+    service-addresses; the format follows the content type or ?format=.
+    Rows are validated and inserted in chunks, bad rows are reported
+    without stopping the import.
+    :param kind: customers or service-addresses
+    :return: import summary
+    """
+    id = get_dealer(current_user.id)
+
+    if kind not in IMPORT_KINDS:
+        msg = {'code': 404, 'message': 'Can not import {}...'.format(kind)}
+        return make_response(jsonify(msg), 404)
+
+    fmt = request.args.get('format') or detect_format(request.mimetype)
+    if fmt not in IMPORT_READERS:
+        msg = {'code': 415, 'message': 'Send JSON, NDJSON or CSV, or name the format with ?format=...'}
+        return make_response(jsonify(msg), 415)
+
+    summary = import_rows(db.session, kind, id, IMPORT_READERS[fmt](request.stream))
+
+    if summary.inserted:
+        response_cache.invalidate(id)
+        invalidate_geo_index(id)
+
+    doc = summary.to_dict()
+    doc['status_code'] = 200 if summary.fatal is None else 400
+    return make_response(jsonify(doc), doc['status_code'])
+
+
+@api.route(api_url_prefix + '/tanks/provision', methods=['POST'])
+@login_required
+def bulk_provision_radios():
+    """
+    The Bulk Radio Provisioning API Endpoint
+    POST: JSON array (or {"items": [...]}) of {"tank_id", "network_id", "action"}
+    objects, action is provision (the default) or deprovision. Items apply in
+    order in a single transaction and each gets the code the single-item
+    endpoints would have returned.
+    :return: per-item results
+    """
+    id = get_dealer(current_user.id)
+
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        data = data.get('items')
+
+    if not isinstance(data, list):
+        msg = {'code': 400, 'message': 'Expected a JSON array of provisioning items...'}
+        return make_response(jsonify(msg), 400)
+
+    if len(data) > config.PROVISION_BATCH_MAX:
+        msg = {'code': 413, 'message': 'Batches are limited to {} items...'.format(config.PROVISION_BATCH_MAX)}
+        return make_response(jsonify(msg), 413)
+
+    items, errors = parse_items(data)
+
+    try:
+        results, added, removed, timings = bulk_provision(db.session, id, items)
+    except exc.SQLAlchemyError as err:
+        db.session.rollback()
+        msg = {'code': 500, 'message': str(err)}
+        return make_response(jsonify(msg), 500)
+
+    if added or removed:
+        response_cache.invalidate(id)
+        radio_index.update(added, removed)
+        invalidate_geo_index(id)
+
+    results = sorted(results + errors, key=lambda result: result['index'])
+    succeeded = sum(1 for result in results if result['code'] == 200)
+
+    return jsonify({
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'timings_ms': timings,
+        'status_code': 200
+    })
+
+
+@api.route(api_url_prefix + '/login', methods=['GET'])
+def login_redirect():
+    """
+    Redirect to auth/login
+    :return: redirect url
+    """
+    return redirect(url_for('.login'), 302)
+
+
+@api.route(api_url_prefix + '/auth/login', methods=['GET', 'POST'])
+def login():
+
+    form = LoginForm()
+
+    if current_user.is_authenticated:
+        return redirect(url_for('.index'))
+
+    if form.validate():
+        username = form.username.data
+        password = form.password.data
+
+        try:
+            user = db.session.query(User).filter_by(username=username).first()
+
+            if user is None or not user.check_password(password):
+                flash('Username or password is invalid!  Please try again...')
+                return redirect(url_for('.login'))
+
+            # login the user and redirect
+            login_user(user)
+            flash('You have been logged in successfully...', 'success')
+            return redirect(request.args.get('next') or url_for('.index'))
+
+        except exc.SQLAlchemyError as db_err:
+            flash('Database returned error {}'.format(str(db_err)))
+            return redirect(url_for('.login'))
+
+    return render_template(
+        'login.html',
+        form=form
+    )
+
+
+@api.route(api_url_prefix + '/logout', methods=['GET'])
+def logout():
+    logout_user()
+    return redirect(url_for('.login'))
+
+
+@api.app_errorhandler(404)
+def page_not_found(err):
+    return render_template('404.html'), 404
+
+
+@api.app_errorhandler(500)
+def internal_server_error(err):
+    return render_template('500.html'), 500
+
+
+def get_dealer(id):
+    """
+    Get the Dealer ID for the Current User
+    :param id:
+    :return: dealer_id
+    """
+    ctx = resolve_dealer(db.session, id)
+
+    if ctx is None:
+        abort(403)
+
+    return ctx.dealer_id
+
+
+def get_dealer_tank(dealer_id, tank_pk_id, fields=None):
+    """
+    Load a tank owned by the dealer
+    :param dealer_id:
+    :param tank_pk_id:
+    :param fields: only load these columns
+    :return: Tank or None
+    """
+    query = db.session.query(Tank)
+
+    if fields:
+        query = query.options(load_only(*fields))
+
+    return query.join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Tank.id == tank_pk_id,
+        Customer.dealer_id == dealer_id
+    ).first()
+
+
+def radio_response(dealer_id, network_id):
+    """
+    Serialize a radio index lookup scoped to the dealer
+    :param dealer_id:
+    :param network_id:
+    :return: response
+    """
+    entry = radio_index.lookup(db.session, network_id)
+
+    if entry is None or entry.dealer_id != dealer_id:
+        msg = {'code': 404, 'message': 'Radio {} not found...'.format(network_id)}
+        return make_response(jsonify(msg), 404)
+
+    return jsonify({'radio': entry._asdict(), 'status_code': 200})
+
+
+def get_dealer_tank_id(dealer_id, tank_pk_id):
+    """
+    Confirm a tank belongs to the dealer
+    :param dealer_id:
+    :param tank_pk_id:
+    :return: tank_id or None
+    """
+    return db.session.query(Tank.id).join(
+        ServiceAddress, Tank.service_address_id == ServiceAddress.id
+    ).join(
+        Customer, ServiceAddress.customer_id == Customer.id
+    ).filter(
+        Tank.id == tank_pk_id,
+        Customer.dealer_id == dealer_id
+    ).scalar()
+
+
+def flash_errors(form):
+    for field, errors in form.errors.items():
+        for error in errors:
+            flash(u"Error in the %s field - %s" % (
+                getattr(form, field).label.text,
+                error
+            ))
@@ -0,0 +1,9 @@
+"""
+WSGI entry point
+
+    gunicorn wsgi:app
+    FLASK_APP=wsgi.py flask import customers customers.csv --dealer 1
+"""
+from app import create_app
+
+app = create_app()